@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Compares the performance of connectors used to exchange data between
+subdomains located on the same host.
+
+For every message size, two processes exchange messages in a ping-pong
+pattern, in the same way two subdomain runners exchange distributions
+in every step of the simulation.  The average round-trip time is saved.
+"""
+
+import ctypes
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import zmq
+
+from sailfish.connector import ZMQSubdomainConnector, SharedMemorySubdomainConnector
+
+iters = 1000
+warmup = 100
+
+
+def ping_pong(connector, size, first, timings=None):
+    ctx = zmq.Context()
+    connector.init_runner(ctx)
+    quit_ev = mp.Event()
+    send = np.ones(size, dtype=np.float32)
+    recv = np.zeros(size, dtype=np.float32)
+
+    for i in range(warmup + iters):
+        if i == warmup:
+            t0 = time.time()
+        if first:
+            connector.send(send)
+            connector.recv(recv, quit_ev)
+        else:
+            connector.recv(recv, quit_ev)
+            connector.send(send)
+
+    if timings is not None:
+        timings.put((time.time() - t0) / iters)
+    # Make sure all messages are delivered before the process terminates.
+    ctx.destroy()
+
+
+def run_benchmark(conn_cls, make_pair, size, ids):
+    c1, c2 = getattr(conn_cls, make_pair)(ctypes.c_float, (size, size), ids)
+    timings = mp.Queue()
+    remote = mp.Process(target=ping_pong, args=(c2, size, False))
+    remote.start()
+    ping_pong(c1, size, True, timings)
+    remote.join()
+
+    if hasattr(c1, 'ipc_files'):
+        files = c1.ipc_files + c2.ipc_files
+    else:
+        files = [c1.ipc_file]
+    for f in files:
+        if os.path.exists(f):
+            os.unlink(f)
+
+    return timings.get()
+
+
+if __name__ == '__main__':
+    summary = []
+    for i, size in enumerate(np.logspace(8, 22, 15, base=2).astype(np.uint32)):
+        size = int(size)
+        t_ipc = run_benchmark(ZMQSubdomainConnector, 'make_ipc_pair', size,
+                              (2 * i, 2 * i + 1))
+        t_shm = run_benchmark(SharedMemorySubdomainConnector, 'make_pair',
+                              size, (2 * i, 2 * i + 1))
+        print('{0:9d} elements: ipc {1:.3e} s, shm {2:.3e} s ({3:.2f}x)'.format(
+              size, t_ipc, t_shm, t_ipc / t_shm))
+        summary.append((size, t_ipc, t_shm))
+
+    np.savetxt('local_connectors.dat', summary, ['%d', '%.6e', '%.6e'])
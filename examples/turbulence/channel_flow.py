@@ -237,7 +237,16 @@ class ChannelSim(LBFluidSim, LBForcedSim, ReynoldsStatsMixIn, Vis2DSliceMixIn):
             self.config.logger.info(line)
 
     def before_main_loop(self, runner):
-        self.prepare_reynolds_stats(runner, axis='x')
+        self.prepare_reynolds_stats(
+            runner, axis='x',
+            callback=lambda stats: self._save_reynolds_stats(runner, stats))
+
+    def _save_reynolds_stats(self, runner, stats):
+        output_path = os.path.join(self.config.output, 'reyn_stats')
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        np.savez('%s/stats_%s.%s' % (output_path, runner._spec.id,
+                                     stats['iters'][-1]), **stats)
 
     def after_step(self, runner):
         # Ignore transients.
@@ -250,14 +259,10 @@ class ChannelSim(LBFluidSim, LBForcedSim, ReynoldsStatsMixIn, Vis2DSliceMixIn):
         if mod == every - 1:
             self.need_fields_flag = True
         elif mod == 0:
-            stats = self.collect_reynolds_stats(runner)
-
-            if stats is not None:
-                output_path = os.path.join(self.config.output, 'reyn_stats')
-                if not os.path.exists(output_path):
-                    os.makedirs(output_path)
-                np.savez('%s/stats_%s.%s' % (output_path, runner._spec.id,
-                                             self.iteration), **stats)
+            self.collect_reynolds_stats(runner)
+
+    def after_main_loop(self, runner):
+        self.finish_reynolds_stats(runner)
 
 if __name__ == '__main__':
     ctrl = LBSimulationController(ChannelSim, EqualSubdomainsGeometry3D)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Measures the time of geometry setup for a synthetic porous medium.
+
+The geometry is a 3D box filled with a random solid matrix, with
+a velocity inlet (with a per-node velocity profile) and a Grad outflow
+boundary (using scratch space).  No compute device is necessary.
+
+Usage: PYTHONPATH=. perftest/geo_setup.py [--size N] [--porosity P] [--cache]
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from scipy import ndimage
+
+from sailfish import geo_encoder
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.lb_base import LBSim
+from sailfish.node_type import (NTEquilibriumVelocity, NTFullBBWall,
+                                NTGradFreeflow, multifield)
+from sailfish.subdomain import Subdomain3D, SubdomainSpec3D
+from sailfish.subdomain_runner import SubdomainRunner
+from sailfish.sym import D3Q19
+
+
+class PorousSubdomain(Subdomain3D):
+    porosity = 0.7
+    seed = 0
+
+    def boundary_conditions(self, hx, hy, hz):
+        # Thresholded smoothed noise gives a connected random pore space
+        # with the requested porosity.
+        rng = np.random.RandomState(self.seed)
+        noise = ndimage.gaussian_filter(rng.random_sample(hx.shape), 2.0)
+        interior = (hx > 0) & (hx < self.gx - 1)
+        solid = noise > np.percentile(noise[interior], 100.0 * self.porosity)
+        self.set_node(solid & interior, NTFullBBWall)
+
+        inlet = (hx == 0)
+        self.set_node(inlet, NTEquilibriumVelocity(multifield(
+            (0.01 * np.sin(np.pi * hy / self.gy) * np.sin(np.pi * hz / self.gz),
+             0.0, 0.0), inlet)))
+        self.set_node(hx == self.gx - 1, NTGradFreeflow)
+
+
+def make_subdomain(size, porosity, threads=0, cache_dir=''):
+    config = LBConfig()
+    config.init_iters = 0
+    config.seed = 0
+    config.precision = 'single'
+    config.block_size = 64
+    config.mem_alignment = 1
+    config.node_addressing = 'direct'
+    config.lat_nx = config.lat_ny = config.lat_nz = size
+    config.logger = logging.getLogger('geo_setup')
+    config.grid = 'D3Q19'
+    config.mode = 'batch'
+    config.periodic_x = config.periodic_y = config.periodic_z = False
+    config.use_link_tags = False
+    config.time_dependence = False
+    config.space_dependence = False
+    config.access_pattern = 'AB'
+    config.geometry_cache_dir = cache_dir
+    config.geometry_threads = threads
+
+    spec = SubdomainSpec3D((0, 0, 0), (size, size, size), envelope_size=1,
+                           id_=0)
+    spec.runner = SubdomainRunner(LBSim(config), spec, output=None,
+                                  backend=DummyBackend(), quit_event=None)
+    spec.runner._init_shape()
+
+    PorousSubdomain.porosity = porosity
+    sub = PorousSubdomain([size, size, size], spec, D3Q19)
+    sub.allocate()
+    return sub
+
+
+def timed(f, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=128,
+                        help='linear size of the lattice')
+    parser.add_argument('--porosity', type=float, default=0.7,
+                        help='fraction of the interior occupied by fluid')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of measurements (the best one is '
+                        'reported)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of threads used for geometry processing')
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='also measure the time of loading the geometry '
+                        'from the geometry cache')
+    args = parser.parse_args()
+
+    sub = make_subdomain(args.size, args.porosity, args.threads)
+    t_reset = timed(lambda: sub.reset(encode=False), 1)
+
+    def _prepare():
+        encoder = geo_encoder.GeoEncoderConst(sub)
+        encoder.prepare_encode(sub._type_map_base, sub._param_map_base,
+                               sub._params, sub._orientation_base, False)
+
+    t_prepare = timed(_prepare, args.repeat)
+
+    boundary = np.sum(sub._param_map_base != 0)
+    print('lattice: {0}^3  boundary nodes: {1}'.format(args.size, boundary))
+    print('reset (incl. prepare_encode): {0:.3f} s'.format(t_reset))
+    print('prepare_encode: {0:.3f} s'.format(t_prepare))
+
+    if args.cache:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            t_store = timed(make_subdomain(args.size, args.porosity,
+                                           args.threads, cache_dir).reset, 1)
+            t_load = timed(make_subdomain(args.size, args.porosity,
+                                          args.threads, cache_dir).reset, 1)
+        finally:
+            shutil.rmtree(cache_dir)
+        print('reset (incl. encoding and caching): {0:.3f} s'.format(t_store))
+        print('reset (cached): {0:.3f} s'.format(t_load))
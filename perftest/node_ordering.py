@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Compares the speed of the node orderings available with indirect addressing.
+
+The geometry is a periodic 3D box filled with a stochastically generated
+porous medium (randomly placed, overlapping spherical obstacles, as in the
+porous_anisotropy showcase), with the flow driven by a body force.
+A compute device is necessary.
+
+Usage: PYTHONPATH=. perftest/node_ordering.py [--size N] [--porosity P]
+"""
+
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+from scipy import ndimage
+
+from sailfish import sparse
+from sailfish.controller import LBSimulationController
+from sailfish.geo import RCBGeometry3D
+from sailfish.lb_base import LBForcedSim
+from sailfish.lb_single import LBFluidSim
+from sailfish.node_type import NTFullBBWall
+from sailfish.subdomain import Subdomain3D
+
+_media = {}
+
+
+def porous_medium(shape, porosity, radius, seed=0):
+    """Returns a Boolean array (True for solid nodes) of randomly placed,
+    overlapping spheres covering approximately (1 - porosity) of the
+    volume.
+
+    :param shape: shape of the array (z, y, x)
+    """
+    key = (tuple(shape), porosity, radius, seed)
+    if key not in _media:
+        # For a Boolean model of overlapping spheres, the porosity is
+        # exp(-n * V), where n is the number density of the spheres.
+        volume = 4.0 / 3.0 * np.pi * radius**3
+        count = int(round(-np.log(porosity) * np.prod(shape) / volume))
+        rng = np.random.RandomState(seed)
+        centers = np.ones(shape, dtype=np.bool_)
+        centers[tuple(rng.randint(0, n, count) for n in shape)] = False
+        # Periodic padding, so that the obstacles wrap around the domain.
+        pad = int(np.ceil(radius))
+        dist = ndimage.distance_transform_edt(
+            np.pad(centers, pad, mode='wrap'))
+        _media[key] = dist[(slice(pad, -pad),) * 3] <= radius
+    return _media[key]
+
+
+class PorousGeometry(RCBGeometry3D):
+    def wall_map(self):
+        return porous_medium(list(reversed(self.gsize)),
+                             self.config.porosity, self.config.radius)
+
+
+class PorousSubdomain(Subdomain3D):
+    def _wall_map(self, hx, hy, hz):
+        wall = porous_medium((self.gz, self.gy, self.gx),
+                             self.config.porosity, self.config.radius)
+        return wall[hz % self.gz, hy % self.gy, hx % self.gx]
+
+    def load_active_node_map(self, hx, hy, hz):
+        self.set_active_node_map_from_wall_map(self._wall_map(hx, hy, hz))
+
+    def boundary_conditions(self, hx, hy, hz):
+        self.set_node(self._wall_map(hx, hy, hz), NTFullBBWall)
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+        sim.vx[:] = 0.0
+        sim.vy[:] = 0.0
+        sim.vz[:] = 0.0
+
+
+class PorousSim(LBFluidSim, LBForcedSim):
+    subdomain = PorousSubdomain
+
+    @classmethod
+    def add_options(cls, group, dim):
+        group.add_argument('--porosity', type=float, default=0.6,
+                           help='fraction of the volume occupied by fluid')
+        group.add_argument('--radius', type=float, default=4.0,
+                           help='radius of the obstacles')
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'grid': 'D3Q19',
+            'visc': 0.1,
+            'periodic_x': True,
+            'periodic_y': True,
+            'periodic_z': True})
+
+    def __init__(self, config):
+        super(PorousSim, self).__init__(config)
+        self.add_body_force((1e-6, 0.0, 0.0))
+
+
+def run(ordering, args):
+    settings = {
+        'mode': 'benchmark',
+        'quiet': True,
+        'node_addressing': 'indirect',
+        'node_ordering': ordering,
+        'lat_nx': args.size,
+        'lat_ny': args.size,
+        'lat_nz': args.size,
+        'porosity': args.porosity,
+        'radius': args.radius,
+        'block_size': args.block_size,
+        'max_iters': args.max_iters,
+        'benchmark_sample_from': args.max_iters // 5,
+        'every': args.max_iters}
+
+    ctrl = LBSimulationController(PorousSim, PorousGeometry, settings)
+    timing_infos, _, _, subdomains = ctrl.run(ignore_cmdline=True)
+    fluid_nodes = dict((s.id, s.num_active_nodes) for s in subdomains)
+    # Only fluid nodes are taken into account.
+    return (sum(fluid_nodes[ti.subdomain_id] / ti.total for ti in
+                timing_infos) * 1e-6,
+            sum(fluid_nodes[ti.subdomain_id] / ti.comp for ti in
+                timing_infos) * 1e-6)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=128,
+                        help='linear size of the lattice')
+    parser.add_argument('--porosity', type=float, default=0.6,
+                        help='fraction of the volume occupied by fluid')
+    parser.add_argument('--radius', type=float, default=4.0,
+                        help='radius of the obstacles')
+    parser.add_argument('--block_size', type=int, default=64,
+                        help='size of the thread blocks (also used for '
+                        'the blocked ordering)')
+    parser.add_argument('--max_iters', type=int, default=5000,
+                        help='number of iterations to run for every ordering')
+    parser.add_argument('--orderings', type=str, nargs='+',
+                        default=sparse.NODE_ORDERINGS,
+                        choices=sparse.NODE_ORDERINGS,
+                        help='node orderings to compare')
+    args = parser.parse_args()
+
+    wall = porous_medium((args.size,) * 3, args.porosity, args.radius)
+    print('lattice: {0}^3  porosity: {1:.3f}'.format(
+        args.size, 1.0 - np.mean(wall)))
+    for ordering in args.orderings:
+        eff, comp = run(ordering, args)
+        print('{0:>10}: MLUPS eff:{1:.2f}  comp:{2:.2f}'.format(
+            ordering, eff, comp))
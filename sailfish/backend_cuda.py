@@ -5,6 +5,7 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
 import operator
+import os
 
 import pycuda.compiler
 import pycuda.tools
@@ -13,6 +14,8 @@ import pycuda.gpuarray as cudaarray
 import pycuda.reduction as reduction
 from functools import reduce
 
+from sailfish import codegen
+
 
 def _expand_block(block):
     if type(block) is int:
@@ -187,8 +190,15 @@ class CUDABackend(object):
     def to_buf_async(self, cl_buf, stream=None):
         cuda.memcpy_htod_async(cl_buf, self.buffers[cl_buf], stream)
 
-    def from_buf_async(self, cl_buf, stream=None):
-        cuda.memcpy_dtoh_async(self.buffers[cl_buf], cl_buf, stream)
+    def from_buf_async(self, cl_buf, stream=None, target=None):
+        """Asynchronously copies data from a device buffer to the host.
+
+        :param target: contiguous page-locked array to copy the data to; if
+            not specified, the host buffer associated with cl_buf is used
+        """
+        if target is None:
+            target = self.buffers[cl_buf]
+        cuda.memcpy_dtoh_async(target, cl_buf, stream)
 
     def build(self, source):
         if self.options.cuda_nvcc_opts:
@@ -209,7 +219,11 @@ class CUDABackend(object):
         #    options.append('-src-in-ptx')
 
         if self.options.cuda_cache:
-            cache = None
+            # Keep the compiled modules together with the cached source code
+            # so that the whole compilation pipeline is skipped on a hit.
+            cache = codegen.code_cache_dir(self.options)
+            if cache is not None:
+                cache = os.path.join(cache, 'cuda')
         else:
             cache = False
 
@@ -46,8 +46,10 @@ class DummyBackend(object):
     def to_buf_async(self, *args):
         pass
 
-    def from_buf_async(self, *args):
-        pass
+    def from_buf_async(self, cl_buf, stream=None, target=None):
+        # Buffers allocated by this backend are host arrays.
+        if target is not None:
+            target[:] = np.ravel(cl_buf)
 
     def get_defines(self):
         return {
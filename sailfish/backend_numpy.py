@@ -0,0 +1,746 @@
+"""Sailfish NumPy backend.
+
+Runs simulations on the CPU.  Instead of compiling the code generated from
+the Mako templates, the backend uses vectorized NumPy implementations of the
+kernels required by single fluid LB models.  Every kernel call processes the
+whole subdomain as a batch of array operations.
+
+Supported features:
+ - BGK and MRT relaxation
+ - the AB access pattern with direct node addressing
+ - fluid, full-way bounce-back and equilibrium velocity/density nodes
+ - periodic boundary conditions and inter-subdomain data exchange
+ - reduction of output fields (output_reduction.mako)
+ - running field statistics (field_statistics.mako)
+ - flow change detection for adaptive output (output_policy.mako)
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import functools
+import operator
+import time
+
+import numpy as np
+import sympy
+
+from sailfish import sym, sym_equilibrium
+from sailfish.util import block_sum
+import sailfish.node_type as nt
+
+
+class NumpyBuffer(object):
+    """Memory buffer on the (virtual) NumPy compute device."""
+
+    def __init__(self, data):
+        self.data = data
+        # Incremented every time the buffer is updated from the host.  Used
+        # to invalidate data derived from the buffer contents.
+        self.version = 0
+
+
+class NumpyKernel(object):
+    def __init__(self, func, args, needs_iteration):
+        self.func = func
+        self.args = args
+        self.needs_iteration = needs_iteration
+
+    def __call__(self):
+        self.func(*self.args)
+
+
+class NumpyStream(object):
+    """All operations are executed synchronously, so there is nothing to
+    wait for."""
+
+    def synchronize(self):
+        pass
+
+    def wait_for_event(self, event):
+        pass
+
+
+class NumpyEvent(object):
+    def __init__(self):
+        self.time = time.time()
+
+    def synchronize(self):
+        pass
+
+    def query(self):
+        return True
+
+    def time_since(self, event):
+        """Returns the time elapsed since 'event' in ms."""
+        return (self.time - event.time) * 1e3
+
+
+class NumpyKernelError(Exception):
+    pass
+
+
+def _host_array(array):
+    if array.base is not None and isinstance(array.base, np.ndarray):
+        return array.base
+    return array
+
+
+def _copy(dst, src):
+    dst.reshape(-1)[:] = np.ravel(src)
+
+
+class NumpyBackend(object):
+    name = 'numpy'
+    array = np
+    FatalError = NumpyKernelError
+
+    @classmethod
+    def devices_count(cls):
+        return 1
+
+    @classmethod
+    def add_options(cls, group):
+        return 0
+
+    def __init__(self, options, gpu_id=0):
+        """Initializes the NumPy backend.
+
+        :param options: LBConfig object
+        :param gpu_id: ignored, the computation always takes place on the host
+        """
+        self.buffers = {}
+        self.arrays = {}
+        self.options = options
+        if options.precision == 'double':
+            self.float = np.float64
+        else:
+            self.float = np.float32
+
+        # To keep track of allocated memory.
+        self._total_memory_bytes = 0
+        self._iteration_kernels = []
+
+    @property
+    def supports_printf(self):
+        return False
+
+    @property
+    def info(self):
+        return 'NumPy {0} / CPU'.format(np.__version__)
+
+    @property
+    def total_memory(self):
+        return self._total_memory_bytes
+
+    def set_iteration(self, it):
+        for kernel in self._iteration_kernels:
+            kernel.args[-1] = it
+
+    def alloc_buf(self, size=None, like=None, wrap_in_array=False):
+        """Allocates a buffer on the device."""
+        if like is not None:
+            host = _host_array(like)
+            buf = NumpyBuffer(host.copy())
+            self.buffers[buf] = host
+            if wrap_in_array:
+                self.arrays[buf] = buf.data
+        else:
+            buf = NumpyBuffer(np.zeros(size // np.dtype(self.float).itemsize,
+                                       dtype=self.float))
+        self._total_memory_bytes += buf.data.nbytes
+        return buf
+
+    def alloc_async_host_buf(self, shape, dtype):
+        """Allocates a buffer that can be used for asynchronous data
+        transfers."""
+        return np.zeros(shape, dtype=dtype)
+
+    def to_buf(self, cl_buf, source=None):
+        """Copies data from the host to a device buffer."""
+        if source is None:
+            if cl_buf in self.buffers:
+                _copy(cl_buf.data, self.buffers[cl_buf])
+            else:
+                raise ValueError('Unknown compute buffer and source not specified.')
+        else:
+            _copy(cl_buf.data, _host_array(source))
+        cl_buf.version += 1
+
+    def from_buf(self, cl_buf, target=None):
+        """Copies data from a device buffer to the host."""
+        if target is None:
+            if cl_buf in self.buffers:
+                _copy(self.buffers[cl_buf], cl_buf.data)
+            else:
+                raise ValueError('Unknown compute buffer and target not specified.')
+        else:
+            _copy(_host_array(target), cl_buf.data)
+
+    def to_buf_async(self, cl_buf, stream=None):
+        self.to_buf(cl_buf)
+
+    def from_buf_async(self, cl_buf, stream=None, target=None):
+        if target is None:
+            self.from_buf(cl_buf)
+        else:
+            _copy(target, cl_buf.data)
+
+    def build(self, source):
+        """Prepares the kernels.
+
+        :param source: code generation context (as returned by
+            BlockCodeGenerator.get_code() for the 'numpy' target)
+        """
+        if not isinstance(source, dict):
+            raise ValueError('The numpy backend cannot execute kernel source code.')
+        return NumpyModule(source, self.float)
+
+    def get_kernel(self, prog, name, block, args, args_format, shared=0,
+            needs_iteration=False, more_shared=False):
+        """
+        :param name: kernel name
+        :param block: ignored
+        :param args: iterable of arguments to pass to the kernel
+        :param args_format: ignored
+        :param shared: ignored
+        :param needs_iteration: if True, the kernel needs access to the current iteration
+            number, which will be provided to it as the last argument
+        """
+        args = list(args)
+        if needs_iteration:
+            args.append(0)
+
+        kern = NumpyKernel(prog.get_function(name), args, needs_iteration)
+        if needs_iteration:
+            self._iteration_kernels.append(kern)
+        return kern
+
+    def run_kernel(self, kernel, grid_size, stream=None):
+        kernel()
+
+    def get_reduction_kernel(self, reduce_expr, map_expr, neutral, *args):
+        """Returns a reduction function; see
+        CUDABackend.get_reduction_kernel() for a description of the
+        parameters.  Both expressions are evaluated as Python code."""
+        arrays = [self.arrays[arg] for arg in args]
+        ns = dict(('x{0}'.format(i), a) for i, a in enumerate(arrays))
+        ns.update(np.__dict__)
+        map_expr = map_expr.replace('[i]', '')
+        reduce_ufunc = {
+            'a+b': np.add,
+            'a*b': np.multiply,
+            'max(a,b)': np.maximum,
+            'min(a,b)': np.minimum,
+            'fmax(a,b)': np.fmax,
+            'fmin(a,b)': np.fmin}.get(reduce_expr.replace(' ', ''))
+
+        def _reduce():
+            vals = np.ravel(eval(map_expr, ns) + np.zeros_like(arrays[0]))
+            if reduce_ufunc is not None:
+                return reduce_ufunc.reduce(np.append(
+                    np.array(eval(str(neutral), ns), dtype=vals.dtype), vals))
+            return functools.reduce(
+                lambda a, b: eval(reduce_expr, ns, {'a': a, 'b': b}), vals,
+                eval(str(neutral), ns))
+
+        return _reduce
+
+    def get_array(self, arg):
+        return self.arrays[arg]
+
+    def sync(self):
+        pass
+
+    def make_stream(self):
+        return NumpyStream()
+
+    def make_event(self, stream, timing=False):
+        return NumpyEvent()
+
+    def get_defines(self):
+        return {
+            'warp_size': 1,
+            'supports_shuffle': False,
+            'supports_printf': False,
+            'backend': 'numpy',
+            'shared_var': '',
+            'kernel': '',
+            'global_ptr': '',
+            'const_ptr': 'const',
+            'device_func': '',
+            'const_var': 'const',
+        }
+
+    def sync_stream(self, *streams):
+        pass
+
+
+class NumpyModule(object):
+    """Vectorized implementations of the kernels of the single fluid
+    LB model (models/lb_single_fluid.mako)."""
+
+    _supported_node_types = set([
+        nt._NTFluid, nt._NTGhost, nt._NTUnused, nt._NTPropagationOnly,
+        nt.NTFullBBWall, nt.NTEquilibriumVelocity, nt.NTEquilibriumDensity])
+
+    def __init__(self, ctx, float_type):
+        self._check_supported(ctx)
+
+        self.float = float_type
+        self.grid = grid = ctx['grid']
+        self.dim = grid.dim
+        self.config = ctx['config']
+        self.spec = ctx['block']
+        self.model = ctx['model']
+        self.omega = 1.0 / ctx['tau']
+        self.incompressible = ctx['incompressible']
+        self.initialization = ctx['initialization']
+
+        if self.dim == 2:
+            self.shape = (ctx['arr_ny'], ctx['arr_nx'])
+            self.lat_size = (ctx['lat_ny'], ctx['lat_nx'])
+        else:
+            self.shape = (ctx['arr_nz'], ctx['arr_ny'], ctx['arr_nx'])
+            self.lat_size = (ctx['lat_nz'], ctx['lat_ny'], ctx['lat_nx'])
+        self.num_nodes = functools.reduce(operator.mul, self.shape)
+
+        self.lat_linear = ctx['lat_linear']
+        self.lat_linear_dist = ctx['lat_linear_dist']
+
+        # With the bulk/boundary split, the boundary kernel processes the
+        # whole subdomain and bulk kernel calls are no-ops.
+        self.bulk_boundary_split = ctx.get('boundary_size', 0) > 0
+
+        self.basis = np.array([[int(x) for x in ei] for ei in grid.basis],
+                              dtype=np.int32)
+        self.weights = np.array([float(w) for w in grid.weights], dtype=self.float)
+        self.opposite = list(grid.idx_opposite)
+
+        # Source and destination slices for the propagation step.  Note that
+        # array axes are in the reverse order (z, y, x).
+        self._prop_slices = []
+        for ei in self.basis:
+            src, dst = [], []
+            for comp in reversed(ei):
+                if comp > 0:
+                    src.append(slice(None, -1))
+                    dst.append(slice(1, None))
+                elif comp < 0:
+                    src.append(slice(1, None))
+                    dst.append(slice(None, -1))
+                else:
+                    src.append(slice(None))
+                    dst.append(slice(None))
+            self._prop_slices.append((tuple(src), tuple(dst)))
+
+        # Node type decoding.
+        self._type_mask = ctx['nt_type_mask']
+        self._param_shift = ctx['nt_misc_shift']
+        self._param_mask = (1 << ctx['nt_param_shift']) - 1
+        self._orientation_shift = (ctx['nt_misc_shift'] + ctx['nt_param_shift'] +
+                                   ctx['nt_scratch_shift'])
+        self._remapped_ids = dict((nt_class, ctx['type_id_remap'][nt_class.id])
+                                  for nt_class in ctx['node_types'])
+        self._node_params = np.array(ctx['node_params'], dtype=self.float)
+        self._geo_cache = None
+
+        if self.model == 'mrt':
+            self._init_mrt(ctx['visc'])
+
+        self._post = np.zeros((grid.Q, self.num_nodes), dtype=self.float)
+
+    def _check_supported(self, ctx):
+        def _unsupported(what):
+            raise ValueError('{0} is not supported by the numpy backend.'.format(what))
+
+        if ctx['simtype'] != 'lbm' or len(ctx['grids']) != 1:
+            _unsupported('Simulation type "{0}"'.format(ctx['simtype']))
+        if ctx['model'] not in ('bgk', 'mrt'):
+            _unsupported('Relaxation model "{0}"'.format(ctx['model']))
+        if ctx['access_pattern'] != 'AB':
+            _unsupported('Access pattern "{0}"'.format(ctx['access_pattern']))
+        if ctx['node_addressing'] != 'direct':
+            _unsupported('Node addressing mode "{0}"'.format(ctx['node_addressing']))
+        if ctx['subgrid'] != 'none':
+            _unsupported('Subgrid model "{0}"'.format(ctx['subgrid']))
+        if ctx['regularized']:
+            _unsupported('Regularized relaxation')
+        if ctx['config'].minimize_roundoff:
+            _unsupported('Round-off minimization')
+        if ctx['equilibria'][0] is not sym_equilibrium.bgk_equilibrium:
+            _unsupported('Equilibrium "{0}"'.format(ctx['equilibria'][0].__name__))
+        forces = ctx.get('forces')
+        if forces is not None and (forces.numeric or forces.symbolic):
+            _unsupported('Body force')
+        if ctx['symbol_idx_map']:
+            _unsupported('Time- or space-dependent node parameter')
+
+        unsupported = set(ctx['node_types']) - self._supported_node_types
+        if unsupported:
+            _unsupported('Node type {0}'.format(
+                ', '.join(sorted(x.__name__ for x in unsupported))))
+
+    def _init_mrt(self, visc):
+        grid = self.grid
+        self._mrt_matrix = np.array(grid.mrt_matrix.tolist(), dtype=np.float64)
+        self._mrt_matrix_inv = np.linalg.inv(self._mrt_matrix)
+
+        mx, my, mz = grid.mx, grid.my, grid.mz
+        rho0 = 1 if self.incompressible else sym.S.rho
+
+        def _subs(expr):
+            expr = sympy.sympify(expr)
+            for local_var in reversed(grid.mrt_eq_symbols):
+                expr = expr.subs(local_var.lhs, local_var.rhs)
+            return expr.subs(sym.S.rho0, rho0).subs(sym.S.visc, visc)
+
+        # Index, relaxation rate, equilibrium function for the non-conserved
+        # moments.
+        self._mrt_relax = []
+        for i, coll in enumerate(grid.mrt_collision):
+            if coll == 0:
+                continue
+            rate = float(_subs(coll))
+            eq = sympy.lambdify([sym.S.rho, mx, my, mz], _subs(grid.mrt_equilibrium[i]),
+                                'numpy')
+            self._mrt_relax.append((i, rate, eq))
+
+        names = grid.mrt_names
+        self._mrt_rho = names.index('rho')
+        self._mrt_momentum = [names.index(x) for x in ('mx', 'my', 'mz')[:self.dim]]
+
+    def get_function(self, name):
+        if not hasattr(self, name) or not name[0].isupper():
+            raise ValueError('Kernel "{0}" is not available in the numpy '
+                             'backend.'.format(name))
+        return getattr(self, name)
+
+    def _dist(self, buf):
+        return buf.data.reshape((self.grid.Q,) + self.shape)
+
+    def _decode_geo(self, geo_buf):
+        """Returns a dictionary of node masks and indices computed from the
+        encoded geometry map.  The result is cached until the geometry buffer
+        is modified."""
+        key = (id(geo_buf), geo_buf.version)
+        if self._geo_cache is not None and self._geo_cache[0] == key:
+            return self._geo_cache[1]
+
+        code = geo_buf.data.reshape(self.shape).astype(np.uint32)
+        node_type = code & self._type_mask
+        orientation = code >> self._orientation_shift
+        param_idx = (code >> self._param_shift) & self._param_mask
+
+        def _is(*nt_classes):
+            mask = np.zeros(self.shape, dtype=np.bool_)
+            for nt_class in nt_classes:
+                if nt_class in self._remapped_ids:
+                    mask |= (node_type == self._remapped_ids[nt_class])
+            return mask
+
+        geo = {}
+        excluded = _is(nt._NTGhost, nt._NTUnused)
+        geo['active'] = np.logical_not(excluded)
+        geo['fbb'] = np.flatnonzero(_is(nt.NTFullBBWall))
+        geo['prop_only'] = np.flatnonzero(_is(nt._NTPropagationOnly))
+        geo['wet'] = (_is(nt._NTFluid, nt.NTEquilibriumVelocity,
+                          nt.NTEquilibriumDensity))
+
+        # Equilibrium nodes, grouped by orientation.  Nodes without
+        # a defined orientation use standard macroscopic quantities.
+        geo['eq'] = []
+        eq_all = []
+        for nt_class in (nt.NTEquilibriumVelocity, nt.NTEquilibriumDensity):
+            mask = _is(nt_class)
+            eq_all.append(np.flatnonzero(mask))
+            for o in range(1, 2 * self.dim + 1):
+                idx = np.flatnonzero(mask & (orientation == o))
+                if idx.size == 0:
+                    continue
+                geo['eq'].append((nt_class, o, idx,
+                                  np.ravel(param_idx)[idx].astype(np.intp)))
+        geo['eq_all'] = np.concatenate(eq_all)
+
+        self._geo_cache = (key, geo)
+        return geo
+
+    def _equilibrium(self, i, rho, rho0, v, usq):
+        """Returns the BGK equilibrium for the i-th distribution."""
+        eu = 0.0
+        for comp, c in enumerate(self.basis[i]):
+            if c > 0:
+                eu = eu + v[comp]
+            elif c < 0:
+                eu = eu - v[comp]
+        if self.basis[i].any():
+            h = 3.0 * eu + 4.5 * eu * eu - 1.5 * usq
+        else:
+            h = -1.5 * usq
+        return self.weights[i] * (rho + rho0 * h)
+
+    def _equilibrium_all(self, rho, v):
+        rho0 = 1.0 if self.incompressible else rho
+        usq = sum(x * x for x in v)
+        return np.array([self._equilibrium(i, rho, rho0, v, usq)
+                         for i in range(self.grid.Q)])
+
+    def _eq_node_macro(self, f, rho, v, geo):
+        """Computes macroscopic quantities for the equilibrium nodes.
+
+        Modifies rho and v in place.
+        """
+        for nt_class, orientation, idx, param_idx in geo['eq']:
+            fi = f[:, idx]
+            # Fill the unknown distributions with the values of their opposites.
+            for missing in sym.get_missing_dists(self.grid, orientation):
+                fi[missing] = fi[self.opposite[missing]]
+            rho_sum = fi.sum(axis=0)
+            normal = [int(x) for x in self.grid.dir_to_vec(orientation)]
+
+            if nt_class is nt.NTEquilibriumVelocity:
+                vn = 0.0
+                for comp in range(self.dim):
+                    v[comp][idx] = self._node_params[param_idx + comp]
+                    vn = vn + normal[comp] * v[comp][idx]
+                if self.incompressible:
+                    rho[idx] = rho_sum + vn
+                else:
+                    rho[idx] = rho_sum / (1.0 - vn)
+            else:
+                par_rho = self._node_params[param_idx]
+                for comp in range(self.dim):
+                    v[comp][idx] = -normal[comp] * (rho_sum - par_rho) / par_rho
+                rho[idx] = par_rho
+
+    def SetInitialConditions(self, dist, *args):
+        v = [x.data.reshape(-1) for x in args[:self.dim]]
+        rho = args[self.dim].data.reshape(-1)
+        f = self._dist(dist).reshape(self.grid.Q, -1)
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            f[:] = self._equilibrium_all(rho, v)
+        dist.version += 1
+
+    def CollideAndPropagate(self, geo_map, dist_in, dist_out, orho, *args):
+        ov = [x.data.reshape(-1) for x in args[:self.dim]]
+        options = int(args[self.dim])
+
+        if (options & 2) and self.bulk_boundary_split:
+            return
+
+        Q = self.grid.Q
+        geo = self._decode_geo(geo_map)
+        f = self._dist(dist_in).reshape(Q, -1)
+        post = self._post
+
+        with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+            rho = f.sum(axis=0)
+            mom = np.dot(self.basis.T.astype(self.float), f)
+            rho0 = 1.0 if self.incompressible else rho
+            v = [m / rho0 for m in mom]
+            self._eq_node_macro(f, rho, v, geo)
+
+            if self.initialization:
+                v = [x.copy() for x in ov]
+
+            eq_idx = geo['eq_all']
+            if self.model == 'mrt':
+                self._relax_mrt(f, rho, v, eq_idx, post)
+            else:
+                self._relax_bgk(f, rho, v, eq_idx, post)
+
+        # Full-way bounce-back: reflect the distributions without relaxation.
+        fbb = geo['fbb']
+        if fbb.size:
+            post[:, fbb] = f[self.opposite][:, fbb]
+
+        prop_only = geo['prop_only']
+        if prop_only.size:
+            post[:, prop_only] = f[:, prop_only]
+
+        if options & 1:
+            wet = geo['wet'].reshape(-1)
+            np.copyto(orho.data.reshape(-1), rho, where=wet)
+            for dst, src in zip(ov, v):
+                np.copyto(dst, src, where=wet)
+
+        self._propagate(post, dist_out, geo['active'])
+
+    def _relax_bgk(self, f, rho, v, eq_idx, post):
+        rho0 = 1.0 if self.incompressible else rho
+        usq = sum(x * x for x in v)
+        for i in range(self.grid.Q):
+            feq = self._equilibrium(i, rho, rho0, v, usq)
+            np.add(f[i], self.omega * (feq - f[i]), out=post[i])
+            # Equilibrium nodes are set to the equilibrium directly.
+            if eq_idx.size:
+                post[i][eq_idx] = feq[eq_idx]
+
+    def _relax_mrt(self, f, rho, v, eq_idx, post):
+        m = np.dot(self._mrt_matrix, f)
+        if eq_idx.size:
+            feq = self._equilibrium_all(rho[eq_idx], [x[eq_idx] for x in v])
+            m[:, eq_idx] = np.dot(self._mrt_matrix, feq)
+
+        mrho = m[self._mrt_rho]
+        momentum = [m[i] for i in self._mrt_momentum]
+        if self.dim == 2:
+            momentum.append(0.0)
+
+        for i, rate, eq in self._mrt_relax:
+            meq = eq(mrho, *momentum)
+            m[i] -= rate * (m[i] - meq)
+            if eq_idx.size:
+                m[i][eq_idx] = (meq + np.zeros_like(mrho))[eq_idx]
+
+        post[:] = np.dot(self._mrt_matrix_inv, m)
+
+    def _propagate(self, post, dist_out, active):
+        """Streams the post-collision distributions to the neighboring nodes.
+
+        Nodes excluded from the simulation do not propagate any data, so
+        the corresponding entries in dist_out retain their old values."""
+        f_out = self._dist(dist_out)
+        for i, (src, dst) in enumerate(self._prop_slices):
+            np.copyto(f_out[i][dst], post[i].reshape(self.shape)[src],
+                      where=active[src])
+
+    def ApplyPeriodicBoundaryConditions(self, dist, axis):
+        axis = int(axis)
+        if axis >= self.dim:
+            return
+
+        f = self._dist(dist)
+        # Array axis corresponding to the spatial axis.
+        arr_axis = self.dim - 1 - axis
+        n = self.lat_size[arr_axis]
+
+        def _sel(i, pos):
+            sel = [slice(None)] * self.dim
+            sel[arr_axis] = pos
+            # Exclude padding along the X axis.
+            if arr_axis != self.dim - 1:
+                sel[-1] = slice(0, self.lat_size[-1])
+            return (i,) + tuple(sel)
+
+        for i, ei in enumerate(self.basis):
+            # Distributions which left the domain through the ghost node
+            # layer are moved to the first/last real node on the other side.
+            if ei[axis] < 0:
+                src, dst = _sel(i, 0), _sel(i, n - 2)
+            elif ei[axis] > 0:
+                src, dst = _sel(i, n - 1), _sel(i, 1)
+            else:
+                continue
+            np.copyto(f[dst], f[src], where=np.isfinite(f[src]))
+
+    def _face_sel(self, dist_num, face, pos, base_gx, nx, base_other, n_other):
+        axis = self.spec.face_to_axis(face)
+        x_sel = slice(base_gx, base_gx + nx)
+        if self.dim == 2:
+            return (dist_num, pos, x_sel)
+        other = slice(base_other, base_other + n_other)
+        if axis == 1:
+            return (dist_num, other, pos, x_sel)
+        else:
+            return (dist_num, pos, other, x_sel)
+
+    def _continuous_data(self, dist, face, args, lat_linear, collect):
+        if self.dim == 2:
+            base_gx, max_lx, buf = args
+            base_other = max_other = 0
+        else:
+            base_gx, base_other, max_lx, max_other, buf = args
+
+        face = int(face)
+        dists = sym.get_interblock_dists(self.grid, self.spec.face_to_normal(face))
+        f = self._dist(dist)
+
+        if self.dim == 2:
+            nx = int(max_lx) // len(dists)
+            buf_shape = (len(dists), nx)
+        else:
+            nx = int(max_lx)
+            n_other = int(max_other) // len(dists)
+            buf_shape = (len(dists), n_other, nx)
+
+        data = buf.data.reshape(-1)[:np.prod(buf_shape)].reshape(buf_shape)
+        for k, dist_num in enumerate(dists):
+            sel = self._face_sel(dist_num, face, lat_linear[face], int(base_gx),
+                                 nx, int(base_other), buf_shape[1])
+            if collect:
+                data[k] = f[sel]
+            else:
+                f[sel] = data[k]
+
+    def CollectContinuousData(self, dist, face, *args):
+        self._continuous_data(dist, face, args, self.lat_linear, True)
+
+    def DistributeContinuousData(self, dist, face, *args):
+        self._continuous_data(dist, face, args, self.lat_linear_dist, False)
+
+    def CollectSparseData(self, idx_array, dist, buf, max_idx):
+        max_idx = int(max_idx)
+        buf.data.reshape(-1)[:max_idx] = dist.data.reshape(-1)[
+            idx_array.data.reshape(-1)[:max_idx]]
+
+    def DistributeSparseData(self, idx_array, dist, buf, max_idx):
+        max_idx = int(max_idx)
+        dist.data.reshape(-1)[idx_array.data.reshape(-1)[:max_idx]] = \
+            buf.data.reshape(-1)[:max_idx]
+
+    def ReduceOutputField(self, geo_map, field, acc, factor, es, *args):
+        sizes, count = args[:-1], int(args[-1])
+        nonghost = tuple(slice(es, es + n) for n in reversed(sizes))
+        wet = self._decode_geo(geo_map)['wet'][nonghost]
+        values = np.where(wet, field.data.reshape(self.shape)[nonghost], 0.0)
+
+        wet_count = block_sum(wet, factor, dtype=np.int32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            val = np.ravel(block_sum(values, factor, dtype=np.float64) /
+                           wet_count)
+
+        out = acc.data.reshape(-1)
+        if count <= 1:
+            out[:] = val
+        else:
+            out += (val - out) / count
+
+    def PackOutputFieldHalf(self, acc, out, cnx):
+        out.data.reshape(-1)[:] = np.ravel(acc.data).astype(np.float16).view(
+            np.uint16)
+
+    def UpdateFieldMoments(self, geo_map, f, mean, m2, n):
+        n = int(n)
+        wet = np.ravel(self._decode_geo(geo_map)['wet'])
+        mean = mean.data.reshape(-1)
+        d = f.data.reshape(-1)[wet].astype(np.float64) - mean[wet]
+        m2.data.reshape(-1)[wet] += d * d * ((n - 1) / float(n))
+        mean[wet] += d / n
+
+    def UpdateFieldCovariance(self, geo_map, f, g, mean_f, mean_g, cov, n):
+        n = int(n)
+        wet = np.ravel(self._decode_geo(geo_map)['wet'])
+        df = f.data.reshape(-1)[wet].astype(np.float64) - mean_f.data.reshape(-1)[wet]
+        dg = g.data.reshape(-1)[wet].astype(np.float64) - mean_g.data.reshape(-1)[wet]
+        cov.data.reshape(-1)[wet] += df * dg * ((n - 1) / float(n))
+
+    def ComputeVelocityChange(self, geo_map, *args):
+        dim = (len(args) - 1) // 2
+        v, snap, change = args[:dim], args[dim:2 * dim], args[-1]
+        wet = np.ravel(self._decode_geo(geo_map)['wet'])
+        out = change.data.reshape(-1)
+        out[:] = 0.0
+        for vi, si in zip(v, snap):
+            d = vi.data.reshape(-1)[wet] - si.data.reshape(-1)[wet]
+            out[wet] += d * d
+
+    def StoreVelocitySnapshot(self, *args):
+        dim = len(args) // 2
+        for vi, si in zip(args[:dim], args[dim:]):
+            si.data[...] = vi.data.reshape(si.data.shape)
+
+
+backend=NumpyBackend
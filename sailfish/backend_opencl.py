@@ -148,10 +148,16 @@ class OpenCLBackend(object):
         cl.enqueue_write_buffer(queue, cl_buf, self.buffers[cl_buf],
                 is_blocking=False)
 
-    def from_buf_async(self, cl_buf, stream=None):
+    def from_buf_async(self, cl_buf, stream=None, target=None):
+        """Asynchronously copies data from a device buffer to the host.
+
+        :param target: contiguous array to copy the data to; if not specified,
+            the host buffer associated with cl_buf is used
+        """
         queue = stream.queue if stream is not None else self.default_queue
-        cl.enqueue_read_buffer(queue, cl_buf, self.buffers[cl_buf],
-                is_blocking=False)
+        if target is None:
+            target = self.buffers[cl_buf]
+        cl.enqueue_read_buffer(queue, cl_buf, target, is_blocking=False)
 
     def build(self, source):
         preamble = ''
@@ -242,6 +248,13 @@ class EventWrapper(object):
     def __init__(self, event):
         self.event = event
 
+    def query(self):
+        return (self.event.command_execution_status ==
+                cl.command_execution_status.COMPLETE)
+
+    def synchronize(self):
+        self.event.wait()
+
     def time_since(self, other):
         return 0
         #return self.event.profile.end - other.event.profile.start
@@ -5,11 +5,15 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import contextlib
+import fcntl
+import hashlib
 import os
 import re
 import sys
 import tempfile
 import mako.exceptions
+import numpy as np
 from mako.lookup import TemplateLookup
 from mako.template import Template
 
@@ -49,6 +53,206 @@ def _use_intrinsics(t):
     t = t.replace('sqrtf(', '__fsqrt_rz(')
     return t
 
+#: Config options which do not influence the generated code and are therefore
+#: ignored when computing code cache keys.
+_code_cache_ignored_options = set([
+    '_code_share_dir', '_zmq_port', 'benchmark_minibatch',
+    'benchmark_sample_from', 'checkpoint_delta_every',
+    'checkpoint_delta_tolerance', 'checkpoint_every', 'checkpoint_file',
+    'checkpoint_format', 'checkpoint_from', 'cluster_interface',
+    'cluster_lsf', 'cluster_pbs', 'cluster_pbs_initscript', 'cluster_spec',
+    'cluster_sync', 'cmdline', 'code_cache_dir',
+    'compress_intersubdomain_data', 'debug_single_process',
+    'delta_intersubdomain_data', 'every', 'final_checkpoint', 'format_src',
+    'geometry_cache_dir', 'geometry_threads', 'gpus', 'indent',
+    'intersubdomain_keyframe_every', 'local_connector', 'log', 'logger',
+    'loglevel', 'max_iters', 'mode', 'node_ordering', 'output',
+    'output_average_every', 'output_chunk_size', 'output_compress',
+    'output_format', 'output_max_interval', 'output_snapshots_per_file',
+    'perf_stats_every', 'quiet', 'restore_from', 'restore_time', 'save_src',
+    'sed', 'seed', 'share_code', 'silent', 'single_checkpoint',
+    'sparse_host_storage', 'use_code_cache', 'use_mako_cache', 'use_src',
+    'verbose', 'vis_engine'])
+
+# Digest of the sailfish package sources, computed once per process.
+_package_digest = None
+
+def _source_files_digest(paths):
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(path.encode('utf-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _package_sources_digest():
+    """Returns a digest of all Python modules and templates of the sailfish
+    package.  Templates call back into these modules at render time, so any
+    change to them can affect the generated code."""
+    global _package_digest
+    if _package_digest is None:
+        base = os.path.realpath(os.path.dirname(__file__))
+        paths = []
+        for d in (base, os.path.join(base, 'templates')):
+            paths.extend(os.path.join(d, fn) for fn in os.listdir(d)
+                         if fn.endswith('.py') or fn.endswith('.mako'))
+        _package_digest = _source_files_digest(paths)
+    return _package_digest
+
+def _cache_repr(value):
+    """Returns a string representation of a code generation context value
+    that is stable across processes and suitable for computing a cache key."""
+    from sailfish.config import LBConfig
+    from sailfish.lb_base import LBSim
+    from sailfish.subdomain import SubdomainSpec
+    import sympy
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    elif isinstance(value, (list, tuple)):
+        return '[{0}]'.format(','.join(_cache_repr(x) for x in value))
+    elif isinstance(value, (set, frozenset)):
+        return '{{{0}}}'.format(','.join(sorted(_cache_repr(x) for x in value)))
+    elif isinstance(value, dict):
+        return '{{{0}}}'.format(','.join(sorted(
+            '{0}:{1}'.format(_cache_repr(k), _cache_repr(v)) for k, v in
+            value.items())))
+    elif isinstance(value, np.ndarray):
+        return 'ndarray({0},{1},{2})'.format(value.dtype, value.shape,
+            hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    elif isinstance(value, np.generic):
+        return '{0}({1!r})'.format(type(value).__name__, value)
+    elif isinstance(value, sympy.Basic):
+        return sympy.srepr(value)
+    elif isinstance(value, type) or callable(value):
+        return '{0}.{1}'.format(getattr(value, '__module__', ''),
+                                getattr(value, '__name__', type(value).__name__))
+    elif isinstance(value, LBConfig):
+        return _cache_repr(dict((k, v) for k, v in vars(value).items() if k not
+                                in _code_cache_ignored_options))
+    elif isinstance(value, SubdomainSpec):
+        # The location of the subdomain is not included, as it only affects
+        # the code through global offsets, which are part of the context.
+        # This makes it possible to share code between identical subdomains.
+        return _cache_repr([value.size, value.envelope_size,
+                            value.actual_size, value._periodicity,
+                            [f for f, c in value._connections.items() if c]])
+    elif isinstance(value, LBSim):
+        return _cache_repr(type(value))
+    # Default representations of objects contain memory addresses, which
+    # are different in every process.
+    return re.sub(' at 0x[0-9a-fA-F]+', '', repr(value))
+
+def code_cache_dir(config):
+    """Returns the path to the directory holding cached compute unit code,
+    or None if the code cache is not used."""
+    if config.use_code_cache:
+        if config.code_cache_dir:
+            return config.code_cache_dir
+        import pwd
+        return '{0}/sailfish_code-{1}'.format(tempfile.gettempdir(),
+                                              pwd.getpwuid(os.getuid())[0])
+    # Temporary directory used to share code between subdomain runners
+    # started by the same machine master.
+    return getattr(config, '_code_share_dir', None)
+
+
+class CodeCache(object):
+    """Persistent, content-addressed cache of generated compute unit code.
+
+    Entries are keyed by a digest of the templates, the code generation
+    context and the code generation options, so that stale entries are never
+    used and the cache does not need to be explicitly invalidated.
+    """
+
+    #: Number of cache hits and misses in the current process.
+    hits = 0
+    misses = 0
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, ctx, template_dirs, sources, target_type):
+        """Computes the cache key for a subdomain.
+
+        :param ctx: code generation context
+        :param template_dirs: list of directories searched for templates
+        :param sources: list of template names or inline template code
+        :param target_type: name of the backend the code is generated for
+        """
+        h = hashlib.sha1()
+        h.update(_package_sources_digest().encode('utf-8'))
+
+        template_files = []
+        for d in template_dirs:
+            if os.path.isdir(d):
+                template_files.extend(
+                    os.path.join(d, fn) for fn in os.listdir(d)
+                    if fn.endswith('.mako'))
+        h.update(_source_files_digest(set(
+            os.path.realpath(x) for x in template_files)).encode('utf-8'))
+
+        # Inline aux code is not stored in a file.
+        h.update(_cache_repr(sources).encode('utf-8'))
+
+        # Global offsets of the subdomain are only used in the code when
+        # a space-dependent expression needs to be evaluated.  Ignore them
+        # otherwise so that identical subdomains share their code.
+        if not ctx.get('space_dependence', True):
+            ctx = dict((k, v) for k, v in ctx.items() if not
+                       k.endswith('_local_device_to_global_offset'))
+        h.update(_cache_repr(ctx).encode('utf-8'))
+        # The subdomain ID is reported by the code checking for invalid
+        # values, so such code cannot be shared between subdomains.
+        if ctx.get('gpu_check_invalid_values') and 'block' in ctx:
+            h.update('subdomain={0}'.format(ctx['block'].id).encode('utf-8'))
+        h.update(target_type.encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry_path(self, key, suffix):
+        return os.path.join(self.path, '{0}.{1}'.format(key, suffix))
+
+    def get(self, key, formatted=False):
+        """Returns the cached code or None if it is not available."""
+        path = self._entry_path(key, 'fmt' if formatted else 'src')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return f.read()
+
+    def _ensure_dir(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # The directory might have been created by another process.
+                if not os.path.isdir(self.path):
+                    raise
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Holds an exclusive lock on a cache entry.
+
+        Used to ensure that the code for any given key is only generated
+        and compiled by one process at a time."""
+        self._ensure_dir()
+        with open(self._entry_path(key, 'lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put(self, key, code, formatted=False):
+        self._ensure_dir()
+
+        # Write to a temporary file first and atomically rename it, so that
+        # other processes never see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(code)
+        os.rename(tmp_path, self._entry_path(key, 'fmt' if formatted else 'src'))
+
 class BlockCodeGenerator(object):
     """Generates CUDA/OpenCL code for a simulation of a subdomain."""
 
@@ -79,6 +283,17 @@ class BlockCodeGenerator(object):
                 help='cache the generated Mako templates in '
                      '/tmp/sailfish_modules-$USER', action='store_true',
                 default=False)
+        group.add_argument('--use_code_cache',
+                help='cache the generated compute unit code on disk and '
+                     'reuse it when the simulation is run again with the same '
+                     'settings', action='store_true', default=False)
+        group.add_argument('--code_cache_dir', type=str, default='',
+                help='directory to store the cached compute unit code in; '
+                     'defaults to /tmp/sailfish_code-$USER')
+        group.add_argument('--noshare_code', dest='share_code',
+                help='do not share the generated and compiled code between '
+                     'identical subdomains simulated on the same machine',
+                action='store_false', default=True)
         group.add_argument('--block_size', type=int, default=64,
                 help='size of the block of threads on the compute device')
         group.add_argument('--mem_alignment', type=int, default=32,
@@ -102,15 +317,60 @@ class BlockCodeGenerator(object):
         return self._sim.config
 
     def get_code(self, subdomain_runner, target_type):
+        # The numpy backend does not use generated source code, and builds
+        # its kernels directly from the code generation context.
+        if target_type == 'numpy':
+            return self._build_context(subdomain_runner)
+
         if self.config.use_src:
-            source_fn = sailfish.io.source_filename(self.config.use_src,
-                    subdomain_runner._spec.id)
-            self.config.logger.debug(
-                    "Using code from '{0}'.".format(source_fn))
-            with open(source_fn, 'r') as f:
-                src = f.read()
-            return src
+            return self._read_code(subdomain_runner)
+
+        prep = self._prepare(subdomain_runner, target_type)
+        cache, cache_key = prep[-2:]
+        if cache is None:
+            return self._render(subdomain_runner, target_type, *prep)
+
+        with cache.lock(cache_key):
+            return self._get_cached_code(subdomain_runner, target_type, prep)
+
+    def build_module(self, subdomain_runner, backend):
+        """Generates the compute unit code and builds it using the backend.
+
+        When the code cache is enabled, subdomains with identical code are
+        processed one at a time.  Only the first one renders the templates
+        and compiles the code, and all others use the cached results.
+
+        :param subdomain_runner: SubdomainRunner for which to build the code
+        :param backend: backend object to build the code with
+        """
+        if backend.name == 'numpy' or self.config.use_src:
+            return backend.build(self.get_code(subdomain_runner, backend.name))
+
+        prep = self._prepare(subdomain_runner, backend.name)
+        cache, cache_key = prep[-2:]
+        if cache is None:
+            return backend.build(self._render(subdomain_runner, backend.name,
+                                              *prep))
 
+        with cache.lock(cache_key):
+            return backend.build(self._get_cached_code(
+                subdomain_runner, backend.name, prep))
+
+    def _read_code(self, subdomain_runner):
+        source_fn = sailfish.io.source_filename(self.config.use_src,
+                subdomain_runner._spec.id)
+        self.config.logger.debug(
+                "Using code from '{0}'.".format(source_fn))
+        with open(source_fn, 'r') as f:
+            src = f.read()
+        return src
+
+    def _prepare(self, subdomain_runner, target_type):
+        """Builds the code generation context and looks up the cache.
+
+        :returns: tuple of: context, template directories, aux sources, cache,
+            cache key; the last two items are None if caching is disabled
+        """
         # Clear all locale settings, we do not want them affecting the
         # generated code in any way.
         import locale
@@ -123,6 +383,47 @@ class BlockCodeGenerator(object):
                     os.path.realpath(os.path.dirname(__file__)),
                     'templates')]
 
+        aux_sources = list(self._sim.aux_code)
+        # Allow mixin classes to provide their own aux_code values.
+        for c in self._sim.__class__.mro()[1:]:
+            if issubclass(c, LBMixIn) and hasattr(c, 'aux_code'):
+                for fn in c.aux_code:
+                    # Do not allow duplicate files.
+                    if fn not in aux_sources:
+                        aux_sources.append(fn)
+        if self.config.output_reduce:
+            aux_sources.append('output_reduction.mako')
+        if self.config.output_change_threshold > 0.0:
+            aux_sources.append('output_policy.mako')
+
+        ctx = self._build_context(subdomain_runner)
+
+        cache_dir = code_cache_dir(self.config)
+        if cache_dir is None:
+            return ctx, template_dirs, aux_sources, None, None
+
+        cache = CodeCache(cache_dir)
+        cache_key = cache.key(ctx, template_dirs,
+                              [self._sim.kernel_file] + aux_sources,
+                              target_type)
+        return ctx, template_dirs, aux_sources, cache, cache_key
+
+    def _get_cached_code(self, subdomain_runner, target_type, prep):
+        cache, cache_key = prep[-2:]
+        src = cache.get(cache_key)
+        if src is not None:
+            CodeCache.hits += 1
+            self._log_cache_stats('hit', cache_key)
+            if self.config.save_src:
+                self._save_code_cached(src, subdomain_runner, cache, cache_key)
+            return src
+
+        CodeCache.misses += 1
+        self._log_cache_stats('miss', cache_key)
+        return self._render(subdomain_runner, target_type, *prep)
+
+    def _render(self, subdomain_runner, target_type, ctx, template_dirs,
+                aux_sources, cache, cache_key):
         if self.config.use_mako_cache:
             import pwd
             lookup = TemplateLookup(directories=template_dirs,
@@ -132,22 +433,12 @@ class BlockCodeGenerator(object):
             lookup = TemplateLookup(directories=template_dirs)
 
         code_tmpl = lookup.get_template(self._sim.kernel_file)
-        ctx = self._build_context(subdomain_runner)
         try:
             src = code_tmpl.render(**ctx)
         except:
             print(mako.exceptions.text_error_template().render())
             return ''
 
-        aux_sources = list(self._sim.aux_code)
-        # Allow mixin classes to provide their own aux_code values.
-        for c in self._sim.__class__.mro()[1:]:
-            if issubclass(c, LBMixIn) and hasattr(c, 'aux_code'):
-                for fn in c.aux_code:
-                    # Do not allow duplicate files.
-                    if fn not in aux_sources:
-                        aux_sources.append(fn)
-
         for aux in aux_sources:
             if aux.count('\n') > 0:
                 code_tmpl = Template(aux)
@@ -170,14 +461,37 @@ class BlockCodeGenerator(object):
             src = _remove_math_function_suffix(src)
             src = _remove_printf_calls(src)
 
+        if cache is not None:
+            cache.put(cache_key, src)
+
         if self.config.save_src:
-            self.save_code(src,
-                    sailfish.io.source_filename(self.config.save_src,
-                        subdomain_runner._spec.id),
-                    self.config.format_src)
+            self._save_code_cached(src, subdomain_runner, cache, cache_key)
 
         return src
 
+    def _log_cache_stats(self, event, key):
+        self.config.logger.info(
+            'Code cache {0} for {1} (hits: {2}, misses: {3}).'.format(
+                event, key[:12], CodeCache.hits, CodeCache.misses))
+
+    def _save_code_cached(self, src, subdomain_runner, cache, cache_key):
+        """Saves the source code to the file specified by the save_src
+        option, reusing the formatted code from the cache if possible."""
+        dest_path = sailfish.io.source_filename(self.config.save_src,
+                                                subdomain_runner._spec.id)
+        if not self.config.format_src or cache is None:
+            self.save_code(src, dest_path, self.config.format_src)
+            return
+
+        formatted = cache.get(cache_key, formatted=True)
+        if formatted is not None:
+            with open(dest_path, 'w') as fsrc:
+                fsrc.write(formatted)
+        else:
+            self.save_code(src, dest_path, True)
+            with open(dest_path, 'r') as fsrc:
+                cache.put(cache_key, fsrc.read(), formatted=True)
+
     def save_code(self, code, dest_path, reformat=True):
         with open(dest_path, 'w') as fsrc:
             print(code, file=fsrc)
@@ -8,8 +8,12 @@ try:
     import blosc
 except ImportError:
     pass
+import errno
+import mmap
 import os
+import select
 import tempfile
+import time
 import sys
 if sys.version_info > (3,):
     buffer = memoryview
@@ -32,11 +36,17 @@ class MPSubdomainConnector(object):
         self._conf_ev = conf_ev
         self._remote_conf_ev = remote_conf_ev
 
-    def send(self, data):
-        self._remote_conf_ev.wait()
+    def send(self, data, quit_ev=None):
+        # If the quit event is set, do not wait for the remote subdomain.
+        while not self._remote_conf_ev.wait(0.01):
+            if self._remote_conf_ev.is_set():
+                break
+            if quit_ev is not None and quit_ev.is_set():
+                return False
         self._send_array[:] = data
         self._remote_conf_ev.clear()
         self._send_ev.set()
+        return True
 
     def recv(self, data, quit_ev):
         # If the quit event is set, do not wait for the data transfer.
@@ -55,6 +65,11 @@ class MPSubdomainConnector(object):
         """Called from the block runner of the sender block."""
         pass
 
+    def poll_handle(self):
+        """Returns an object that can be registered with a zmq.Poller to wait
+        for incoming data, or None if this is not supported."""
+        return None
+
     @classmethod
     def make_pair(self, ctype, sizes, ids):
         array1 = Array(ctype, sizes[0])
@@ -70,6 +85,153 @@ class MPSubdomainConnector(object):
                 MPSubdomainConnector(array2, array1, ev2, ev1, ev4, ev3))
 
 
+class SharedMemorySubdomainConnector(object):
+    """Handles directed data exchange between two subdomains on the same host
+    using shared memory.
+
+    Data for every direction of the connection is stored in a ring of slots in
+    a memory-mapped file (in /dev/shm, if available).  The sender copies the
+    data into a free slot and wakes up the receiver by writing a single byte
+    to a named pipe, which the receiver can wait on with select() or
+    a zmq.Poller.  Once the data is consumed, the receiver releases the slot
+    and wakes up the sender in the same way through a second pipe, in case
+    the sender is waiting for a free slot.  Layout of the shared memory area for one direction::
+
+        read_seq (uint64) | slot sizes (nslots x uint64) | slots
+    """
+
+    #: Number of message slots in every direction.
+    nslots = 2
+
+    def __init__(self, send_path, recv_path, dtype, sizes):
+        """
+        :param send_path: path prefix of the files for sending data
+        :param recv_path: path prefix of the files for receiving data
+        :param dtype: numpy dtype of the exchanged data
+        :param sizes: capacities (in elements) of the send and recv slots
+        """
+        self._send_path = send_path
+        self._recv_path = recv_path
+        self._dtype = np.dtype(dtype)
+        self._send_size, self._recv_size = sizes
+        self._send_seq = 0
+        self._recv_seq = 0
+        self.port = None
+        self.ipc_files = [send_path, send_path + '.fifo',
+                          send_path + '.free']
+
+    @classmethod
+    def _area_size(cls, size, dtype):
+        return 8 * (1 + cls.nslots) + cls.nslots * size * np.dtype(dtype).itemsize
+
+    @classmethod
+    def _create(cls, path, size, dtype):
+        with open(path, 'wb') as f:
+            f.truncate(cls._area_size(size, dtype))
+        os.mkfifo(path + '.fifo')
+        os.mkfifo(path + '.free')
+
+    def _map(self, path, size):
+        with open(path, 'r+b') as f:
+            area = mmap.mmap(f.fileno(), self._area_size(size, self._dtype))
+        header = np.frombuffer(area, dtype=np.uint64, count=1 + self.nslots)
+        slots = np.frombuffer(area, dtype=self._dtype, offset=header.nbytes,
+                              count=self.nslots * size).reshape(self.nslots, size)
+        return area, header, slots
+
+    def init_runner(self, ctx):
+        """Called from the block runner of the sender block."""
+        # All pipes are opened in read-write mode so that the call does not
+        # block waiting for the remote runner, which might itself be busy
+        # initializing a connector to a different subdomain.
+        self._recv_fd = os.open(self._recv_path + '.fifo',
+                                os.O_RDWR | os.O_NONBLOCK)
+        self._send_fd = os.open(self._send_path + '.fifo', os.O_RDWR)
+        self._free_fd = os.open(self._send_path + '.free',
+                                os.O_RDWR | os.O_NONBLOCK)
+        self._release_fd = os.open(self._recv_path + '.free',
+                                   os.O_RDWR | os.O_NONBLOCK)
+        self._send_area, self._send_header, self._send_slots = self._map(
+            self._send_path, self._send_size)
+        self._recv_area, self._recv_header, self._recv_slots = self._map(
+            self._recv_path, self._recv_size)
+
+    def poll_handle(self):
+        return self._recv_fd
+
+    def send(self, data, quit_ev=None):
+        data = np.ravel(data)
+        if data.size > self._send_size:
+            raise ValueError('Message of {0} elements does not fit in the '
+                             'shared memory slot of {1} elements.'.format(
+                                 data.size, self._send_size))
+
+        # Wait until the receiver has consumed the data previously stored in
+        # the slot.  With two slots, this only happens if the receiver is
+        # lagging more than one message behind.
+        while self._send_seq - int(self._send_header[0]) >= self.nslots:
+            # If the quit event is set, do not wait for the receiver.
+            if quit_ev is not None and quit_ev.is_set():
+                return False
+            select.select([self._free_fd], [], [], 0.1)
+            # Discard all pending notifications.  The slot state is always
+            # checked in the shared memory area.
+            try:
+                os.read(self._free_fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        slot = self._send_seq % self.nslots
+        self._send_slots[slot, :data.size] = data
+        self._send_header[1 + slot] = data.size
+        self._send_seq += 1
+        os.write(self._send_fd, b'\0')
+        return True
+
+    def recv(self, data, quit_ev):
+        while True:
+            try:
+                os.read(self._recv_fd, 1)
+                break
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            # If the quit event is set, do not wait for the data transfer.
+            if quit_ev.is_set():
+                return False
+            select.select([self._recv_fd], [], [], 0.1)
+
+        slot = self._recv_seq % self.nslots
+        size = int(self._recv_header[1 + slot])
+        data[:] = self._recv_slots[slot, :size].reshape(data.shape)
+        self._recv_seq += 1
+        # Release the slot and wake up the sender.  If the pipe is full,
+        # the sender has not picked up earlier notifications yet and
+        # will check the slot state anyway.
+        self._recv_header[0] = self._recv_seq
+        try:
+            os.write(self._release_fd, b'\0')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def is_ready(self):
+        return True
+
+    @classmethod
+    def make_pair(cls, ctype, sizes, ids):
+        base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = '%s/sailfish-master-%d_%d-%d' % (base, os.getpid(), ids[0], ids[1])
+        path1 = path + '.0'
+        path2 = path + '.1'
+        cls._create(path1, sizes[0], ctype)
+        cls._create(path2, sizes[1], ctype)
+        return (cls(path1, path2, ctype, sizes),
+                cls(path2, path1, ctype, (sizes[1], sizes[0])))
+
+
 class ZMQSubdomainConnector(object):
     """Handles directed data exchange between two subdomains using 0MQ."""
 
@@ -96,8 +258,12 @@ class ZMQSubdomainConnector(object):
         else:
             self.socket.bind(self._addr)
 
-    def send(self, data):
+    def poll_handle(self):
+        return self.socket
+
+    def send(self, data, quit_ev=None):
         self.socket.send(data, copy=False)
+        return True
 
     def recv(self, data, quit_ev):
         if quit_ev.is_set():
@@ -157,15 +323,195 @@ class ZMQRemoteSubdomainConnector(ZMQSubdomainConnector):
 
 
 class CompressedZMQRemoteSubdomainConnector(ZMQRemoteSubdomainConnector):
-    """Like ZMQRemoteSubdomainConnector, but transfers compressed data."""
+    """Like ZMQRemoteSubdomainConnector, but transfers compressed data.
+
+    The compression method is selected adaptively for every link.  In
+    periodic probing rounds, every available method is used in turn and
+    the time to compress, transmit and decompress the data is measured.
+    The method with the lowest cost is then used until the next round,
+    which can be started early if the compression ratio changes
+    significantly.
+    """
+
+    #: Candidate methods: (name, blosc compressor, compression level).
+    methods = (('raw', None, 0), ('lz4', 'lz4', 5), ('zstd', 'zstd', 1))
+
+    #: Number of messages sent with every method in a probing round.
+    probe_messages = 3
 
-    def send(self, data):
-        self.socket.send(blosc.pack_array(data), copy=False)
+    #: Number of messages sent between probing rounds.
+    probe_interval = 1000
+
+    #: Relative change of the compression ratio which triggers probing.
+    ratio_tolerance = 0.25
+
+    def __init__(self, addr, receiver=False):
+        ZMQRemoteSubdomainConnector.__init__(self, addr, receiver)
+        compressors = blosc.compressor_list()
+        self._methods = [m for m in self.methods if m[1] is None or
+                         m[1] in compressors]
+        self._method = None
+        self._ratio = None
+        self._probe_costs = {}
+        self._probe_ratios = {}
+        self._to_probe = []
+        self._since_probe = 0
+        self._stats = {
+            'messages': dict((m[0], 0) for m in self._methods),
+            'bytes_raw': 0,
+            'bytes_sent': 0,
+            'compress_time': 0.0,
+            'decompress_time': 0.0,
+        }
+
+    def _start_probing(self):
+        self._probe_costs = dict((m[0], []) for m in self._methods)
+        self._probe_ratios = dict((m[0], []) for m in self._methods)
+        self._to_probe = self._methods * self.probe_messages
+
+    def _compress(self, data, method):
+        _, cname, clevel = method
+        if cname is None:
+            return data
+        return blosc.compress(data, typesize=data.dtype.itemsize,
+                              clevel=clevel, shuffle=blosc.SHUFFLE,
+                              cname=cname)
+
+    def send(self, data, quit_ev=None):
+        if not self._to_probe and (self._method is None or
+                                   self._since_probe >= self.probe_interval):
+            self._start_probing()
+
+        probing = bool(self._to_probe)
+        method = self._to_probe.pop() if probing else self._method
+        name = method[0]
+
+        t0 = time.time()
+        payload = self._compress(data, method)
+        t_comp = time.time() - t0
+        size = data.nbytes if method[1] is None else len(payload)
+        ratio = float(data.nbytes) / size
+
+        frames = [name.encode('ascii'), payload]
+        if probing:
+            # Wait for the message to be handed over to the network stack
+            # so that the transfer time is included in the measurement.
+            self.socket.send_multipart(frames, copy=False, track=True).wait()
+            cost = time.time() - t0
+            if method[1] is not None:
+                t1 = time.time()
+                blosc.decompress(payload)
+                cost += time.time() - t1
+            self._probe_costs[name].append(cost)
+            self._probe_ratios[name].append(ratio)
+            if not self._to_probe:
+                self._select_method()
+        else:
+            self.socket.send_multipart(frames, copy=False)
+            self._since_probe += 1
+            # Probe again if the data compresses much better or worse than
+            # when the current method was selected.
+            if (method[1] is not None and abs(ratio - self._ratio) >
+                    self.ratio_tolerance * self._ratio):
+                self._since_probe = self.probe_interval
+
+        self._stats['messages'][name] += 1
+        self._stats['bytes_raw'] += data.nbytes
+        self._stats['bytes_sent'] += size
+        self._stats['compress_time'] += t_comp
+        return True
+
+    def _select_method(self):
+        costs = dict((name, sum(c) / len(c)) for name, c in
+                     self._probe_costs.items())
+        self._method = min(self._methods, key=lambda m: costs[m[0]])
+        ratios = self._probe_ratios[self._method[0]]
+        self._ratio = sum(ratios) / len(ratios)
+        self._since_probe = 0
+        self._stats['probe_costs'] = costs
 
     def recv(self, data, quit_ev):
         if quit_ev.is_set():
             return False
 
-        msg = self.socket.recv(copy=False)
-        data[:] = blosc.unpack_array(bytes(msg))
+        name, msg = self.socket.recv_multipart(copy=False)
+        if name.bytes == b'raw':
+            data[:] = np.frombuffer(buffer(msg), dtype=data.dtype).reshape(data.shape)
+        else:
+            t0 = time.time()
+            data[:] = np.frombuffer(blosc.decompress(bytes(msg)),
+                                    dtype=data.dtype).reshape(data.shape)
+            self._stats['decompress_time'] += time.time() - t0
+        return True
+
+    def stats(self):
+        """Returns a dictionary of statistics of the data sent over this
+        link."""
+        ret = dict(self._stats)
+        ret['method'] = self._method[0] if self._method is not None else None
+        if ret['bytes_sent']:
+            ret['ratio'] = float(ret['bytes_raw']) / ret['bytes_sent']
+        return ret
+
+
+class DeltaCompressedZMQRemoteSubdomainConnector(CompressedZMQRemoteSubdomainConnector):
+    """Like CompressedZMQRemoteSubdomainConnector, but transfers the bitwise
+    difference (XOR) between the current and the previously sent data.
+
+    In steady or slowly evolving flows, consecutive messages differ only in
+    the least significant bits, so the difference compresses much better
+    than the data itself.  The data is reconstructed exactly on the
+    receiving side.  A full keyframe is sent every keyframe_every messages.
+    """
+
+    def __init__(self, addr, receiver=False, keyframe_every=100):
+        """
+        :param keyframe_every: number of messages between two consecutive
+            messages containing full data
+        """
+        CompressedZMQRemoteSubdomainConnector.__init__(self, addr, receiver)
+        if keyframe_every < 1:
+            raise ValueError('keyframe_every has to be a positive number.')
+        self.keyframe_every = keyframe_every
+        # Previously sent and received data, indexed by message size.
+        # Messages of different sizes are exchanged in alternate
+        # iterations with the AA access pattern.
+        self._prev_sent = {}
+        self._prev_recv = {}
+        self._num_sent = 0
+        self._num_recv = 0
+
+    @staticmethod
+    def _bits(data):
+        return np.ravel(data).view('u{0}'.format(data.dtype.itemsize))
+
+    def _is_keyframe(self, num, prev, size):
+        return num % self.keyframe_every == 0 or size not in prev
+
+    def send(self, data, quit_ev=None):
+        bits = self._bits(data)
+        if self._is_keyframe(self._num_sent, self._prev_sent, bits.size):
+            self._prev_sent[bits.size] = bits.copy()
+        else:
+            prev = self._prev_sent[bits.size]
+            delta = bits ^ prev
+            prev[:] = bits
+            data = delta.view(data.dtype)
+        self._num_sent += 1
+        return CompressedZMQRemoteSubdomainConnector.send(self, data, quit_ev)
+
+    def recv(self, data, quit_ev):
+        if not CompressedZMQRemoteSubdomainConnector.recv(self, data, quit_ev):
+            return False
+
+        # The receive buffer is contiguous, so this is a view and the
+        # data is reconstructed in place.
+        bits = self._bits(data)
+        if self._is_keyframe(self._num_recv, self._prev_recv, bits.size):
+            self._prev_recv[bits.size] = bits.copy()
+        else:
+            prev = self._prev_recv[bits.size]
+            bits ^= prev
+            prev[:] = bits
+        self._num_recv += 1
         return True
@@ -87,31 +87,140 @@ def _start_cluster_machine_master(channel, args, main_script, lb_class_name,
         channel.send('FIN')
 
 
+def _is_global_sum(data):
+    """Returns True if data is a request for global sums sent by a machine
+    master."""
+    return type(data) is tuple and len(data) == 3 and data[0] == 'global_sum'
+
+
 # TODO: This is currently a very dumb procedure.  Ideally, we would
 # obtain a speed estimate from each node, calculate the amount of work
 # per subdomain, and distribute the work taking all this into account.
-def split_subdomains_between_nodes(nodes, subdomains):
+def _connection_graph(subdomains):
+    """Returns a dict of dicts mapping pairs of subdomain IDs to the number
+    of elements exchanged between the two subdomains in a single step."""
+    graph = defaultdict(lambda: defaultdict(int))
+    ids = set(s.id for s in subdomains)
+    for subdomain in subdomains:
+        for face, nbid in subdomain.connecting_subdomains():
+            if nbid not in ids or nbid == subdomain.id:
+                continue
+            for cpair in subdomain.get_connections(face, nbid):
+                graph[subdomain.id][nbid] += cpair.src.elements
+                graph[nbid][subdomain.id] += cpair.src.elements
+    return graph
+
+
+def _imbalance(loads, gpus):
+    """Returns the relative excess of the highest load per GPU over the
+    average load per GPU."""
+    total = float(sum(loads))
+    if total == 0:
+        return 0.0
+    return max(l / g for l, g in zip(loads, gpus)) / (total / sum(gpus)) - 1.0
+
+
+def placement_stats(nodes, assignments):
+    """Returns a tuple of the number of elements exchanged between different
+    nodes in a single step and the load imbalance between the nodes.
+
+    :param nodes: list of MachineSpecs
+    :param assignments: list of subdomain lists, as returned by
+        split_subdomains_between_nodes
+    """
+    graph = _connection_graph([s for a in assignments for s in a])
+    node_of = dict((s.id, i) for i, a in enumerate(assignments) for s in a)
+    cut = sum(w for a, nbs in graph.items() for b, w in nbs.items()
+              if node_of[a] < node_of[b])
+    loads = [sum(s.num_active_nodes for s in a) for a in assignments]
+    gpus = [len(node.gpus) for node in nodes[:len(assignments)]]
+    return cut, _imbalance(loads, gpus)
+
+
+def split_subdomains_between_nodes(nodes, subdomains, tolerance=0.05,
+                                   max_passes=10):
     """Assigns subdomains to cluster nodes.
 
+    The number of subdomains assigned to every node is proportional to the
+    number of its GPUs.  Nodes are filled with connected subdomains (greedy
+    graph growing), and the partition is then refined by swapping pairs
+    of subdomains between nodes (Kernighan-Lin) so that less data is
+    exchanged between the nodes and the number of active nodes per GPU
+    is balanced.
+
+    :param tolerance: acceptable load imbalance, as a fraction of the
+        average load per GPU
+    :param max_passes: maximum number of refinement passes
+
     Returns a list of 'nodes' lists of subdomains."""
 
     total_gpus = sum([len(node.gpus) for node in nodes])
     n = len(subdomains)
     idx = 0
 
-    assignments = []
+    counts = []
     for i, node in enumerate(nodes):
         units = int(math.ceil(float(n) * len(node.gpus) / total_gpus))
-        assignments.append(subdomains[idx:idx+units])
+        counts.append(min(units, n - idx))
         idx += units
 
         if idx >= n:
             break
 
     # Add any remaining subdomains to the last node.
-    assignments[-1].extend(subdomains[idx:])
+    counts[-1] += max(n - idx, 0)
+
+    graph = _connection_graph(subdomains)
+    order = dict((s.id, i) for i, s in enumerate(subdomains))
+    unassigned = list(subdomains)
+    parts = []
+    for count in counts:
+        part = set()
+        for _ in range(count):
+            # Add the subdomain with the most data exchanged with the
+            # subdomains already on the node.  Without connections, the
+            # original order of the subdomains is preserved.
+            best = max(unassigned, key=lambda s: (
+                sum(graph[s.id][x] for x in part), -order[s.id]))
+            unassigned.remove(best)
+            part.add(best.id)
+        parts.append(part)
+
+    weight = dict((s.id, s.num_active_nodes) for s in subdomains)
+    gpus = [len(node.gpus) for node in nodes[:len(parts)]]
+    loads = [sum(weight[x] for x in part) for part in parts]
+    link = lambda a, part: sum(graph[a][x] for x in part)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(parts)):
+            for j in range(i + 1, len(parts)):
+                for a in sorted(parts[i], key=order.get):
+                    for b in sorted(parts[j], key=order.get):
+                        if a not in parts[i] or b not in parts[j]:
+                            continue
+                        gain = (link(a, parts[j]) - link(a, parts[i]) +
+                                link(b, parts[i]) - link(b, parts[j]) -
+                                2 * graph[a][b])
+                        new_loads = list(loads)
+                        new_loads[i] += weight[b] - weight[a]
+                        new_loads[j] += weight[a] - weight[b]
+                        imb = _imbalance(loads, gpus)
+                        new_imb = _imbalance(new_loads, gpus)
+                        if ((gain > 0 and new_imb <= max(imb, tolerance)) or
+                            (gain >= 0 and new_imb < imb - 1e-9 and
+                             imb > tolerance)):
+                            parts[i].remove(a)
+                            parts[j].remove(b)
+                            parts[i].add(b)
+                            parts[j].add(a)
+                            loads = new_loads
+                            improved = True
+        if not improved:
+            break
 
-    return assignments
+    by_id = dict((s.id, s) for s in subdomains)
+    return [[by_id[x] for x in sorted(part, key=order.get)] for part in parts]
 
 
 class GeometryError(Exception):
@@ -285,6 +394,10 @@ class LBSimulationController(object):
         self._lb_geo = lb_geo
         self._tmpdir = tempfile.mkdtemp()
 
+        #: Statistics of the links between subdomains collected in the
+        #: benchmark mode: subdomain ID -> remote subdomain ID -> dict.
+        self.link_stats = {}
+
         group = self._config_parser.add_group('Runtime mode settings')
         group.add_argument('--mode', help='runtime mode', type=str,
             choices=['batch', 'visualization', 'benchmark'], default='batch'),
@@ -314,10 +427,48 @@ class LBSimulationController(object):
                            action='store_false', default=True,
                            help='stores the output in compressed files'
                            'if the selected format supports it')
+        group.add_argument('--output_chunk_size', type=int, default=64,
+                           metavar='N',
+                           help='with the chunked output format, size of the '
+                           'chunks along every axis')
+        group.add_argument('--output_snapshots_per_file', type=int,
+                           default=0, metavar='N',
+                           help='with the npy_stream output format, number of '
+                           'snapshots stored in every file; if <= 0, all '
+                           'snapshots of the simulation are stored in a '
+                           'single file')
+        group.add_argument('--output_reduce', type=str, default='',
+                           metavar='SPEC',
+                           help='comma-separated list of field:ops entries '
+                           'specifying how output fields are reduced on the '
+                           'compute device before they are saved; ops is '
+                           'a "+"-separated list of: avg2, avg4, avg8 '
+                           '(downsampling by block averaging), mean (time '
+                           'average since the previous output), f16 (half '
+                           'precision); use "*" as the field name to apply '
+                           'the reduction to all fields, e.g. '
+                           '"*:f16,v:avg4+mean"')
+        group.add_argument('--output_average_every', type=int, default=1,
+                           metavar='N',
+                           help='with time-averaged output fields, sample the '
+                           'fields every N iterations')
+        group.add_argument('--output_change_threshold', type=float,
+                           default=0.0, metavar='DV',
+                           help='if > 0, only save the output in the '
+                           'iterations selected by --every and --from if the '
+                           'RMS change of the velocity field since the last '
+                           'saved snapshot is at least DV (in lattice units)')
+        group.add_argument('--output_max_interval', type=int, default=0,
+                           metavar='N',
+                           help='with --output_change_threshold, save the '
+                           'output regardless of the change of the flow if '
+                           'at least N iterations elapsed since the last '
+                           'saved snapshot; 0 disables this')
         group.add_argument('--backends',
             type=str, default='cuda,opencl',
             help='computational backends to use; multiple backends '
-                 'can be separated by a comma')
+                 'can be separated by a comma; use "numpy" to run the '
+                 'simulation on the CPU')
         group.add_argument('--vis_engine',
             type=str, default='pygame',
             help='visualization engine to use')
@@ -387,11 +538,26 @@ class LBSimulationController(object):
                 default=True, help='If True, will terminate the simulation '
                 'when invalid values (inf, nan) are detected in the domain '
                 'during the simulation.')
+        group.add_argument('--local_connector', type=str,
+                choices=['ipc', 'shm'], default='ipc', help='Mechanism used '
+                'to exchange data between subdomains on the same host. ipc: '
+                '0MQ IPC sockets, shm: shared memory ring buffers.')
         group.add_argument('--compress_intersubdomain_data',
                 action='store_true', default=False, help='Uses blosc to '
                 'compress data exchanged between subdomains. Can improve '
                 'performance in distributed simulations limited by bandwidth '
-                'available between computational nodes.')
+                'available between computational nodes. The compression '
+                'method (none, blosc-lz4, blosc-zstd) is selected '
+                'separately for every link based on measured transfer times.')
+        group.add_argument('--delta_intersubdomain_data',
+                action='store_true', default=False, help='Like '
+                '--compress_intersubdomain_data, but only the bitwise '
+                'difference from the previously sent data is compressed and '
+                'transferred. Effective in steady or slowly evolving flows.')
+        group.add_argument('--intersubdomain_keyframe_every', type=int,
+                default=100, metavar='N', help='With '
+                '--delta_intersubdomain_data, send the full data every N '
+                'messages.')
         group.add_argument('--seed', type=int, default=int(time.time()),
                 help='PRNG seed value')
 
@@ -419,6 +585,23 @@ class LBSimulationController(object):
         group.add_argument('--checkpoint_from', type=int, default=0,
                 metavar='N', help='Starts generating checkpoints after N '
                 'steps of the simulation have been completed.')
+        group.add_argument('--checkpoint_format', type=str, default='npz',
+                choices=['npz', 'raw'], help='Format of the checkpoint files. '
+                'raw checkpoints store the distributions as aligned binary '
+                'data described by a JSON manifest for every subdomain. They '
+                'are memory-mapped when restored, and can be restored with a '
+                'different subdomain decomposition.')
+        group.add_argument('--checkpoint_delta_every', type=int, default=0,
+                metavar='N', help='If N > 0, only every N-th checkpoint '
+                'contains the complete distributions. The other ones only '
+                'store the blocks of the distributions that changed since the '
+                'last full checkpoint. With --single_checkpoint, the full '
+                'checkpoint and the latest delta checkpoint are saved as '
+                'iterations 0 and 1, respectively.')
+        group.add_argument('--checkpoint_delta_tolerance', type=float,
+                default=0.0, help='Blocks of the distributions in which no '
+                'value changed by more than this tolerance are not saved in '
+                'delta checkpoints.')
 
         group = self._config_parser.add_group('Benchmarking')
         group.add_argument('--benchmark_sample_from', type=int, default=1000,
@@ -484,6 +667,21 @@ class LBSimulationController(object):
         for subdomain in subdomain_specs:
             subdomain.set_actual_size(envelope_size)
 
+    def _log_placement(self, nodes, assignments):
+        # The controller does not have a logger, and the config is sent to
+        # the cluster nodes, so the information is printed directly.
+        if self.config.quiet:
+            return
+        cut, imbalance = placement_stats(nodes, assignments)
+        itemsize = 8 if self.config.precision == 'double' else 4
+        if self.config.verbose:
+            for node, subdomains in zip(nodes, assignments):
+                print('Node {0}: subdomains {1}'.format(
+                    node.host, [s.id for s in subdomains]))
+        print('Subdomain placement: {0:.2f} MiB exchanged between nodes per '
+              'step, load imbalance {1:.1f}%.'.format(
+                  cut * itemsize / 1048576.0, imbalance * 100))
+
     def _start_cluster_simulation(self, subdomains, cluster=None):
         """Starts a simulation on a cluster of nodes."""
 
@@ -496,6 +694,7 @@ class LBSimulationController(object):
 
         self._cluster_gateways = []
         self._node_subdomains = split_subdomains_between_nodes(cluster.nodes, subdomains)
+        self._log_placement(cluster.nodes, self._node_subdomains)
 
         import execnet
         for _, node in zip(self._node_subdomains, cluster.nodes):
@@ -516,6 +715,8 @@ class LBSimulationController(object):
                 subdomain_id_to_addr[subdomain.id] = cluster.nodes[node_id].addr
 
         self._cluster_channels = []
+        # Messages from the masters received while computing global sums.
+        self._master_messages = {}
         import sys
         for i, (node, gw) in enumerate(zip(cluster.nodes, self._cluster_gateways)):
             # Assign specific GPUs from this node, as defined by the cluster
@@ -656,6 +857,44 @@ class LBSimulationController(object):
         else:
             self._start_local_simulation(subdomains)
 
+    def _receive_from_master(self, channel, timeout=None):
+        """Receives a message from a machine master in a cluster simulation,
+        computing global sums for the subdomain runners in the meantime."""
+        while True:
+            if channel in self._master_messages:
+                return self._master_messages.pop(channel)
+            data = channel.receive(timeout)
+            if not _is_global_sum(data):
+                return data
+            self._send_global_sums(channel, data)
+
+    def _send_global_sums(self, channel, request):
+        """Combines the partial sums computed by all machine masters (see
+        LBMachineMaster._send_global_sums()) and sends the result back."""
+        requests = []
+        for ch in self._cluster_channels:
+            if ch is channel:
+                data = request
+            elif ch in self._master_messages:
+                continue
+            else:
+                data = ch.receive()
+            if _is_global_sum(data):
+                requests.append(data)
+            else:
+                # The master failed or finished.  Its subdomains will never
+                # request the sums.
+                self._master_messages[ch] = data
+
+        sums = None
+        if (len(requests) == len(self._cluster_channels) and
+                all(x[2] is not None for x in requests)):
+            sums = util.global_sums(util.GlobalSumRequest(x[1], x[2])
+                                    for x in requests)
+        for ch in self._cluster_channels:
+            if ch not in self._master_messages:
+                ch.send(sums)
+
     def _wait_for_masters(self):
         done = set()
         import execnet
@@ -665,7 +904,7 @@ class LBSimulationController(object):
                     continue
 
                 try:
-                    data = ch.receive(timeout=1)
+                    data = self._receive_from_master(ch, timeout=1)
                 except execnet.TimeoutError:
                     continue
                 except Exception as err:
@@ -694,11 +933,13 @@ class LBSimulationController(object):
             if self.config.mode == 'benchmark':
                 for ch, node_subdomains in zip(self._cluster_channels, self._node_subdomains):
                     for sub in node_subdomains:
-                        ti, min_ti, max_ti, nodes = ch.receive()
+                        ti, min_ti, max_ti, nodes, link_stats = \
+                                self._receive_from_master(ch)
                         timing_infos.append(util.TimingInfo(*ti))
                         min_timings.append(util.TimingInfo(*min_ti))
                         max_timings.append(util.TimingInfo(*max_ti))
                         num_nodes.append(nodes)
+                        self.link_stats[ti[-1]] = link_stats
 
             self._wait_for_masters()
 
@@ -712,12 +953,13 @@ class LBSimulationController(object):
             if self.config.mode == 'benchmark':
                 # Collect timing information from all subdomains.
                 for i in range(len(subdomains)):
-                    ti, min_ti, max_ti, nodes = summary_receiver.recv_pyobj()
+                    ti, min_ti, max_ti, nodes, link_stats = summary_receiver.recv_pyobj()
                     summary_receiver.send('ack')
                     timing_infos.append(ti)
                     min_timings.append(min_ti)
                     max_timings.append(max_ti)
                     num_nodes.append(nodes)
+                    self.link_stats[ti.subdomain_id] = link_stats
 
             if not self.config.debug_single_process:
                 self._simulation_process.join()
@@ -743,6 +985,7 @@ class LBSimulationController(object):
                     print(('Subdomain {0}: MLUPS eff:{1:.2f} +{2:.2f} -{3:.2f}  '
                            'comp:{4:.2f}'.format(ti.subdomain_id, total,
                                                  abs(high), abs(low), comp)))
+                    self._print_link_stats(ti.subdomain_id)
 
             if not self.config.quiet:
                 print(('Total MLUPS: eff:{0:.2f}  comp:{1:.2f}'.format(
@@ -751,6 +994,14 @@ class LBSimulationController(object):
 
         return None, None
 
+    def _print_link_stats(self, subdomain_id):
+        for nbid, st in sorted(self.link_stats.get(subdomain_id, {}).items()):
+            print(('  link {0} -> {1}: {2}  ratio:{3:.2f}  sent:{4:.2f} MiB  '
+                   'compress:{5:.3f} s  decompress:{6:.3f} s'.format(
+                       subdomain_id, nbid, st['method'], st.get('ratio', 1.0),
+                       st['bytes_sent'] / 1048576.0, st['compress_time'],
+                       st['decompress_time'])))
+
     def save_subdomain_config(self, subdomains):
         if self.config.output:
             dname = os.path.dirname(self.config.output)
@@ -7,6 +7,7 @@ __license__ = 'LGPL3'
 
 import gzip
 import numpy as np
+from scipy.ndimage import morphology
 from sailfish.subdomain import SubdomainSpec2D, SubdomainSpec3D
 from sailfish import util
 
@@ -174,3 +175,169 @@ class WeightedSubdomainsGeometry3D(EqualSubdomainsGeometry3D):
             size[conn_axis] = len(profile) - start[conn_axis]
             ret.append(SubdomainSpec3D(start, size))
         return ret
+
+
+def rcb_decomposition(wall_map, num, tolerance=0.05, periodicity=None):
+    """Splits a domain into subdomains with approximately equal numbers of
+    fluid nodes using recursive coordinate bisection (RCB).
+
+    Every box is split along its longest axis, unless splitting along
+    a different axis gives a better balance of fluid nodes and the
+    imbalance along the longest axis exceeds the tolerance.  Boxes are
+    trimmed to the fluid nodes and a single layer of the surrounding solid
+    nodes, which are needed as walls.  Every subdomain contains at least
+    one fluid node, so exactly num subdomains are returned.
+
+    :param wall_map: Boolean array covering the whole domain, in the
+        standard (z), y, x order. True indicates a solid node.
+    :param num: number of subdomains
+    :param tolerance: acceptable deviation of the number of fluid nodes
+        in a subdomain from the average, as a fraction of the average
+    :param periodicity: list of booleans indicating periodicity along
+        the x, y, (z) axes. Boxes are not trimmed along periodic axes.
+
+    :rvalue: list of (location, size, number of fluid nodes) tuples, with
+        location and size in the x, y, (z) order
+    """
+    fluid = np.logical_not(wall_map)
+    dim = fluid.ndim
+    if periodicity is None:
+        periodicity = [False] * dim
+    # Reverse to match the array order.
+    periodicity = list(reversed(periodicity))
+    needed = morphology.binary_dilation(
+        fluid, structure=np.ones([3] * dim, dtype=np.bool))
+    avg = np.sum(fluid) / float(num)
+    if np.sum(fluid) < num:
+        raise ValueError('Not enough fluid nodes for {0} subdomains.'.format(num))
+
+    box_slice = lambda lo, hi: tuple(slice(l, h) for l, h in zip(lo, hi))
+    other_axes = lambda axis: tuple(a for a in range(dim) if a != axis)
+
+    def trim(lo, hi):
+        box = needed[box_slice(lo, hi)]
+        lo = list(lo)
+        hi = list(hi)
+        for axis in range(dim):
+            if periodicity[axis]:
+                continue
+            used = np.flatnonzero(np.any(box, axis=other_axes(axis)))
+            hi[axis] = lo[axis] + used[-1] + 1
+            lo[axis] += used[0]
+        return lo, hi
+
+    ret = []
+
+    def split(lo, hi, n):
+        lo, hi = trim(lo, hi)
+        box = fluid[box_slice(lo, hi)]
+        count = int(np.sum(box))
+        if n == 1:
+            ret.append((lo, hi, count))
+            return
+
+        best = None
+        # With an odd number of subdomains, the larger part can be on
+        # either side of the split.
+        for n_low in sorted(set([n // 2, n - n // 2])):
+            target = count * n_low / float(n)
+            for axis in sorted(range(dim), key=lambda a: lo[a] - hi[a]):
+                if hi[axis] - lo[axis] < 2:
+                    continue
+                profile = np.cumsum(np.sum(box, axis=other_axes(axis)))
+                # Every part needs at least one fluid node per subdomain.
+                err = np.abs(profile[:-1] - target) / avg
+                err[(profile[:-1] < n_low) |
+                    (count - profile[:-1] < n - n_low)] = np.inf
+                pos = int(np.argmin(err)) + 1
+                err = err[pos - 1]
+                if np.isinf(err):
+                    continue
+                if best is None or err < best[0]:
+                    best = (err, axis, pos, n_low)
+                if best[0] <= tolerance:
+                    break
+            if best is not None:
+                break
+
+        if best is None:
+            raise ValueError('Box {0}-{1} cannot be split into {2} '
+                             'subdomains with fluid nodes.'.format(lo, hi, n))
+
+        _, axis, pos, n_low = best
+        mid = lo[axis] + pos
+        split(lo, hi[:axis] + [mid] + hi[axis + 1:], n_low)
+        split(lo[:axis] + [mid] + lo[axis + 1:], hi, n - n_low)
+
+    split([0] * dim, list(fluid.shape), num)
+    return [(tuple(int(x) for x in reversed(lo)),
+             tuple(int(h - l) for l, h in reversed(list(zip(lo, hi)))), count)
+            for lo, hi, count in ret]
+
+
+def _add_rcb_options(group):
+    group.add_argument('--subdomains', help='number of subdomains',
+            type=int, default=1)
+    group.add_argument('--geometry_for_decomposition', type=str,
+            default='', help='Numpy boolean array with True entries '
+            'indicating inactive nodes to use to decide where to split '
+            'the domain.')
+    group.add_argument('--decomposition_tolerance', type=float,
+            default=0.05, help='Acceptable deviation of the number of '
+            'fluid nodes in a subdomain from the average, as a fraction of '
+            'the average.')
+
+
+class _RCBGeometryMixin(object):
+    """Common code for the RCB geometry classes."""
+
+    def wall_map(self):
+        """Returns a Boolean array covering the whole domain, with True
+        entries indicating solid nodes."""
+        if not self.config.geometry_for_decomposition:
+            return np.zeros(list(reversed(self.gsize)), dtype=np.bool)
+        return util.load_array(self.config.geometry_for_decomposition)
+
+    def subdomains(self):
+        wall_map = self.wall_map()
+        if wall_map.shape != tuple(reversed(self.gsize)):
+            raise ValueError('Wall map shape {0} does not match the size of '
+                             'the domain.'.format(wall_map.shape))
+
+        periodicity = [self.config.periodic_x, self.config.periodic_y]
+        if self.spec_cls.dim == 3:
+            periodicity.append(self.config.periodic_z)
+
+        ret = []
+        for location, size, fluid_nodes in rcb_decomposition(
+                wall_map, self.config.subdomains,
+                self.config.decomposition_tolerance, periodicity):
+            spec = self.spec_cls(location, size)
+            spec.num_active_nodes = fluid_nodes
+            ret.append(spec)
+        return ret
+
+
+class RCBGeometry2D(_RCBGeometryMixin, LBGeometry2D):
+    """Divides a domain into subdomains with approximately equal numbers of
+    fluid nodes using recursive coordinate bisection.  Useful for sparse
+    geometries, such as porous media or blood vessels.
+
+    The wall map is loaded from --geometry_for_decomposition.  Subclasses
+    can provide it directly by overriding wall_map()."""
+    spec_cls = SubdomainSpec2D
+
+    @classmethod
+    def add_options(cls, group):
+        LBGeometry2D.add_options(group)
+        _add_rcb_options(group)
+
+
+class RCBGeometry3D(_RCBGeometryMixin, LBGeometry3D):
+    """3D version of RCBGeometry2D."""
+    spec_cls = SubdomainSpec3D
+
+    @classmethod
+    def add_options(cls, group):
+        LBGeometry3D.add_options(group)
+        _add_rcb_options(group)
@@ -4,9 +4,15 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
 import numpy as np
 
-from sailfish import util
+from sailfish import codegen, util
 import sailfish.node_type as nt
 
 def bit_len(num):
@@ -18,6 +24,25 @@ def bit_len(num):
     return max(length, 1)
 
 
+def _group_nodes(param_map):
+    """Groups nodes by the values of param_map.
+
+    Nodes with a value of 0 (no parameters) are ignored.
+
+    :rvalue: dict mapping values from param_map to arrays of flat indices of
+        the nodes with that value, in row-major order
+    """
+    flat = np.ravel(param_map)
+    nodes = np.flatnonzero(flat)
+    keys, inverse = np.unique(flat[nodes], return_inverse=True)
+    # A stable sort keeps the nodes within every group in row-major order.
+    order = np.argsort(inverse, kind='mergesort')
+    counts = np.bincount(inverse)
+    ends = np.cumsum(counts)
+    return dict((key, nodes[order[end - count:end]]) for key, end, count in
+                zip(keys.tolist(), ends, counts))
+
+
 class GeoEncoder(object):
     """Takes information about geometry as specified by the simulation and
     encodes it into buffers suitable for processing on a GPU.
@@ -93,62 +118,41 @@ class GeoEncoderConst(GeoEncoder):
         self._param_dict = param_dict
         self._encoded_param_map = np.zeros_like(self._type_map)
         self._scratch_map = np.zeros_like(self._type_map)
+        # Flat views used for vectorized assignments.
+        encoded_params = self._encoded_param_map.reshape(-1)
+        scratch = self._scratch_map.reshape(-1)
+
+        param_to_idx = dict()  # Maps seen params to ids.
 
-        param_to_idx = dict()  # Maps entries in seen_params to ids.
-        seen_params = set()
-        param_items = 0
+        def _param_idx(param, values):
+            if param not in param_to_idx:
+                param_to_idx[param] = len(self._geo_params)
+                self._geo_params.extend(values)
+            return param_to_idx[param]
+
+        node_lists = _group_nodes(param_map)
 
         # Refer to subdomain.Subdomain._verify_params for a list of allowed
         # ways of encoding nodes.
         for node_key, node_type in param_dict.items():
+            nodes = node_lists.get(node_key)
+            if nodes is None:
+                continue
             for param in node_type.params.values():
                 if util.is_number(param):
-                    if param in seen_params:
-                        idx = param_to_idx[param]
-                    else:
-                        seen_params.add(param)
-                        self._geo_params.append(param)
-                        idx = param_items
-                        param_to_idx[param] = idx
-                        param_items += 1
-                    self._encoded_param_map[param_map == node_key] = idx
+                    encoded_params[nodes] = _param_idx(param, [param])
                 elif type(param) is tuple:
-                    if param in seen_params:
-                        idx = param_to_idx[param]
-                    else:
-                        seen_params.add(param)
-                        self._geo_params.extend(param)
-                        idx = param_items
-                        param_to_idx[param] = idx
-                        param_items += len(param)
-                    self._encoded_param_map[param_map == node_key] = idx
-                # Param is a structured numpy array.
+                    encoded_params[nodes] = _param_idx(param, param)
+                # Param is a structured numpy array, with values
+                # corresponding to nodes in row-major order.
                 elif isinstance(param, np.ndarray):
-                    nodes_idx = np.argwhere(param_map == node_key)
-
-                    uniques = np.unique(param)
+                    uniques, inverse = np.unique(param, return_inverse=True)
                     uniques.flags.writeable = False
+                    idx = np.array([_param_idx(value, value) for value in
+                                    uniques], dtype=encoded_params.dtype)
+                    encoded_params[nodes] = idx[np.ravel(inverse)]
 
-                    for value in uniques:
-                        if value in seen_params:
-                            idx = param_to_idx[value]
-                        else:
-                            seen_params.add(value)
-                            self._geo_params.extend(value)
-                            idx = param_items
-                            param_to_idx[value] = idx
-                            param_items += len(value)
-
-                        idxs = nodes_idx[param == value]
-                        if idxs.shape[1] == 3:
-                            self._encoded_param_map[idxs[:,0], idxs[:,1],
-                                                    idxs[:,2]] = idx
-                        elif idxs.shape[1] == 2:
-                            self._encoded_param_map[idxs[:,0], idxs[:,1]] = idx
-                        else:
-                            assert False, 'Unsupported dimension: {0}'.format(
-                                    idxs.shape[1])
-
+        param_items = len(self._geo_params)
         self._non_symbolic_idxs = param_items
         self._symbol_map = {}  # Maps param indices to sympy expressions.
 
@@ -163,10 +167,9 @@ class GeoEncoderConst(GeoEncoder):
         for node_key, node_type in param_dict.items():
             for param in node_type.params.values():
                 if isinstance(param, nt.DynamicValue):
-                    if param in seen_params:
-                        idx = param_to_idx[value]
+                    if param in param_to_idx:
+                        idx = param_to_idx[param]
                     else:
-                        seen_params.add(param)
                         idx = param_items
                         self._symbol_map[idx] = param
                         param_to_idx[param] = idx
@@ -182,27 +185,24 @@ class GeoEncoderConst(GeoEncoder):
                                 timeseries_offset += ts._data.size
                                 self._timeseries_data.extend(ts._data)
 
-                    self._encoded_param_map[param_map == node_key] = idx
+                    if node_key in node_lists:
+                        encoded_params[node_lists[node_key]] = idx
 
         self._bits_param = bit_len(param_items)
 
         # Maps node type ID to base offset within the scratch space array.
         self._scratch_space_base = {}
         type_to_node_count = {}
-        # Generate unique (within node type) scratch space ids.
+        # Generate unique (within node type) scratch space ids, assigned
+        # to nodes in row-major order.
         for node_type in self._node_types:
             if node_type.scratch_space_size(self.dim) <= 0:
                 continue
 
-            def _selector(idx_list):
-                return [slice(i, i+1) for i in idx_list]
-
-            idx = np.argwhere(self._type_map == node_type.id)
-            num_nodes = idx.shape[0]
+            idx = np.flatnonzero(self._type_map == node_type.id)
+            num_nodes = idx.size
             type_to_node_count[node_type.id] = num_nodes
-
-            for i in range(num_nodes):
-               self._scratch_map[_selector(idx[i,:])] = i
+            scratch[idx] = np.arange(num_nodes)
 
             self._scratch_space_base[node_type.id] = self.scratch_space_size
 
@@ -258,8 +258,26 @@ class GeoEncoderConst(GeoEncoder):
                 self._scratch_map)
         self.config.logger.debug('... type map done.')
 
-        # Drop the reference to the map array.
+        # Drop the reference to the map array. The scratch space IDs are
+        # now a part of the encoded map.
         self._type_map = None
+        self._scratch_map = None
+
+    def release_param_map(self):
+        """Releases the per-node array of parameter indices.  get_param()
+        cannot be used afterwards."""
+        self._encoded_param_map = None
+
+    def get_state(self):
+        """Returns the state of the encoder after encode(), in a form suitable
+        for pickling.  References to the subdomain are not included."""
+        return dict((k, v) for k, v in self.__dict__.items() if k not in
+                    ('subdomain', 'config', '_type_map', '_param_map',
+                     '_param_dict'))
+
+    def set_state(self, state):
+        """Restores the state returned by get_state()."""
+        self.__dict__.update(state)
 
     def get_param(self, location, values=1):
         """
@@ -314,6 +332,120 @@ class GeoEncoderConst(GeoEncoder):
         return (misc_data << self._bits_type) | node_type
 
 
+class GeometryCache(object):
+    """Persistent cache of processed subdomain geometry.
+
+    Entries are keyed by a digest of the subdomain spec, the simulation
+    settings and the sources of the classes defining the subdomain, so that
+    a simulation restarted with an unchanged geometry can skip the geometry
+    processing in Subdomain.reset().  Files named by string options are
+    identified by their size and modification time.
+
+    Note that Subdomain.boundary_conditions() is not called when the geometry
+    is loaded from the cache, so it should not have any side effects other
+    than setting nodes.  The random seed is a part of the key, so geometries
+    generated using random numbers are only reused for the same seed.
+    """
+
+    #: Number of cache hits and misses in the current process.
+    hits = 0
+    misses = 0
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def key(self, subdomain):
+        """Computes the cache key for a subdomain.
+
+        :rvalue: cache key, or None if the sources of the subdomain class are
+            not available and the geometry cannot be cached
+        """
+        h = hashlib.sha1()
+        h.update(codegen._package_sources_digest().encode('utf-8'))
+
+        paths = set()
+        for cls in type(subdomain).mro()[:-1]:
+            try:
+                path = inspect.getsourcefile(cls)
+            except TypeError:
+                path = None
+            if path is None or not os.path.isfile(path):
+                return None
+            paths.add(os.path.realpath(path))
+        h.update(codegen._source_files_digest(paths).encode('utf-8'))
+
+        options = {}
+        for name, value in vars(subdomain.config).items():
+            if name in _geometry_cache_ignored_options:
+                continue
+            if isinstance(value, str) and os.path.isfile(value):
+                st = os.stat(value)
+                value = (value, st.st_size, st.st_mtime)
+            options[name] = value
+
+        spec = subdomain.spec
+        h.update(codegen._cache_repr([
+            options, spec.location, spec.size, spec.envelope_size,
+            spec.actual_size, spec._periodicity,
+            [f for f, c in spec._connections.items() if c],
+            subdomain.grid.__name__, subdomain.grid_shape,
+            # Pickled data is not portable between these.
+            sys.version_info[0], np.__version__]).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, '{0}.geo'.format(key))
+
+    def get(self, key):
+        """Returns the cached geometry state or None if it is not available."""
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            GeometryCache.misses += 1
+            return None
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            self.logger.warning('Failed to load cached geometry from {0}: '
+                                '{1}'.format(path, e))
+            GeometryCache.misses += 1
+            return None
+        GeometryCache.hits += 1
+        return state
+
+    def put(self, key, state):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # The directory might have been created by another process.
+                if not os.path.isdir(self.path):
+                    raise
+
+        # Write to a temporary file first and atomically rename it, so that
+        # other processes never see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # Node parameters are not guaranteed to be picklable.
+            os.unlink(tmp_path)
+            self.logger.warning('Failed to cache geometry: {0}'.format(e))
+            return
+        os.rename(tmp_path, self._entry_path(key))
+
+
+#: Config options which do not influence the geometry and are therefore
+#: ignored when computing geometry cache keys.  The dependence flags are set
+#: while processing the geometry, and are restored from the cache.  The seed
+#: does not affect the generated code, but can affect the geometry.
+_geometry_cache_ignored_options = (
+    (codegen._code_cache_ignored_options - set(['seed'])) |
+    set(['time_dependence', 'space_dependence']))
+
+
 # TODO: Implement this class.
 class GeoEncoderBuffer(GeoEncoder):
     pass
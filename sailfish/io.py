@@ -4,23 +4,45 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import base64
 import glob
+import json
 import math
 import numpy as np
 import operator
 import os
 import re
 import ctypes
+import struct
 import threading
 import time
+import uuid
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 try:
     from queue import Queue
 except ImportError:
     from Queue import Queue
+try:
+    import blosc
+except ImportError:
+    blosc = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from ctypes import Structure, c_uint16, c_int32, c_uint8, c_bool
 from functools import reduce
 
+
+def _missing_value(dtype):
+    """Returns the value used for nodes without valid data: NaN for
+    floating point data and 0 otherwise."""
+    return np.nan if np.issubdtype(dtype, np.inexact) else 0
+
+
 class VisConfig(Structure):
     MAX_NAME_SIZE = 64
     _fields_ = [('iteration', c_int32), ('subdomain', c_uint16), ('field', c_uint8),
@@ -29,10 +51,18 @@ class VisConfig(Structure):
                  type(ctypes.create_string_buffer(MAX_NAME_SIZE)))]
 
 class LBOutput(object):
+    #: Whether fields of a size different from that of the subdomain
+    #: can be saved.
+    supports_downsampling = True
+    #: Whether half precision fields can be saved.
+    supports_half_precision = True
+
     def __init__(self, config, subdomain_id, *args, **kwargs):
         self._scalar_fields = {}
         self._vector_fields = {}
         self._fluid_map = None
+        # Fluid maps for fields not matching the size of the subdomain.
+        self._field_fluid_maps = {}
 
         # Additional scalar fields used for visualization.
         self._visualization_fields = {}
@@ -40,7 +70,13 @@ class LBOutput(object):
         self.subdomain_id = subdomain_id
         self.num_subdomains = config.subdomains if hasattr(config, 'subdomains') else 1
 
-    def register_field(self, field, name, visualization=False):
+    def register_field(self, field, name, visualization=False,
+                       fluid_map=None):
+        """
+        :param fluid_map: boolean array selecting fluid nodes of the field;
+            only needs to be specified if it is different from the fluid map
+            of the subdomain
+        """
         if visualization:
             self._visualization_fields[name] = field
         else:
@@ -48,14 +84,28 @@ class LBOutput(object):
                 self._vector_fields[name] = field
             else:
                 self._scalar_fields[name] = field
+            if fluid_map is not None:
+                self._field_fluid_maps[name] = fluid_map
+            else:
+                self._field_fluid_maps.pop(name, None)
+
+    def unregister_field(self, name):
+        """Removes a field registered with register_field()."""
+        self._scalar_fields.pop(name, None)
+        self._vector_fields.pop(name, None)
+        self._field_fluid_maps.pop(name, None)
+
+    def _fluid_map_for(self, name):
+        return self._field_fluid_maps.get(name, self._fluid_map)
 
     def mask_nonfluid_nodes(self):
-        nonfluid = np.logical_not(self._fluid_map)
-        for f in self._scalar_fields.values():
-            f[nonfluid] = np.nan
-        for fv in self._vector_fields.values():
+        for name, f in self._scalar_fields.items():
+            f[np.logical_not(self._fluid_map_for(name))] = _missing_value(
+                f.dtype)
+        for name, fv in self._vector_fields.items():
+            nonfluid = np.logical_not(self._fluid_map_for(name))
             for f in fv:
-                f[nonfluid] = np.nan
+                f[nonfluid] = _missing_value(f.dtype)
 
     def save(self, i):
         pass
@@ -73,12 +123,21 @@ class LBOutput(object):
         """
         self._fluid_map = fluid_map
 
+    def set_geometry(self, location, global_size):
+        """
+        :param location: location of the subdomain within the global
+            lattice (x, y, [z])
+        :param global_size: size of the global lattice (x, y, [z])
+        """
+        self._location = location
+        self._global_size = global_size
+
     def verify(self):
-        fm = self._fluid_map
-        return (all((np.all(np.isfinite(f[fm])) for f in
-                    self._scalar_fields.values()))
-                and all(np.all(np.isfinite(fc[fm])) for f in
-                    self._vector_fields.values() for fc in f))
+        return (all((np.all(np.isfinite(f[self._fluid_map_for(name)])) for
+                     name, f in self._scalar_fields.items()))
+                and all(np.all(np.isfinite(fc[self._fluid_map_for(name)]))
+                        for name, f in self._vector_fields.items()
+                        for fc in f))
 
     def wait(self):
         pass
@@ -88,6 +147,8 @@ class VisualizationWrapper(LBOutput):
     """Passes data to a visualization engine, and handles saving it to a
     file."""
     format_name = 'vis'
+    # The visualization buffers match the size of the subdomain.
+    supports_downsampling = False
 
     # TODO(michalj): Add support for visualization fields different from these
     # used for the output file.
@@ -101,8 +162,16 @@ class VisualizationWrapper(LBOutput):
         self.nodes = reduce(operator.mul, subdomain.size)
         self._dim = len(self.subdomain.size)
 
-    def register_field(self, field, name, visualization=False):
-        self._output.register_field(field, name, visualization)
+    @property
+    def supports_half_precision(self):
+        return self._output.supports_half_precision
+
+    def register_field(self, field, name, visualization=False,
+                       fluid_map=None):
+        self._output.register_field(field, name, visualization, fluid_map)
+
+    def unregister_field(self, name):
+        self._output.unregister_field(name)
 
     def mask_nonfluid_nodes(self):
         self._output.mask_nonfluid_nodes()
@@ -110,6 +179,9 @@ class VisualizationWrapper(LBOutput):
     def set_fluid_map(self, fluid_map):
         self._output.set_fluid_map(fluid_map)
 
+    def set_geometry(self, location, global_size):
+        self._output.set_geometry(location, global_size)
+
     def verify(self):
         return self._output.verify()
 
@@ -158,6 +230,105 @@ class VisualizationWrapper(LBOutput):
             self._vis_buffer[0:self.nodes] = np.ravel(field)
             self._geo_buffer[0:self.nodes] = np.ravel(self.subdomain.runner.visualization_map())
 
+
+class SparseOutputWrapper(LBOutput):
+    """Saves fields stored only for the active nodes of a subdomain (see
+    --sparse_host_storage).
+
+    Dense copies of the fields are created for every saved snapshot and
+    passed to the wrapped output object, which holds them only while the
+    snapshot is being saved.  Fields registered with their own fluid map
+    (e.g. reduced output fields) are already dense and are passed through.
+    """
+
+    def __init__(self, output, lattice, nonghost_slice):
+        """
+        :param output: LBOutput instance saving the dense fields
+        :param lattice: SparseLattice describing the active nodes
+        :param nonghost_slice: slice selecting non-ghost nodes in the dense
+            lattice arrays
+        """
+        self._output = output
+        self._lattice = lattice
+        self._nonghost_slice = nonghost_slice
+        self._scalar_fields = {}
+        self._vector_fields = {}
+        self._fluid_map = None
+        self._field_fluid_maps = {}
+
+    @property
+    def supports_downsampling(self):
+        return self._output.supports_downsampling
+
+    @property
+    def supports_half_precision(self):
+        return self._output.supports_half_precision
+
+    def _dense(self, field, fill=np.nan):
+        return self._lattice.scatter(field, fill=fill)[self._nonghost_slice]
+
+    def register_field(self, field, name, visualization=False,
+                       fluid_map=None):
+        if visualization or fluid_map is not None:
+            self._scalar_fields.pop(name, None)
+            self._vector_fields.pop(name, None)
+            self._output.register_field(field, name, visualization, fluid_map)
+        elif type(field) is list:
+            self._vector_fields[name] = field
+        else:
+            self._scalar_fields[name] = field
+
+    def unregister_field(self, name):
+        self._scalar_fields.pop(name, None)
+        self._vector_fields.pop(name, None)
+        self._output.unregister_field(name)
+
+    def set_fluid_map(self, fluid_map):
+        """
+        :param fluid_map: dense boolean array selecting non-ghost nodes that
+            represent fluid
+        """
+        dense = np.zeros(self._lattice.shape, dtype=np.bool_)
+        dense[self._nonghost_slice] = fluid_map
+        self._fluid_map = self._lattice.gather(dense)
+
+    def mask_nonfluid_nodes(self):
+        LBOutput.mask_nonfluid_nodes(self)
+        self._output.mask_nonfluid_nodes()
+
+    def verify(self):
+        return LBOutput.verify(self) and self._output.verify()
+
+    def set_geometry(self, location, global_size):
+        self._output.set_geometry(location, global_size)
+
+    def save(self, i):
+        names = []
+        for name, field in self._scalar_fields.items():
+            self._output.register_field(self._dense(field), name)
+            names.append(name)
+        for name, field in self._vector_fields.items():
+            self._output.register_field([self._dense(c) for c in field], name)
+            names.append(name)
+        self._output.set_fluid_map(self._dense(self._fluid_map, fill=False))
+
+        self._output.save(i)
+
+        # Release the dense arrays. Asynchronous writers keep their own
+        # references until the data is saved.
+        for name in names:
+            self._output.unregister_field(name)
+        self._output.set_fluid_map(None)
+
+    def dump_dists(self, dists, i):
+        self._output.dump_dists(dists, i)
+
+    def dump_node_type(self, node_type):
+        self._output.dump_node_type(node_type)
+
+    def wait(self):
+        self._output.wait()
+
 def filename_iter_digits(max_iters=0):
     """Returns the number of digits used to represent the iteration in the filename"""
     if max_iters:
@@ -189,15 +360,25 @@ def checkpoint_filename(base, digits, subdomain_id, it):
     return ('{0}.{1:0' + str(digits) + 'd}.{2}.cpoint').format(base, it, subdomain_id)
 
 def subdomain_checkpoint(base, subdomain_id):
+    """Returns the name of the checkpoint file for a subdomain.
+
+    For checkpoints in the raw format, this is the name of the manifest.
+    The manifest does not need to exist if the checkpoint was saved with a
+    different subdomain decomposition.
+    """
     if base.endswith('.last'):
         base = base[:-5]
-        files = glob.glob('{0}.*.{1}.cpoint.npz'.format(base, subdomain_id))
+        files = (glob.glob('{0}.*.{1}.cpoint.npz'.format(base, subdomain_id)) +
+                 glob.glob('{0}.*.{1}.cpoint.json'.format(base, subdomain_id)))
         if not files:
             return None
         files.sort()
         return files[0]
 
-    return '{0}.{1}.cpoint.npz'.format(base, subdomain_id)
+    fname = '{0}.{1}.cpoint.npz'.format(base, subdomain_id)
+    if not os.path.exists(fname) and glob.glob('{0}.*.cpoint.json'.format(base)):
+        return '{0}.{1}.cpoint.json'.format(base, subdomain_id)
+    return fname
 
 def iter_from_filename(fname):
     return re.findall(r'([0-9]+)\.npz', fname)[0]
@@ -213,53 +394,291 @@ def temp_filename(fname):
     dirname, base = os.path.split(fname)
     return os.path.join(dirname, '.tmp.' + base)
 
+def _vtk_type(dtype):
+    kinds = {'f': 'Float', 'i': 'Int', 'u': 'UInt'}
+    return '{0}{1}'.format(kinds[dtype.kind], dtype.itemsize * 8)
+
+
+def _vtk_extent(location, shape):
+    """Returns a VTK extent string for an array of a given shape ([z,] y, x)
+    located at location (x, y, [z]).
+
+    Every lattice node is represented by a VTK cell, so that the extents
+    of neighboring subdomains share their boundary points.
+    """
+    location = list(location)
+    size = list(reversed(shape))
+    extent = ['{0} {1}'.format(l, l + n) for l, n in zip(location, size)]
+    extent += ['0 0'] * (3 - len(extent))
+    return ' '.join(extent)
+
+
+def _vtk_slabs(field, components, slab_size):
+    """Yields the data of a field in the order expected by VTK, as strings
+    of bytes with at most slab_size nodes each.
+
+    :param field: scalar field array, or list of vector field components
+    :param components: number of components of the VTK data array
+    """
+    if components == 1:
+        arrays = [field]
+    else:
+        arrays = list(field)
+    shape = arrays[0].shape
+    flat_shape = (int(np.prod(shape[1:])),)
+    rows = max(1, slab_size // flat_shape[0])
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        if components == 1:
+            yield np.ascontiguousarray(field[start:stop]).tobytes()
+        else:
+            # Interleave the components.  Missing ones (Z in 2D) are zeros.
+            buf = np.zeros(((stop - start) * flat_shape[0], components),
+                           dtype=arrays[0].dtype)
+            for i, component in enumerate(arrays):
+                buf[:, i] = component[start:stop].reshape(-1)
+            yield buf.tobytes()
+
+
+class _VTKAppendedWriter(object):
+    """Writes data arrays to the raw appended data section of a VTK XML
+    file."""
+    header = np.uint64
+
+    def __init__(self, f, compress, block_size):
+        self._f = f
+        self._compress = compress
+        self._block_size = block_size
+
+    def _write_header(self, pos, values):
+        end = self._f.tell()
+        self._f.seek(pos)
+        self._f.write(np.array(values, dtype=self.header).tobytes())
+        self._f.seek(end)
+
+    def write(self, pieces, nbytes):
+        """Writes one data array.
+
+        :param pieces: iterable of strings of bytes with the array data
+        :param nbytes: total size of the data
+        :returns: number of bytes written to the file
+        """
+        start = self._f.tell()
+        if not self._compress:
+            self._f.write(np.array([nbytes], dtype=self.header).tobytes())
+            for piece in pieces:
+                self._f.write(piece)
+            return self._f.tell() - start
+
+        # With compression, the data is split into blocks of equal size
+        # (except the last one), compressed independently.  The header
+        # contains the number of blocks, the block size, the size of the
+        # last block and the compressed sizes of all blocks, which are
+        # filled in once the blocks are written.
+        num_blocks = (nbytes + self._block_size - 1) // self._block_size
+        last = nbytes % self._block_size
+        sizes = []
+        self._f.write(np.zeros(3 + num_blocks, dtype=self.header).tobytes())
+
+        pending = []
+        pending_size = 0
+        for piece in pieces:
+            pending.append(piece)
+            pending_size += len(piece)
+            if pending_size < self._block_size:
+                continue
+            buf = b''.join(pending)
+            pos = 0
+            while len(buf) - pos >= self._block_size:
+                block = zlib.compress(buf[pos:pos + self._block_size])
+                self._f.write(block)
+                sizes.append(len(block))
+                pos += self._block_size
+            pending = [buf[pos:]]
+            pending_size = len(pending[0])
+        if pending_size > 0:
+            block = zlib.compress(b''.join(pending))
+            self._f.write(block)
+            sizes.append(len(block))
+
+        self._write_header(start, [num_blocks, self._block_size, last] + sizes)
+        return self._f.tell() - start
+
+
+def _vtk_data_arrays(scalar_fields, vector_fields, tag, offsets=None):
+    lines = []
+    names = list(scalar_fields.keys()) + list(vector_fields.keys())
+    for i, name in enumerate(names):
+        if name in scalar_fields:
+            dtype = np.dtype(scalar_fields[name].dtype)
+            components = ''
+        else:
+            dtype = np.dtype(vector_fields[name][0].dtype)
+            components = ' NumberOfComponents="3"'
+        extra = ''
+        if offsets is not None:
+            extra = ' format="appended" offset="{0}"'.format(offsets[i])
+        lines.append('<{0} type="{1}" Name="{2}"{3}{4}/>'.format(
+            tag, _vtk_type(dtype), name, components, extra))
+    return lines
+
+
+def write_vti(fname, scalar_fields, vector_fields, location=(0, 0, 0),
+              origin=(-0.5, -0.5, -0.5), spacing=(1.0, 1.0, 1.0),
+              whole_extent=None, compress=False, block_size=1 << 20):
+    """Saves fields in a VTK XML ImageData file.
+
+    The fields are saved as cell data, with cells centered on the lattice
+    nodes.  The data is written directly from the field arrays, a slab at
+    a time, as raw appended data, optionally compressed with zlib.
+
+    :param scalar_fields: dict mapping names to arrays ([z,] y, x)
+    :param vector_fields: dict mapping names to lists of component arrays
+    :param location: location (x, y, [z]) of the first node of the arrays
+        within the global lattice
+    :param whole_extent: VTK extent of the global lattice; defaults to the
+        extent of the arrays
+    :param block_size: size in bytes of the compressed blocks
+    """
+    if scalar_fields:
+        shape = next(iter(scalar_fields.values())).shape
+    else:
+        shape = next(iter(vector_fields.values()))[0].shape
+    extent = _vtk_extent(location, shape)
+    if whole_extent is None:
+        whole_extent = extent
+    names = list(scalar_fields.keys()) + list(vector_fields.keys())
+    # Offsets are not known until the data is written and are filled in
+    # later, so reserve space for them.
+    placeholder = '0' * 20
+
+    compressor = ' compressor="vtkZLibDataCompressor"' if compress else ''
+    attrs = ''
+    if scalar_fields:
+        attrs += ' Scalars="{0}"'.format(names[0])
+    if vector_fields:
+        attrs += ' Vectors="{0}"'.format(list(vector_fields.keys())[0])
+    header = '\n'.join([
+        '<?xml version="1.0"?>',
+        '<VTKFile type="ImageData" version="1.0" byte_order="LittleEndian" '
+        'header_type="UInt64"{0}>'.format(compressor),
+        '<ImageData WholeExtent="{0}" Origin="{1}" Spacing="{2}">'.format(
+            whole_extent, ' '.join(str(x) for x in origin),
+            ' '.join(str(x) for x in spacing)),
+        '<Piece Extent="{0}">'.format(extent),
+        '<CellData{0}>'.format(attrs)] +
+        _vtk_data_arrays(scalar_fields, vector_fields, 'DataArray',
+                         [placeholder] * len(names)) + [
+        '</CellData>',
+        '</Piece>',
+        '</ImageData>',
+        '<AppendedData encoding="raw">',
+        '_'])
+
+    # Number of nodes in a slab of data processed at a time.
+    slab_size = max(1, block_size // 8)
+    with open(fname, 'wb') as f:
+        f.write(header.encode('ascii'))
+        writer = _VTKAppendedWriter(f, compress, block_size)
+        offsets = []
+        offset = 0
+        num_nodes = int(np.prod(shape))
+        for name in names:
+            offsets.append(offset)
+            if name in scalar_fields:
+                field = scalar_fields[name]
+                pieces = _vtk_slabs(field, 1, slab_size)
+                nbytes = num_nodes * field.dtype.itemsize
+            else:
+                field = vector_fields[name]
+                pieces = _vtk_slabs(field, 3, slab_size)
+                nbytes = num_nodes * field[0].dtype.itemsize * 3
+            offset += writer.write(pieces, nbytes)
+        f.write(b'\n</AppendedData>\n</VTKFile>\n')
+
+        # Fill in the offsets of the data arrays.
+        pos = 0
+        for off in offsets:
+            pos = header.index(placeholder, pos)
+            f.seek(pos)
+            f.write('{0:020d}'.format(off).encode('ascii'))
+            pos += len(placeholder)
+
+
+def write_pvti(fname, pieces, scalar_fields, vector_fields, whole_extent,
+               origin=(-0.5, -0.5, -0.5), spacing=(1.0, 1.0, 1.0)):
+    """Saves a VTK XML PImageData file, combining ImageData files of
+    multiple subdomains.
+
+    :param pieces: list of (extent, file name) tuples
+    :param scalar_fields: dict mapping names to arrays or dtypes
+    :param vector_fields: dict mapping names to lists of component arrays
+        (or dtypes)
+    """
+    lines = [
+        '<?xml version="1.0"?>',
+        '<VTKFile type="PImageData" version="1.0" byte_order="LittleEndian" '
+        'header_type="UInt64">',
+        '<PImageData WholeExtent="{0}" GhostLevel="0" Origin="{1}" '
+        'Spacing="{2}">'.format(whole_extent,
+                                ' '.join(str(x) for x in origin),
+                                ' '.join(str(x) for x in spacing)),
+        '<PCellData>']
+    lines.extend(_vtk_data_arrays(scalar_fields, vector_fields, 'PDataArray'))
+    lines.append('</PCellData>')
+    for extent, source in pieces:
+        lines.append('<Piece Extent="{0}" Source="{1}"/>'.format(
+            extent, os.path.basename(source)))
+    lines.extend(['</PImageData>', '</VTKFile>', ''])
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+
+
 class VTKOutput(LBOutput):
-    """Saves simulation data in VTK files."""
+    """Saves simulation data in VTK XML ImageData (.vti) files.
+
+    For every snapshot, the output for subdomain 0 also saves a .pvti file
+    combining the data from all subdomains.
+    """
     format_name = 'vtk'
+    supports_downsampling = False
+    supports_half_precision = False
 
     def __init__(self, config, subdomain_id):
         LBOutput.__init__(self, config, subdomain_id)
         self.digits = filename_iter_digits(config.max_iters)
+        self.compress = config.output_compress
+        self._location = None
+        self._global_size = None
+        self._subdomains = None
+
+    def _save_pvti(self, i):
+        if self._subdomains is None:
+            with open(subdomains_filename(self.basename), 'rb') as f:
+                self._subdomains = pickle.load(f)
+        pieces = [(_vtk_extent(s.location, list(reversed(s.size))),
+                   filename(self.basename, self.digits, s.id, i, suffix='.vti'))
+                  for s in self._subdomains]
+        write_pvti(merged_filename(self.basename, self.digits, i,
+                                   suffix='.pvti'),
+                   pieces, self._scalar_fields, self._vector_fields,
+                   _vtk_extent([0, 0, 0], list(reversed(self._global_size))))
 
     def save(self, i):
         self.mask_nonfluid_nodes()
-        os.environ['ETS_TOOLKIT'] = 'null'
-        from tvtk.api import tvtk
-        idata = tvtk.ImageData(spacing=(1, 1, 1), origin=(0, 0, 0))
-
-        first = True
-        sample_field = None
-        for name, field in self._scalar_fields.items():
-            if first:
-                idata.point_data.scalars = field.flatten()
-                idata.point_data.scalars.name = name
-                first = False
-                sample_field = field
-            else:
-                t = idata.point_data.add_array(field.flatten())
-                idata.point_data.get_array(t).name = name
-
-        idata.update()
-        dim = len(sample_field.shape)
-
-        for name, field in self._vector_fields.items():
-            if dim == 3:
-                tmp = idata.point_data.add_array(np.c_[field[0].flatten(),
-                                                 field[1].flatten(), field[2].flatten()])
-            else:
-                tmp = idata.point_data.add_array(np.c_[field[0].flatten(),
-                                                 field[1].flatten(),
-                                                 np.zeros_like(field[0].flatten())])
-            idata.point_data.get_array(tmp).name = name
-
-        if dim == 3:
-            idata.dimensions = list(reversed(sample_field.shape))
-        else:
-            idata.dimensions = list(reversed(sample_field.shape)) + [1]
-
         fname = filename(self.basename, self.digits, self.subdomain_id, i, suffix='.vti')
-        w = tvtk.XMLImageDataWriter(input=idata, file_name=fname)
-        w.write()
+        if self._location is None:
+            write_vti(fname, self._scalar_fields, self._vector_fields,
+                      compress=self.compress)
+            return
+
+        write_vti(fname, self._scalar_fields, self._vector_fields,
+                  location=self._location,
+                  whole_extent=_vtk_extent(
+                      [0, 0, 0], list(reversed(self._global_size))),
+                  compress=self.compress)
+        if self.subdomain_id == 0:
+            self._save_pvti(i)
 
     # TODO: Implement this function.
     def dump_dists(self, dists, i):
@@ -295,6 +714,235 @@ def Saver(queue, do_save, num_subdomains):
         queue.task_done()
 
 
+def _block_view(flat, block_size):
+    """Returns a copy of flat, padded and reshaped into blocks."""
+    num_blocks = (flat.size + block_size - 1) // block_size
+    blocks = np.zeros(num_blocks * block_size, dtype=flat.dtype)
+    blocks[:flat.size] = flat
+    return blocks.reshape((num_blocks, block_size))
+
+
+class CheckpointWriter(object):
+    """Saves checkpoints to disk in a background thread.
+
+    Checkpoints are saved either as .npz files, or in the raw format, in
+    which the distributions are stored as aligned binary blobs in a .raw
+    file, described by a .json manifest.  Files in the raw format can be
+    memory-mapped when the checkpoint is restored.
+
+    With delta_every > 0, only every delta_every-th checkpoint contains
+    complete distributions.  The remaining ones only store blocks of the
+    distributions which changed by more than tolerance since the last
+    full checkpoint, together with the name and the unique ID of that
+    checkpoint.  Deltas are only valid with the full checkpoint they were
+    computed against, so they are removed when that checkpoint is
+    overwritten.
+    """
+    block_size = 4096
+    #: Alignment (in bytes) of the distribution arrays in raw files.
+    alignment = 4096
+
+    def __init__(self, delta_every=0, tolerance=0.0, fmt='npz'):
+        if fmt not in ('npz', 'raw'):
+            raise ValueError('Unsupported checkpoint format: {0}'.format(fmt))
+        if fmt == 'raw' and delta_every > 0:
+            raise ValueError('Delta checkpoints are only supported in the '
+                             'npz format.')
+        self.delta_every = delta_every
+        self.tolerance = tolerance
+        self.fmt = fmt
+        self._queue = None
+        self._num_saved = 0
+        # Name, ID and distributions of the last full checkpoint.
+        self._base = None
+        # Delta checkpoints computed against the last full checkpoint.
+        self._deltas = []
+
+    def next_is_full(self):
+        return self.delta_every <= 0 or self._num_saved % self.delta_every == 0
+
+    def save(self, fname, state, dists, info=None):
+        """Queues a checkpoint for saving.
+
+        :param fname: checkpoint file name, without the suffix
+        :param state: pickled state of the simulation
+        :param dists: dict of distribution arrays; the arrays must not be
+            modified until wait() returns
+        :param info: dict of JSON-serializable values describing the
+            subdomain, saved in the manifest of raw checkpoints and as
+            a JSON string in npz checkpoints
+        """
+        # As in NPYOutput, the thread is started lazily in the process
+        # which saves the data.
+        if self._queue is None:
+            self._queue = Queue()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        self._queue.put((fname, state, dists, self.next_is_full(), info))
+        self._num_saved += 1
+
+    def wait(self):
+        """Waits for all queued checkpoints to be saved."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self._write(*args)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, fname, state, dists, full, info):
+        if self.fmt == 'raw':
+            self._write_raw(fname, state, dists, info)
+            return
+
+        fname += '.npz'
+        data = {'state': state}
+        if info is not None:
+            data['info'] = json.dumps(info, sort_keys=True)
+        if full:
+            data.update(dists)
+            if self.delta_every > 0:
+                # With --single_checkpoint, a full checkpoint replaces the
+                # base of the existing deltas.
+                if (self._base is not None and
+                        self._base[0] == os.path.basename(fname)):
+                    for delta in self._deltas:
+                        if os.path.exists(delta):
+                            os.remove(delta)
+                self._deltas = []
+                data['checkpoint_id'] = uuid.uuid4().hex
+                self._base = (os.path.basename(fname), data['checkpoint_id'],
+                              dict((k, v.copy()) for k, v in dists.items()))
+        else:
+            base_name, base_id, base = self._base
+            data['base'] = base_name
+            data['base_id'] = base_id
+            if fname not in self._deltas:
+                self._deltas.append(fname)
+            for k, v in dists.items():
+                cur = _block_view(v.ravel(), self.block_size)
+                prev = _block_view(base[k].ravel(), self.block_size)
+                with np.errstate(invalid='ignore'):
+                    same = np.abs(cur - prev) <= self.tolerance
+                # Unused nodes can contain NaNs.
+                same |= np.isnan(cur) & np.isnan(prev)
+                changed = np.nonzero(np.logical_not(np.all(same, axis=1)))[0]
+                data[k] = cur[changed]
+                data[k + '_blocks'] = changed.astype(np.uint32)
+
+        # Save to a temporary file first so that an interrupted write
+        # never replaces a valid checkpoint.
+        tfname = temp_filename(fname)
+        np.savez(tfname, **data)
+        os.rename(tfname, fname)
+
+    def _write_raw(self, fname, state, dists, info):
+        data_fname = fname + '.raw'
+        arrays = {}
+        offset = 0
+        tfname = temp_filename(data_fname)
+        with open(tfname, 'wb') as f:
+            for name in sorted(dists.keys()):
+                v = dists[name]
+                offset = (offset + self.alignment - 1) // self.alignment * self.alignment
+                f.seek(offset)
+                v.tofile(f)
+                arrays[name] = {'offset': offset, 'shape': list(v.shape),
+                                'dtype': v.dtype.str}
+                offset += v.nbytes
+        os.rename(tfname, data_fname)
+
+        # The manifest is saved last and marks the checkpoint as complete.
+        manifest = dict(info or {})
+        manifest.update({
+            'version': 1,
+            'data': os.path.basename(data_fname),
+            'arrays': arrays,
+            'state': base64.b64encode(state).decode('ascii')})
+        manifest_fname = fname + '.json'
+        tfname = temp_filename(manifest_fname)
+        with open(tfname, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tfname, manifest_fname)
+
+
+def load_checkpoint(fname):
+    """Loads a checkpoint saved by CheckpointWriter.
+
+    :returns: tuple of: pickled simulation state, dict of distribution arrays
+    """
+    cpoint = np.load(fname)
+    base = None
+    if 'base' in cpoint.files:
+        base = np.load(os.path.join(os.path.dirname(fname),
+                                    str(cpoint['base'])))
+        if ('base_id' in cpoint.files and
+                ('checkpoint_id' not in base.files or
+                 str(base['checkpoint_id']) != str(cpoint['base_id']))):
+            raise ValueError('Delta checkpoint {0} does not match its base '
+                             'checkpoint {1}.'.format(fname,
+                                                      str(cpoint['base'])))
+
+    dists = {}
+    for k in cpoint.files:
+        if not k.startswith('dist') or k.endswith('_blocks'):
+            continue
+        if base is None:
+            dists[k] = cpoint[k]
+        else:
+            prev = base[k]
+            blocks = _block_view(prev.ravel(), cpoint[k].shape[1])
+            blocks[cpoint[k + '_blocks']] = cpoint[k]
+            dists[k] = blocks.ravel()[:prev.size].reshape(prev.shape).copy()
+
+    return cpoint['state'], dists
+
+
+def load_checkpoint_info(fname):
+    """Loads the description of the subdomain saved with a checkpoint in
+    the npz format.
+
+    :returns: dict passed as info to CheckpointWriter.save(), empty if the
+        checkpoint does not contain it
+    """
+    cpoint = np.load(fname)
+    if 'info' not in cpoint.files:
+        return {}
+    return json.loads(str(cpoint['info']))
+
+
+def load_checkpoint_manifests(fname):
+    """Loads the manifests of all subdomains of a raw checkpoint.
+
+    :param fname: name of the manifest of any subdomain in the checkpoint
+    :returns: list of manifest dicts, with the pickled simulation state
+        stored in 'state' and the location of the data file in 'path'
+    """
+    pattern = re.sub(r'\.[0-9]+\.cpoint\.json$', '.*.cpoint.json', fname)
+    dirname = os.path.dirname(fname)
+    manifests = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        manifest['state'] = base64.b64decode(manifest['state'])
+        manifest['path'] = os.path.join(dirname, manifest['data'])
+        manifests.append(manifest)
+    return manifests
+
+
+def checkpoint_array(manifest, name):
+    """Memory-maps a distribution array from a raw checkpoint."""
+    desc = manifest['arrays'][name]
+    return np.memmap(manifest['path'], dtype=np.dtype(str(desc['dtype'])),
+                     mode='r', offset=desc['offset'],
+                     shape=tuple(desc['shape']))
+
+
 class NPYOutput(LBOutput):
     """Saves simulation data as np arrays."""
     format_name = 'npy'
@@ -342,9 +990,319 @@ class NPYOutput(LBOutput):
         self._queue.join()
 
 
+class _StreamFileGroup(object):
+    """Memory-mapped files holding consecutive snapshots of all fields."""
+
+    def __init__(self, manifest, arrays, capacity):
+        self.manifest = manifest
+        self.arrays = arrays
+        self.capacity = capacity
+        self.used = 0
+        # List of (iteration, slot) pairs for completely written snapshots.
+        self.snapshots = []
+
+
+class NPYStreamOutput(LBOutput):
+    """Streams simulation data to memory-mapped .npy files.
+
+    Every field of a subdomain is saved in a preallocated .npy file holding
+    a series of snapshots, with the snapshot index as the first dimension.
+    Snapshots are written from a thread pool, and a JSON manifest listing
+    the completely written snapshots is updated after every one of them.
+    """
+    format_name = 'npy_stream'
+    num_threads = 4
+
+    def __init__(self, config, subdomain_id):
+        LBOutput.__init__(self, config, subdomain_id)
+        self.digits = filename_iter_digits(config.max_iters)
+        self.capacity = config.output_snapshots_per_file
+        if self.capacity <= 0:
+            if config.max_iters > 0:
+                self.capacity = config.max_iters // config.every + 1
+            else:
+                self.capacity = 100
+        self._pool = None
+        self._group = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _new_group(self, i):
+        def _fname(suffix):
+            return filename(self.basename, self.digits, self.subdomain_id, i,
+                            suffix=suffix)
+
+        arrays = {}
+        for name, field in self._scalar_fields.items():
+            arrays[name] = np.lib.format.open_memmap(
+                _fname('.{0}.npy'.format(name)), mode='w+', dtype=field.dtype,
+                shape=(self.capacity,) + field.shape)
+        for name, field in self._vector_fields.items():
+            arrays[name] = np.lib.format.open_memmap(
+                _fname('.{0}.npy'.format(name)), mode='w+',
+                dtype=field[0].dtype,
+                shape=(self.capacity, len(field)) + field[0].shape)
+        return _StreamFileGroup(_fname('.json'), arrays, self.capacity)
+
+    def _write(self, group, snapshot, slot, target, field):
+        target[slot] = field
+        with self._lock:
+            snapshot[1] -= 1
+            if snapshot[1] > 0:
+                return
+            for array in group.arrays.values():
+                array.flush()
+            group.snapshots.append((snapshot[0], slot))
+            group.snapshots.sort()
+            manifest = {
+                'capacity': group.capacity,
+                'fields': dict((name, os.path.basename(array.filename))
+                               for name, array in group.arrays.items()),
+                'snapshots': group.snapshots,
+            }
+            tfname = temp_filename(group.manifest)
+            with open(tfname, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tfname, group.manifest)
+
+    def save(self, i):
+        self.mask_nonfluid_nodes()
+        # As in NPYOutput, the pool is created lazily in the process which
+        # saves the data.
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+        if self._group is None or self._group.used == self._group.capacity:
+            self._group = self._new_group(i)
+
+        group = self._group
+        slot = group.used
+        group.used += 1
+
+        tasks = []
+        for name, field in self._scalar_fields.items():
+            tasks.append((group.arrays[name], field))
+        for name, field in self._vector_fields.items():
+            for j, component in enumerate(field):
+                tasks.append((group.arrays[name][:, j], component))
+
+        # Iteration and number of writes remaining to complete the snapshot.
+        snapshot = [i, len(tasks)]
+        for target, field in tasks:
+            self._pending.append(self._pool.apply_async(
+                self._write, (group, snapshot, slot, target, field)))
+
+    def dump_dists(self, dists, i):
+        fname = dists_filename(self.basename, self.digits, self.subdomain_id, i)
+        np.savez(fname, *dists)
+
+    def dump_node_type(self, node_type_map):
+        fname = node_type_filename(self.basename, self.subdomain_id)
+        np.save(fname, node_type_map)
+
+    def wait(self):
+        for result in self._pending:
+            # Reraises any exception from the writer threads.
+            result.get()
+        self._pending = []
+
+
+def load_npy_stream(manifest_fname):
+    """Loads snapshots saved by NPYStreamOutput.
+
+    :param manifest_fname: name of the JSON manifest of a file series
+    :returns: tuple of: list of iterations, dict mapping field names to
+        arrays of the corresponding snapshots
+    """
+    with open(manifest_fname, 'r') as f:
+        manifest = json.load(f)
+    dirname = os.path.dirname(manifest_fname)
+    iterations = [it for it, _ in manifest['snapshots']]
+    slots = [slot for _, slot in manifest['snapshots']]
+    fields = {}
+    for name, fname in manifest['fields'].items():
+        fields[name] = np.load(os.path.join(dirname, fname),
+                               mmap_mode='r')[slots]
+    return iterations, fields
+
+
+def _compress_chunk(data, compressor):
+    if compressor == 'blosc':
+        cname = 'zstd' if 'zstd' in blosc.compressor_list() else 'lz4'
+        return blosc.compress(data.tobytes(), typesize=data.dtype.itemsize,
+                              clevel=5, shuffle=blosc.SHUFFLE, cname=cname)
+    elif compressor == 'zlib':
+        return zlib.compress(data.tobytes(), 1)
+    return data.tobytes()
+
+
+def _decompress_chunk(buf, compressor):
+    if compressor == 'blosc':
+        if blosc is None:
+            raise ValueError('blosc is required to read this file.')
+        return blosc.decompress(buf)
+    elif compressor == 'zlib':
+        return zlib.decompress(buf)
+    return buf
+
+
+class ChunkedOutput(LBOutput):
+    """Saves simulation data in a chunked store with compressed chunks.
+
+    Every snapshot is a directory representing the global lattice.  Each
+    subdomain splits its part of every field into chunks, which are
+    compressed and written in parallel to separate files, and then saves
+    an index of its chunks as a JSON file.  Use read_chunked() to read
+    any region of a field from the store.
+    """
+    format_name = 'chunked'
+    supports_downsampling = False
+    num_threads = 4
+
+    def __init__(self, config, subdomain_id):
+        LBOutput.__init__(self, config, subdomain_id)
+        self.digits = filename_iter_digits(config.max_iters)
+        self.chunk_size = config.output_chunk_size
+        if not config.output_compress:
+            self.compressor = None
+        elif blosc is not None:
+            self.compressor = 'blosc'
+        else:
+            self.compressor = 'zlib'
+        self._pool = None
+        self._location = None
+        self._global_size = None
+
+    def _chunks(self, shape):
+        """Yields the origin and slices of every chunk of an array."""
+        ranges = [range(0, n, self.chunk_size) for n in shape]
+        for origin in np.ndindex(*[len(r) for r in ranges]):
+            start = [r[i] for r, i in zip(ranges, origin)]
+            yield start, tuple(slice(s, min(s + self.chunk_size, n)) for s, n
+                               in zip(start, shape))
+
+    def _write_chunk(self, fname, data):
+        with open(fname, 'wb') as f:
+            f.write(_compress_chunk(np.ascontiguousarray(data),
+                                    self.compressor))
+
+    def save(self, i):
+        self.mask_nonfluid_nodes()
+        # As in NPYOutput, the pool is created lazily in the process which
+        # saves the data.
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+
+        dirname = merged_filename(self.basename, self.digits, i,
+                                  suffix='.chunks')
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+        # Location and size of the global lattice in array order.
+        offset = list(reversed(self._location))
+        gsize = list(reversed(self._global_size))
+
+        fields = []
+        for name, field in self._scalar_fields.items():
+            fields.append((name, field, []))
+        for name, field in self._vector_fields.items():
+            fields.append((name, np.array(field), [len(field)]))
+
+        index = {}
+        tasks = []
+        for name, field, components in fields:
+            chunks = []
+            spatial = field.shape[len(components):]
+            for n, (start, sl) in enumerate(self._chunks(spatial)):
+                fname = '{0}.{1}.{2}'.format(name, self.subdomain_id, n)
+                chunks.append({
+                    'file': fname,
+                    'origin': [o + s for o, s in zip(offset, start)],
+                    'shape': [x.stop - x.start for x in sl]})
+                sl = (slice(None),) * len(components) + sl
+                tasks.append((os.path.join(dirname, fname), field[sl]))
+            index[name] = {
+                'dtype': field.dtype.str,
+                'shape': components + gsize,
+                'compressor': self.compressor,
+                'chunks': chunks}
+
+        self._pool.map(lambda args: self._write_chunk(*args), tasks)
+
+        # The index is saved last and marks the data of the subdomain
+        # as complete.
+        fname = os.path.join(dirname, '{0}.json'.format(self.subdomain_id))
+        tfname = temp_filename(fname)
+        with open(tfname, 'w') as f:
+            json.dump(index, f)
+        os.rename(tfname, fname)
+
+    def dump_dists(self, dists, i):
+        fname = dists_filename(self.basename, self.digits, self.subdomain_id, i)
+        np.savez(fname, *dists)
+
+    def dump_node_type(self, node_type_map):
+        fname = node_type_filename(self.basename, self.subdomain_id)
+        np.save(fname, node_type_map)
+
+
+def read_chunked(dirname, field, region=None):
+    """Reads a field from a store saved by ChunkedOutput.
+
+    Only the chunks overlapping the requested region are read.
+
+    :param dirname: directory of the snapshot
+    :param field: name of the field
+    :param region: tuple of slices (with unit step) selecting the spatial
+        region to read, in array order ([z,] y, x); the whole lattice is
+        read if not specified
+    :returns: numpy array, with nodes not covered by any subdomain set to NaN
+        (0 for integer and boolean fields);
+        the components of vector fields are stored along the first axis
+    """
+    index = []
+    for fname in sorted(glob.glob(os.path.join(dirname, '*.json'))):
+        with open(fname, 'r') as f:
+            index.append(json.load(f)[field])
+    if not index:
+        raise ValueError('No data found in {0}'.format(dirname))
+
+    info = index[0]
+    shape = info['shape']
+    dim = len(index[0]['chunks'][0]['origin'])
+    components = shape[:len(shape) - dim]
+    if region is None:
+        region = tuple(slice(0, n) for n in shape[-dim:])
+    region = [slice(*sl.indices(n)[:2]) for sl, n in zip(region, shape[-dim:])]
+
+    out = np.empty(components + [sl.stop - sl.start for sl in region],
+                   dtype=np.dtype(str(info['dtype'])))
+    out[:] = _missing_value(out.dtype)
+    for info in index:
+        for chunk in info['chunks']:
+            lo = [max(sl.start, o) for sl, o in zip(region, chunk['origin'])]
+            hi = [min(sl.stop, o + n) for sl, o, n in
+                  zip(region, chunk['origin'], chunk['shape'])]
+            if any(l >= h for l, h in zip(lo, hi)):
+                continue
+            with open(os.path.join(dirname, chunk['file']), 'rb') as f:
+                buf = _decompress_chunk(f.read(), info['compressor'])
+            data = np.frombuffer(buf, dtype=out.dtype).reshape(
+                components + chunk['shape'])
+            src = tuple(slice(l - o, h - o) for l, h, o in
+                        zip(lo, hi, chunk['origin']))
+            dst = tuple(slice(l - sl.start, h - sl.start) for l, h, sl in
+                        zip(lo, hi, region))
+            out[(Ellipsis,) + dst] = data[(Ellipsis,) + src]
+    return out
+
+
 class MatlabOutput(LBOutput):
     """Saves simulation data as Matlab .mat files."""
     format_name = 'mat'
+    supports_half_precision = False
 
     def __init__(self, config, subdomain_id):
         LBOutput.__init__(self, config, subdomain_id)
@@ -366,7 +1324,189 @@ class MatlabOutput(LBOutput):
         scipy.io.savemat(fname, dists[0])
 
 
-_OUTPUTS = [NPYOutput, VTKOutput, MatlabOutput]
+def load_npz_member(fname, name):
+    """Loads an array from a .npz file.
+
+    Arrays stored without compression are memory-mapped.
+    """
+    with zipfile.ZipFile(fname) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(fname)[name]
+
+    with open(fname, 'rb') as f:
+        # Skip the local file header of the zip member.
+        f.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _find_digits(base, subdomain_id, it):
+    for digits in range(1, 10):
+        if os.path.exists(filename(base, digits, subdomain_id, it)):
+            return digits
+    raise ValueError('No output files found for iteration {0}.'.format(it))
+
+
+def output_iterations(base, subdomain_id=0):
+    """Returns a sorted list of iterations for which output files exist."""
+    pattern = re.compile(r'\.{0}\.([0-9]+)\.npz$'.format(subdomain_id))
+    iterations = []
+    for fname in glob.glob('{0}.{1}.*.npz'.format(base, subdomain_id)):
+        match = pattern.search(fname)
+        if match is not None:
+            iterations.append(int(match.group(1)))
+    return sorted(iterations)
+
+
+class SubdomainArray(object):
+    """Lazy view of a field from per-subdomain output files, which behaves
+    like an array covering the global lattice.
+
+    Slicing the object only reads data from the subdomains overlapping the
+    selected region.  Nodes not covered by any subdomain are NaNs (0 for
+    integer and boolean fields).  The components of vector fields are
+    stored along the first axis.
+    """
+
+    def __init__(self, base, it, field, subdomains=None, digits=None):
+        """
+        :param base: base name of the output files (--output)
+        :param it: iteration number
+        :param field: name of the field
+        :param subdomains: list of SubdomainSpec objects; read from the
+            .subdomains file if not specified
+        :param digits: number of digits used for the iteration number in
+            file names; detected automatically if not specified
+        """
+        if subdomains is None:
+            with open(subdomains_filename(base), 'rb') as f:
+                subdomains = pickle.load(f)
+        if digits is None:
+            digits = _find_digits(base, subdomains[0].id, it)
+
+        self.subdomains = subdomains
+        self.field = field
+        self._fnames = dict((s.id, filename(base, digits, s.id, it)) for s
+                            in subdomains)
+        self._members = {}
+
+        dim = subdomains[0].dim
+        spatial = [max(s.end_location[i] for s in subdomains) for i in
+                   reversed(range(dim))]
+        sample = self._member(subdomains[0])
+        self.shape = tuple(sample.shape[:sample.ndim - dim]) + tuple(spatial)
+        self.dtype = sample.dtype
+        self.ndim = len(self.shape)
+        self._dim = dim
+
+    def _member(self, subdomain):
+        if subdomain.id not in self._members:
+            self._members[subdomain.id] = load_npz_member(
+                self._fnames[subdomain.id], self.field)
+        return self._members[subdomain.id]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        ret = self[...]
+        return ret if dtype is None else ret.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = (key[:i] + (slice(None),) * (self.ndim - len(key) + 1) +
+                   key[i + 1:])
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError('too many indices')
+
+        num_components = self.ndim - self._dim
+        comp_key = key[:num_components]
+        comp_shape = np.empty(self.shape[:num_components])[comp_key].shape
+
+        # Requested global indices along every spatial axis, in array order.
+        indices = []
+        for k, n in zip(key[num_components:], self.shape[num_components:]):
+            if isinstance(k, slice):
+                indices.append(np.arange(*k.indices(n)))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += n
+                if not 0 <= k < n:
+                    raise IndexError('index out of bounds')
+                indices.append(np.array([k]))
+
+        out = np.empty(comp_shape + tuple(len(x) for x in indices),
+                       dtype=self.dtype)
+        out[:] = _missing_value(out.dtype)
+        for s in self.subdomains:
+            dst = []
+            src = []
+            for idx, lo, hi in zip(indices, reversed(s.location),
+                                   reversed(s.end_location)):
+                sel = np.nonzero((idx >= lo) & (idx < hi))[0]
+                dst.append(sel)
+                src.append(idx[sel] - lo)
+            if any(len(x) == 0 for x in dst):
+                continue
+            out[(Ellipsis,) + np.ix_(*dst)] = \
+                    self._member(s)[comp_key + np.ix_(*src)]
+
+        # Drop the axes selected with integers.
+        return out[(Ellipsis,) + tuple(slice(None) if isinstance(k, slice)
+                                       else 0 for k in key[num_components:])]
+
+
+def iter_subdomain_arrays(base, field, iterations=None, key=Ellipsis,
+                          subdomains=None):
+    """Iterates over a time series of a field saved in per-subdomain output
+    files.  The data for the next iteration is read in the background while
+    the current one is being processed.
+
+    :param iterations: list of iterations; all available iterations are
+        used if not specified
+    :param key: index selecting the part of the global lattice to read
+    :returns: generator of (iteration, array) tuples
+    """
+    if subdomains is None:
+        with open(subdomains_filename(base), 'rb') as f:
+            subdomains = pickle.load(f)
+    if iterations is None:
+        iterations = output_iterations(base, subdomains[0].id)
+    if not iterations:
+        return
+
+    def _read(it):
+        return SubdomainArray(base, it, field, subdomains)[key]
+
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(_read, (iterations[0],))
+        for i, it in enumerate(iterations):
+            data = pending.get()
+            if i + 1 < len(iterations):
+                pending = pool.apply_async(_read, (iterations[i + 1],))
+            yield it, data
+    finally:
+        pool.terminate()
+
+
+_OUTPUTS = [NPYOutput, NPYStreamOutput, ChunkedOutput, VTKOutput,
+            MatlabOutput]
 
 format_name_to_cls = {}
 for output_class in _OUTPUTS:
@@ -1,7 +1,7 @@
 """Base class for all lattice Boltzman simulations in Sailfish."""
 
 from collections import namedtuple
-from sailfish import sym, util
+from sailfish import sparse, sym, util
 from sailfish import node_type as nt
 
 import numpy as np
@@ -23,7 +23,10 @@ class LBMixIn(object):
     (LBSim descentant). These are:
         - aux_code
         - before_main_loop
+        - after_step
         - fields
+        - get_checkpoint_state, set_checkpoint_state: save and restore
+          data of the mix-in in checkpoints
     """
 
 
@@ -42,6 +45,11 @@ class LBSim(object):
     #  to use subdomain runner other than default.
     subdomain_runner = None
 
+    #: Set this to a class implementing the OutputPolicy interface (see
+    #  sailfish.output_policy) in order to control when output is saved.
+    #  The class is instantiated with the SubdomainRunner as its only argument.
+    output_policy = None
+
     #: How many layers of nearest neighbors nodes are required by the model.
     nonlocality = 0
 
@@ -69,6 +77,23 @@ class LBSim(object):
                            'direct (dense matrix of nodes), indirect ('
                            '(only active nodes have distributions; '
                            'slower, but saves memory for sparse domains)')
+        group.add_argument('--sparse_host_storage', action='store_true',
+                           default=False, help='With indirect node '
+                           'addressing, only keep host copies of the fields '
+                           'and of the geometry for the active nodes. Fields '
+                           'are then 1D arrays, initial_conditions() receives '
+                           '1D arrays of the coordinates of the active nodes, '
+                           'and dense arrays are only created for output.')
+        group.add_argument('--node_ordering', type=str, default='row_major',
+                           choices=sparse.NODE_ORDERINGS,
+                           help='Order of the active nodes in memory with '
+                           'indirect node addressing: row_major (as in the '
+                           'dense lattice), morton (Z-order curve), hilbert '
+                           '(Hilbert curve), blocked (tiles of block_size '
+                           'nodes along X). Space-filling curves keep nodes '
+                           'close on the lattice close in memory, which can '
+                           'be faster for sparse 3D geometries. Checkpoints '
+                           'can only be restored with the same ordering.')
         group.add_argument('--minimize_roundoff', action='store_true',
                            default=False, help='Tries to minimize round-off '
                            'errors by using a model that avoids adding O(1) '
@@ -89,6 +114,14 @@ class LBSim(object):
                            'tagging for node types that support it. This '
                            'effectively falls back to the more crude '
                            'orientation tagging.')
+        group.add_argument('--geometry_cache_dir', type=str, default='',
+                           help='directory to cache the processed geometry '
+                           'of the subdomains in; the cached geometry is '
+                           'reused when the simulation is run again with the '
+                           'same settings')
+        group.add_argument('--geometry_threads', type=int, default=0,
+                           help='number of threads to use for processing the '
+                           'geometry of a subdomain; 0 to use all CPUs')
 
     @classmethod
     def modify_config(cls, config):
@@ -230,7 +263,7 @@ class LBSim(object):
         else:
             return False
 
-    def need_sync_fields(self):
+    def need_sync_fields(self, output=None):
         """Indicates whether computation/transfer of macroscopic fields is requested.
 
         This is true if either data is to be output after the current step, or
@@ -240,12 +273,18 @@ class LBSim(object):
 
         Called from SubdomainRunner.main().
 
+        Args:
+          output: whether data is to be output after the current step; if
+            None, need_output() is used
+
         Returns:
           tuple of two boolean values; the first is True if synchronization of
           fields to the host is requested; the second is True if computation of
           macroscopic fields is requested.
         """
-        need_sync = self.need_sync_flag or self.need_output()
+        if output is None:
+            output = self.need_output()
+        need_sync = self.need_sync_flag or output
         need_fields = self.need_fields_flag or need_sync
         self.need_fields_flag = False
         self.need_sync_flag = False
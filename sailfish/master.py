@@ -9,17 +9,21 @@ __license__ = 'LGPL3'
 import atexit
 import ctypes
 import os
+import shutil
 import subprocess
 import tempfile
 import time
 
 import multiprocessing as mp
 from multiprocessing import Process, Event, Value
+import operator
+from functools import reduce
 
 import zmq
 
-from sailfish import subdomain_runner, util, io
-from sailfish.connector import ZMQSubdomainConnector, ZMQRemoteSubdomainConnector, CompressedZMQRemoteSubdomainConnector
+from sailfish import codegen, subdomain_runner, util, io
+from sailfish.connector import ZMQSubdomainConnector, ZMQRemoteSubdomainConnector, CompressedZMQRemoteSubdomainConnector, SharedMemorySubdomainConnector, DeltaCompressedZMQRemoteSubdomainConnector
+from sailfish.lb_base import LBMixIn, LBSim, ScalarField
 
 def _start_subdomain_runner(subdomain_spec, config, sim, num_subdomains,
         backend_class, gpu_id, output,
@@ -107,9 +111,15 @@ class LBMachineMaster(object):
         subdomain2gpu = {}
 
         try:
-            gpus = len(self.config.gpus)
-            for i, subdomain in enumerate(self.subdomain_specs):
-                subdomain2gpu[subdomain.id] = self.config.gpus[i % gpus]
+            # Assign the subdomains with the most active nodes first, every
+            # one to the least loaded GPU.  For subdomains of equal size,
+            # this is a round-robin assignment.
+            loads = [0] * len(self.config.gpus)
+            for subdomain in sorted(self.subdomain_specs,
+                                    key=lambda s: -s.num_active_nodes):
+                i = loads.index(min(loads))
+                loads[i] += subdomain.num_active_nodes
+                subdomain2gpu[subdomain.id] = self.config.gpus[i]
         except TypeError:
             for subdomain in self.subdomain_specs:
                 subdomain2gpu[subdomain.id] = 0
@@ -122,6 +132,31 @@ class LBMachineMaster(object):
         else:
             return ctypes.c_float
 
+    def _max_message_size(self, subdomain, nbid):
+        """Returns an upper bound on the size (in elements) of a single
+        message sent from subdomain to the subdomain nbid."""
+        num = lambda shape: reduce(operator.mul, shape, 1)
+        dists = 0
+        macro = 0
+        for face, cid in subdomain.connecting_subdomains():
+            if cid != nbid:
+                continue
+            for cpair in subdomain.get_connections(face, nbid):
+                dists += max(num(cpair.src.transfer_shape),
+                             num(cpair.src.local_transfer_shape))
+                macro += num(cpair.src.macro_transfer_shape)
+
+        # Scalar fields needed on the neighboring nodes are exchanged in
+        # separate messages.
+        fields = list(self.sim.fields())
+        for c in self.sim.__class__.mro()[1:]:
+            if (issubclass(c, LBMixIn) and hasattr(c, 'fields') and
+                not issubclass(c, LBSim)):
+                fields.extend(c.fields())
+        nn_fields = len([f for f in fields if type(f) is ScalarField and
+                         f.need_nn])
+        return max(dists * len(self.sim.grids), macro * nn_fields)
+
     def _init_connectors(self):
         """Creates subdomain connectors for all subdomains connections."""
         # A set to keep track which connections are already created.
@@ -159,10 +194,18 @@ class LBMachineMaster(object):
                             subdomain.id, nbid, size1, size2, face_str))
 
                 if nbid in local_subdomain_ids:
-                    c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype, (size1, size2),
-                                                             (subdomain.id, nbid))
+                    if self.config.local_connector == 'shm':
+                        nb = local_subdomain_map[nbid]
+                        c1, c2 = SharedMemorySubdomainConnector.make_pair(
+                            ctype, (self._max_message_size(subdomain, nbid),
+                                    self._max_message_size(nb, subdomain.id)),
+                            (subdomain.id, nbid))
+                        ipc_files.extend(c1.ipc_files + c2.ipc_files)
+                    else:
+                        c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype, (size1, size2),
+                                                                 (subdomain.id, nbid))
+                        ipc_files.append(c1.ipc_file)
                     subdomain.add_connector(nbid, c1)
-                    ipc_files.append(c1.ipc_file)
                     local_subdomain_map[nbid].add_connector(subdomain.id, c2)
                 else:
                     receiver = subdomain.id > nbid
@@ -170,7 +213,11 @@ class LBMachineMaster(object):
                         addr = "tcp://{0}".format(self._subdomain_addr_map[nbid])
                     else:
                         addr = "tcp://{0}".format(self._iface)
-                    if self.config.compress_intersubdomain_data:
+                    if self.config.delta_intersubdomain_data:
+                        c1 = DeltaCompressedZMQRemoteSubdomainConnector(addr,
+                                receiver=subdomain.id > nbid,
+                                keyframe_every=self.config.intersubdomain_keyframe_every)
+                    elif self.config.compress_intersubdomain_data:
                         c1 = CompressedZMQRemoteSubdomainConnector(addr,
                                 receiver=subdomain.id > nbid)
                     else:
@@ -244,6 +291,17 @@ class LBMachineMaster(object):
         sockets = []
         ipc_files = []
 
+        # Set up the code cache before starting the subdomain runners, which
+        # use private temporary directories.
+        share_dir = None
+        if self.config.use_code_cache:
+            self.config.code_cache_dir = codegen.code_cache_dir(self.config)
+        elif self.config.share_code and len(self.subdomain_specs) > 1:
+            # Identical subdomains have identical code, which is generated
+            # and compiled only once if a shared cache directory is available.
+            share_dir = tempfile.mkdtemp(prefix='sailfish-code-')
+            self.config._code_share_dir = share_dir
+
         # Create subdomain runners for all subdomains.
         for subdomain in self.subdomain_specs:
             output = output_initializer(subdomain)
@@ -286,20 +344,40 @@ class LBMachineMaster(object):
         for socket in sockets:
             socket.send_pyobj(ports)
 
-        if self._channel is not None and self.config.mode == 'benchmark':
-            for socket in sockets:
-                ti, min_ti, max_ti, num_nodes = socket.recv_pyobj()
-                self._channel.send((tuple(ti), tuple(min_ti), tuple(max_ti), num_nodes))
-                socket.send('ack')
-
-        # Wait for all subdomain runners to finish.
+        # Wait for all subdomain runners to finish, handling their requests
+        # in the meantime.
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        sum_requests = {}
         done_runners = set()
         while len(done_runners) != len(self.runners):
             for runner in self.runners:
                 if runner not in done_runners and not runner.is_alive():
                     done_runners.add(runner)
 
-            self._quit_event.wait(1)
+            for socket, _ in poller.poll(1000):
+                msg = socket.recv_pyobj()
+                if isinstance(msg, util.GlobalSumRequest):
+                    sum_requests[socket] = msg
+                    if len(sum_requests) == len(sockets):
+                        self._send_global_sums(sum_requests)
+                        sum_requests = {}
+                else:
+                    # Timing information, only sent here in cluster
+                    # simulations in the benchmark mode.
+                    ti, min_ti, max_ti, num_nodes, link_stats = msg
+                    self._channel.send((tuple(ti), tuple(min_ti), tuple(max_ti),
+                                        num_nodes, link_stats))
+                    socket.send('ack')
+
+            # The remaining runners would never get their sums.
+            if sum_requests and done_runners:
+                self.config.logger.error('Subdomain runner terminated while '
+                                         'other subdomains were waiting for '
+                                         'global sums.')
+                self._quit_event.set()
+
             if self._quit_event.is_set():
                 self.config.logger.info('Received termination request.')
                 time.sleep(0.5)
@@ -311,6 +389,28 @@ class LBMachineMaster(object):
         for ipcfile in ipc_files:
             os.unlink(ipcfile)
 
+        if share_dir is not None:
+            shutil.rmtree(share_dir, ignore_errors=True)
+
+    def _send_global_sums(self, requests):
+        """Replies to the GlobalSumRequests sent by all subdomain runners on
+        this machine.
+
+        :param requests: dict mapping runner sockets to requests
+        """
+        sums = util.global_sums(requests.values())
+        # In cluster simulations, the partial sums from all machines are
+        # combined by the controller.
+        if self._channel is not None:
+            iteration = min(r.iteration for r in requests.values())
+            self._channel.send(('global_sum', iteration, sums))
+            sums = self._channel.receive()
+        if sums is None:
+            self.config.logger.error('Global sums requested in different '
+                                     'iterations in different subdomains.')
+        for socket in requests:
+            socket.send_pyobj(sums)
+
     def run(self):
         self.config.logger.info('Machine master starting with PID {0} at {1}'.format(
             os.getpid(), time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())))
@@ -548,5 +548,17 @@ class LinearlyInterpolatedTimeSeries(Symbol):
         """Returns a hash of the underying data series."""
         return hashlib.sha1(self._data).digest()
 
+    def __reduce_ex__(self, protocol):
+        # Sympy reconstructs symbols from their names, which does not work
+        # here.  Used when caching the encoded geometry.
+        return (_unpickle_timeseries, (self._data, self._step_size,
+                                       self._offset))
+
+
+def _unpickle_timeseries(data, step_size, offset):
+    ret = LinearlyInterpolatedTimeSeries(data, step_size)
+    ret._offset = offset
+    return ret
+
 # Maps node type IDs to their classes.
 _NODE_TYPES = __init_node_type_list()
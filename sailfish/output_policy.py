@@ -0,0 +1,139 @@
+"""Policies deciding in which iterations the simulation output is saved."""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import math
+import numpy as np
+
+
+class OutputPolicy(object):
+    """Saves the output at regular intervals, as specified by the --every and
+    --from options (see LBSim.need_output()).
+
+    Used by SubdomainRunner.main().  output_candidate() is called before
+    every step.  If it returns True, the macroscopic fields are computed in
+    the step, and need_output() is called once the step is scheduled on the
+    compute device to make the final decision.
+
+    All subdomains have to save the output in the same iterations.
+    output_candidate() has to return the same value in all subdomains.
+    Unless synchronized is True, SubdomainRunner compares the decisions made by
+    need_output() in all subdomains, and saves the output in all of them if
+    any of them requested it.
+    """
+
+    #: Set to True if need_output() is guaranteed to return the same value in
+    #: all subdomains, e.g. because it is based on global data (see
+    #: SubdomainRunner.global_sum()).  Only used for custom policies.
+    synchronized = False
+
+    def __init__(self, runner):
+        self._runner = runner
+
+    def start(self):
+        """Called once the initial state of the simulation is set, either
+        from the initial conditions or from a checkpoint."""
+        pass
+
+    def output_candidate(self):
+        """Returns True if the output might be saved after the current step."""
+        return self._runner._sim.need_output()
+
+    def need_output(self):
+        """Returns True if the output is to be saved after the current step.
+
+        Only called in steps for which output_candidate() returned True.
+        """
+        return True
+
+    def output_saved(self):
+        """Called after the output was saved."""
+        pass
+
+
+class ChangeDrivenOutputPolicy(OutputPolicy):
+    """Saves the output only if the flow changed since the last saved
+    snapshot, or if too many iterations elapsed since then.
+
+    The change is measured as the root mean square of the magnitude of the
+    velocity difference at the fluid nodes of all subdomains.  The sums of
+    squares are computed on the compute device and combined using
+    SubdomainRunner.global_sum(), so that all subdomains save the same
+    iterations.  The change is only checked in the iterations selected by the
+    --every and --from options.
+    """
+    synchronized = True
+
+    def __init__(self, runner, threshold, max_interval=0):
+        """
+        :param runner: SubdomainRunner instance
+        :param threshold: minimum RMS change of the velocity (in lattice
+            units) for which the output is saved
+        :param max_interval: if > 0, the output is saved when at least this
+            many iterations elapsed since the last snapshot, regardless of
+            the change of the flow
+        """
+        super(ChangeDrivenOutputPolicy, self).__init__(runner)
+        if threshold <= 0.0:
+            raise ValueError('The flow change threshold has to be positive.')
+        if not hasattr(runner._sim, 'v'):
+            raise ValueError('Change-driven output requires a simulation '
+                             'with a velocity field.')
+
+        self.threshold = threshold
+        self.max_interval = max_interval
+        #: RMS velocity change computed at the last check.
+        self.last_change = None
+        self._last_output = runner._sim.iteration
+
+        backend = runner.backend
+        gpu_v = runner.gpu_field(runner._sim.v)
+        if runner.config.node_addressing == 'indirect':
+            shape = (runner._subdomain.active_nodes,)
+        else:
+            shape = tuple(runner._physical_size)
+
+        gpu_snap = [backend.alloc_buf(like=np.zeros(shape, dtype=runner.float))
+                    for _ in gpu_v]
+        gpu_change = backend.alloc_buf(like=np.zeros(shape, dtype=runner.float),
+                                       wrap_in_array=True)
+
+        args, signature = runner._add_indirect_args(
+            [runner.gpu_geo_map()] + gpu_v + gpu_snap + [gpu_change],
+            'P' * (2 * len(gpu_v) + 2))
+        self._change_kernel = runner.get_kernel('ComputeVelocityChange', args,
+                                                signature)
+        args, signature = runner._add_indirect_args(gpu_v + gpu_snap,
+                                                    'P' * (2 * len(gpu_v)))
+        self._store_kernel = runner.get_kernel('StoreVelocitySnapshot', args,
+                                               signature)
+        self._sum_change = backend.get_reduction_kernel('a+b', 'x0[i]', '0',
+                                                        gpu_change)
+        self._num_nodes = runner._subdomain.num_fluid_nodes
+
+    def start(self):
+        # Use the initial state as the reference snapshot.
+        self.output_saved()
+
+    def need_output(self):
+        runner = self._runner
+        if (self.max_interval > 0 and
+                runner._sim.iteration - self._last_output >= self.max_interval):
+            return True
+
+        runner.backend.run_kernel(self._change_kernel,
+                                  runner._kernel_grid_full,
+                                  runner._calc_stream)
+        runner.backend.sync_stream(runner._data_stream, runner._calc_stream)
+        sum_sq, num_nodes = runner.global_sum([float(self._sum_change()),
+                                               self._num_nodes])
+        self.last_change = math.sqrt(sum_sq / max(num_nodes, 1))
+        return self.last_change >= self.threshold
+
+    def output_saved(self):
+        runner = self._runner
+        runner.backend.run_kernel(self._store_kernel, runner._kernel_grid_full,
+                                  runner._calc_stream)
+        self._last_output = runner._sim.iteration
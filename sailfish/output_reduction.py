@@ -0,0 +1,235 @@
+"""Reduction of macroscopic fields on the compute device prior to output.
+
+Every output field can be independently:
+ - downsampled by averaging over blocks of 2^dim, 4^dim or 8^dim nodes,
+ - averaged in time over all samples taken since the previous output,
+ - converted to half precision floating point numbers.
+
+The reduction is done on the compute device, so that only the reduced fields
+are transferred to the host and saved.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import math
+import numpy as np
+
+from sailfish.util import block_sum
+
+#: Supported linear sizes of the blocks used for downsampling.
+DOWNSAMPLING_FACTORS = (2, 4, 8)
+
+
+class FieldReduction(object):
+    """Describes how a single output field is reduced."""
+
+    def __init__(self, factor=1, average=False, half=False):
+        self.factor = factor
+        self.average = average
+        self.half = half
+
+    def __eq__(self, other):
+        return (isinstance(other, FieldReduction) and
+                (self.factor, self.average, self.half) ==
+                (other.factor, other.average, other.half))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'FieldReduction(factor={0}, average={1}, half={2})'.format(
+            self.factor, self.average, self.half)
+
+    @property
+    def trivial(self):
+        return self.factor == 1 and not self.average and not self.half
+
+
+def parse_output_reduction(spec):
+    """Parses the value of the --output_reduce option.
+
+    The option is a comma-separated list of field:ops entries, where ops
+    is a '+'-separated list of reduction operations:
+     - avg2, avg4, avg8: downsampling by block averaging,
+     - mean: time averaging,
+     - f16: conversion to half precision.
+
+    The entry for the '*' field applies to all fields not explicitly listed,
+    e.g. '*:f16,v:avg2+mean'.
+
+    :rvalue: dict mapping field names to FieldReduction objects
+    """
+    ret = {}
+    if not spec:
+        return ret
+
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, ops = entry.partition(':')
+        if not name or not ops:
+            raise ValueError('Invalid output reduction "{0}". Use '
+                             'field:op[+op...].'.format(entry))
+        red = FieldReduction()
+        for op in ops.split('+'):
+            if op == 'mean':
+                red.average = True
+            elif op == 'f16':
+                red.half = True
+            elif (op.startswith('avg') and op[3:].isdigit() and
+                  int(op[3:]) in DOWNSAMPLING_FACTORS):
+                red.factor = int(op[3:])
+            else:
+                raise ValueError('Unsupported output reduction "{0}" for '
+                                 'field "{1}".'.format(op, name))
+        ret[name] = red
+    return ret
+
+
+class _ReducedComponent(object):
+    """Device and host buffers of a single reduced scalar field."""
+
+    def __init__(self, reduce_kernel, pack_kernel, grid, transfer_buf,
+                 average):
+        self.reduce_kernel = reduce_kernel
+        self.pack_kernel = pack_kernel
+        self.grid = grid
+        self.transfer_buf = transfer_buf
+        self.average = average
+
+
+class OutputReductionStage(object):
+    """Reduces output fields on the compute device.
+
+    The reduced fields replace the original ones in the output.  Fields that
+    are averaged in time are sampled every average_every iterations and
+    the average is reset after every output.
+    """
+
+    def __init__(self, runner, fields, reductions, average_every=1):
+        """
+        :param runner: SubdomainRunner instance
+        :param fields: dict mapping names of output fields to host fields
+            (arrays for scalar fields, lists of arrays for vector fields)
+        :param reductions: dict mapping field names to FieldReduction
+            objects, as returned by parse_output_reduction()
+        :param average_every: sampling interval for time averages
+        """
+        if average_every <= 0:
+            raise ValueError('The sampling interval for time averages has to '
+                             'be positive.')
+
+        unknown = set(reductions.keys()) - set(fields.keys()) - set(['*'])
+        if unknown:
+            raise ValueError('Output reduction requested for unknown fields: '
+                             '{0}. Available fields: {1}.'.format(
+                                 ', '.join(sorted(unknown)),
+                                 ', '.join(sorted(fields.keys()))))
+
+        self.average_every = average_every
+        self._runner = runner
+        self._components = []
+        #: Number of the current sample in the time averaging window.
+        self._count = 0
+        self._averaged = False
+        #: IDs of the host fields replaced by reduced fields in the output.
+        self.field_ids = set()
+
+        output = runner._output
+        fluid_map = runner._subdomain.fluid_map()
+        default = reductions.get('*')
+        for name in sorted(fields.keys()):
+            red = reductions.get(name, default)
+            if red is None or red.trivial:
+                continue
+            if red.factor > 1 and not output.supports_downsampling:
+                raise ValueError('Downsampling of output fields is not '
+                                 'supported with the selected output format '
+                                 'or mode.')
+            if red.half and not output.supports_half_precision:
+                raise ValueError('Half precision output fields are not '
+                                 'supported with the selected output format.')
+
+            field = fields[name]
+            self.field_ids.add(id(field))
+            self._averaged = self._averaged or red.average
+            if type(field) is list:
+                hosts = [self._add_component(c, red)
+                         for c in runner.gpu_field(field)]
+            else:
+                hosts = self._add_component(runner.gpu_field(field), red)
+            output.register_field(hosts, name, fluid_map=block_sum(
+                fluid_map, red.factor, dtype=np.int32) > 0)
+
+    def _add_component(self, gpu_field, red):
+        runner = self._runner
+        backend = runner.backend
+        spec = runner._spec
+        # Size of the subdomain in array order ([z,] y, x).
+        size = list(reversed(spec.size))
+        shape = tuple((n + red.factor - 1) // red.factor for n in size)
+
+        acc = np.zeros(shape, dtype=runner.float)
+        gpu_acc = backend.alloc_buf(like=acc)
+        args = ([runner.gpu_geo_map(), gpu_field, gpu_acc, red.factor,
+                 spec.envelope_size] + list(reversed(size)) + [0])
+        signature = 'PPPii' + 'i' * len(size) + 'i'
+        args, signature = runner._add_indirect_args(args, signature)
+        reduce_kernel = runner.get_kernel('ReduceOutputField', args, signature)
+
+        bs = runner._kernel_block_size[0]
+        grid = [int(math.ceil(shape[-1] / float(bs))),
+                int(np.prod(shape[:-1]))]
+
+        if red.half:
+            host = np.zeros(shape, dtype=np.uint16)
+            transfer_buf = backend.alloc_buf(like=host)
+            pack_kernel = runner.get_kernel('PackOutputFieldHalf',
+                                            [gpu_acc, transfer_buf, shape[-1]],
+                                            'PPi')
+            host = host.view(np.float16)
+        else:
+            host = acc
+            transfer_buf = gpu_acc
+            pack_kernel = None
+
+        self._components.append(_ReducedComponent(
+            reduce_kernel, pack_kernel, grid, transfer_buf, red.average))
+        return host
+
+    def sample_due(self, iteration):
+        """Returns True if the fields have to be sampled after the step
+        starting at the given iteration, in addition to output steps."""
+        return self._averaged and (iteration + 1) % self.average_every == 0
+
+    def sample(self, output=False):
+        """Runs the reduction kernels.
+
+        Has to be called after a simulation step in which the macroscopic
+        fields were computed.
+
+        :param output: if True, the reduced fields are transferred to the
+            host and the time averages are reset
+        """
+        backend = self._runner.backend
+        stream = self._runner._calc_stream
+        self._count += 1
+        for comp in self._components:
+            # Fields which are not averaged in time are only sampled for
+            # output.
+            if not comp.average and not output:
+                continue
+            comp.reduce_kernel.args[-1] = self._count if comp.average else 1
+            backend.run_kernel(comp.reduce_kernel, comp.grid, stream)
+
+        if not output:
+            return
+
+        for comp in self._components:
+            if comp.pack_kernel is not None:
+                backend.run_kernel(comp.pack_kernel, comp.grid, stream)
+            backend.from_buf_async(comp.transfer_buf, stream)
+        self._count = 0
@@ -31,9 +31,12 @@ class TimeProfile(object):
 
     STEP = 13
 
+    # Collection of flow statistics (see sailfish.stats).
+    STATS = 14
+
     # This event needs to have the highest ID.
     # Square of total calculation time. Used for standard deviation.
-    STEP_SQ = 14
+    STEP_SQ = 15
 
     def __init__(self, runner):
         self._runner = runner
@@ -72,6 +75,7 @@ class TimeProfile(object):
                 net_wait=self._timings[self.NET_RECV] / mi,
                 recv=self._timings[self.RECV_DISTS] / mi,
                 send=self._timings[self.SEND_DISTS] / mi,
+                stats=self._timings[self.STATS] / mi,
                 total=self._timings[self.STEP] / mi,
                 total_sq=self._timings[self.STEP_SQ] / mi,
                 subdomain_id=self._runner._spec.id)
@@ -84,6 +88,7 @@ class TimeProfile(object):
                 net_wait=self._min_timings[self.NET_RECV],
                 recv=self._min_timings[self.RECV_DISTS],
                 send=self._min_timings[self.SEND_DISTS],
+                stats=self._min_timings[self.STATS],
                 total=self._min_timings[self.STEP],
                 total_sq=0.0,
                 subdomain_id=self._runner._spec.id)
@@ -96,6 +101,7 @@ class TimeProfile(object):
                 net_wait=self._max_timings[self.NET_RECV],
                 recv=self._max_timings[self.RECV_DISTS],
                 send=self._max_timings[self.SEND_DISTS],
+                stats=self._max_timings[self.STATS],
                 total=self._max_timings[self.STEP],
                 total_sq=0.0,
                 subdomain_id=self._runner._spec.id)
@@ -0,0 +1,242 @@
+"""Compact representation of the active nodes of a subdomain.
+
+With indirect node addressing, distributions and macroscopic fields are only
+stored for the active nodes of a subdomain, in compact (sparse) arrays.
+The SparseLattice class maps between these arrays and the dense arrays
+covering the whole subdomain.
+
+The order of the nodes in the compact arrays (see NODE_ORDERINGS) does not
+affect the results of the simulation, but it affects its speed: nodes close
+to each other on the lattice should also be close in memory.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import numpy as np
+
+#: Address of inactive nodes in the indirect address map.
+INVALID_NODE = 0xffffffff
+
+#: Supported orders of the nodes in the compact arrays:
+#:  - row_major: the order of the nodes in dense arrays
+#:  - morton: Morton (Z-order) curve
+#:  - hilbert: Hilbert curve
+#:  - blocked: tiles of block_size nodes along X and TILE_ROWS nodes along
+#:    the remaining axes, each ordered row-major
+NODE_ORDERINGS = ('row_major', 'morton', 'hilbert', 'blocked')
+
+#: Extent of the tiles of the 'blocked' ordering along the Y and Z axes.
+TILE_ROWS = 4
+
+
+def _curve_bits(shape):
+    """Returns the number of bits necessary to represent the coordinates."""
+    return max(1, int(np.ceil(np.log2(max(shape)))))
+
+
+def morton_keys(coords, bits):
+    """Returns the positions of nodes along the Morton (Z-order) curve.
+
+    :param coords: sequence of coordinate arrays, in array order ([z,] y, x)
+    :param bits: number of bits per coordinate
+    :rvalue: uint64 array of curve positions
+    """
+    dim = len(coords)
+    coords = [np.asarray(c).astype(np.uint64) for c in reversed(coords)]
+    key = np.zeros(coords[0].shape, dtype=np.uint64)
+    one = np.uint64(1)
+    for b in range(bits):
+        for i, c in enumerate(coords):
+            key |= ((c >> np.uint64(b)) & one) << np.uint64(b * dim + i)
+    return key
+
+
+def hilbert_keys(coords, bits):
+    """Returns the positions of nodes along the Hilbert curve.
+
+    Uses the algorithm from J. Skilling, "Programming the Hilbert curve",
+    AIP Conf. Proc. 707, 381 (2004).
+
+    :param coords: sequence of coordinate arrays, in array order ([z,] y, x)
+    :param bits: number of bits per coordinate
+    :rvalue: uint64 array of curve positions
+    """
+    x = [np.asarray(c).astype(np.uint64) for c in coords]
+    dim = len(x)
+
+    # Inverse undo of the rotations and reflections.
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        for i in range(dim):
+            upper = (x[i] & np.uint64(q)) != 0
+            x[0] = np.where(upper, x[0] ^ p, x[0])
+            t = np.where(upper, np.uint64(0), (x[0] ^ x[i]) & p)
+            x[0] ^= t
+            x[i] ^= t
+        q >>= 1
+
+    # Gray encoding.
+    for i in range(1, dim):
+        x[i] ^= x[i - 1]
+    t = np.zeros_like(x[0])
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((x[dim - 1] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    for i in range(dim):
+        x[i] ^= t
+
+    # Interleave the bits of the transposed index.
+    key = np.zeros(x[0].shape, dtype=np.uint64)
+    one = np.uint64(1)
+    for b in range(bits - 1, -1, -1):
+        for i in range(dim):
+            key = (key << one) | ((x[i] >> np.uint64(b)) & one)
+    return key
+
+
+def tile_keys(coords, tile_shape):
+    """Returns the positions of nodes in an order where the lattice is split
+    into tiles, with the tiles as well as the nodes within every tile ordered
+    row-major.
+
+    :param coords: sequence of coordinate arrays, in array order ([z,] y, x)
+    :param tile_shape: shape of the tiles, in array order
+    :rvalue: int64 array of positions
+    """
+    tiles = [np.asarray(c) // t for c, t in zip(coords, tile_shape)]
+    within = [np.asarray(c) % t for c, t in zip(coords, tile_shape)]
+    # Positions can be compared as (tile, position within tile) tuples.
+    tile_idx = np.ravel_multi_index(
+        tiles, [int(x.max()) + 1 if x.size else 1 for x in tiles])
+    within_idx = np.ravel_multi_index(within, tile_shape)
+    return tile_idx.astype(np.int64) * int(np.prod(tile_shape)) + within_idx
+
+
+class SparseLattice(object):
+    """Set of active nodes of a lattice.
+
+    The nodes are kept as a list of their flat (row-major) indices in the
+    dense lattice array, so that memory usage is proportional to the number
+    of active nodes.  The entries of compact arrays correspond to the nodes
+    in the same order.  Dense arrays are only created on request.
+    """
+
+    def __init__(self, shape, nodes):
+        """
+        :param shape: shape of the dense lattice array ([z,] y, x)
+        :param nodes: flat indices of the active nodes, in the order used
+            in compact arrays
+        """
+        self.shape = tuple(shape)
+        dtype = np.uint32 if np.prod(self.shape) < INVALID_NODE else np.int64
+        self.nodes = np.asarray(nodes).astype(dtype, copy=False)
+        # Sorted node indices and their positions in the compact arrays,
+        # built on the first call to address().
+        self._sorted_nodes = None
+        self._sorted_pos = None
+
+    @classmethod
+    def from_mask(cls, mask, ordering='row_major', block_size=None):
+        """Creates a lattice from a dense Boolean array (True for active
+        nodes).
+
+        :param ordering: order of the nodes in compact arrays, one of
+            NODE_ORDERINGS
+        :param block_size: extent of the tiles along X for the 'blocked'
+            ordering
+        """
+        nodes = np.flatnonzero(mask)
+        if ordering == 'row_major':
+            return cls(mask.shape, nodes)
+
+        coords = np.unravel_index(nodes, mask.shape)
+        if ordering == 'morton':
+            keys = morton_keys(coords, _curve_bits(mask.shape))
+        elif ordering == 'hilbert':
+            keys = hilbert_keys(coords, _curve_bits(mask.shape))
+        elif ordering == 'blocked':
+            if block_size is None:
+                raise ValueError('The blocked node ordering requires the '
+                                 'block size.')
+            tile = [TILE_ROWS] * (mask.ndim - 1) + [block_size]
+            keys = tile_keys(coords, tile)
+        else:
+            raise ValueError('Unsupported node ordering: {0}'.format(
+                ordering))
+        del coords
+        return cls(mask.shape, nodes[np.argsort(keys, kind='mergesort')])
+
+    @property
+    def size(self):
+        """Number of active nodes."""
+        return self.nodes.size
+
+    def mask(self):
+        """Returns a dense Boolean array, True for active nodes."""
+        ret = np.zeros(self.shape, dtype=np.bool_)
+        np.put(ret, self.nodes, True)
+        return ret
+
+    def coords(self):
+        """Returns a tuple of index arrays ([z,] y, x) of the active nodes,
+        in the order of the compact arrays."""
+        return np.unravel_index(self.nodes, self.shape)
+
+    def address(self, flat_idx):
+        """Returns the locations of nodes in the compact arrays.
+
+        :param flat_idx: flat indices of the nodes in the dense array
+        :rvalue: uint32 array of the same shape as flat_idx; INVALID_NODE
+            for inactive nodes
+        """
+        if self._sorted_nodes is None:
+            if np.all(self.nodes[1:] > self.nodes[:-1]):
+                self._sorted_nodes = self.nodes
+            else:
+                self._sorted_pos = np.argsort(self.nodes, kind='mergesort')
+                self._sorted_nodes = self.nodes[self._sorted_pos]
+
+        flat_idx = np.asarray(flat_idx)
+        pos = np.searchsorted(self._sorted_nodes, flat_idx)
+        found = pos < self.size
+        found[found] = self._sorted_nodes[pos[found]] == flat_idx[found]
+        if self._sorted_pos is not None:
+            pos = self._sorted_pos[np.where(found, pos, 0)]
+        return np.where(found, pos, INVALID_NODE).astype(np.uint32)
+
+    def address_map(self):
+        """Returns a dense uint32 array of the locations of the nodes in the
+        compact arrays (the indirect address map).  Inactive nodes are
+        marked with INVALID_NODE."""
+        ret = np.empty(self.shape, dtype=np.uint32)
+        ret.fill(INVALID_NODE)
+        np.put(ret, self.nodes, np.arange(self.size, dtype=np.uint32))
+        return ret
+
+    def gather(self, dense, out=None):
+        """Returns a compact array with the values of a dense array at the
+        active nodes.
+
+        :param dense: array of the shape of the lattice
+        :param out: optional compact array to store the values in
+        """
+        return np.take(dense, self.nodes, out=out)
+
+    def scatter(self, compact, out=None, fill=0):
+        """Returns a dense array with the values of a compact array at the
+        active nodes.
+
+        :param compact: array of values for the active nodes
+        :param out: optional dense array to store the values in; only
+            the active nodes are modified
+        :param fill: value for the inactive nodes of a newly created array
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=compact.dtype)
+            out.fill(fill)
+        np.put(out, self.nodes, compact)
+        return out
@@ -6,6 +6,7 @@ __license__ = 'LGPL3'
 
 import math
 from sailfish.lb_base import ScalarField, LBMixIn
+from sailfish.profile import TimeProfile
 import numpy as np
 
 class FlowStatsMixIn(LBMixIn):
@@ -53,23 +54,239 @@ class KineticEnergyEnstrophyMixIn(FlowStatsMixIn):
         return kinetic_energy, enstrophy
 
 
+class FieldStatsMixIn(FlowStatsMixIn):
+    """Accumulates the running mean and variance of macroscopic fields, and
+    covariances between pairs of them, at every node of the subdomain.
+
+    The statistics are updated on the compute device in double precision
+    using Welford's algorithm, and are saved in and restored from
+    checkpoints.  To use, call prepare_field_stats() from before_main_loop(),
+    and collect_field_stats() from after_step() in iterations in which the
+    macroscopic fields were computed (see LBSim.need_fields_flag).
+    """
+    aux_code = ['field_statistics.mako']
+
+    _fstats_restored = None
+
+    def prepare_field_stats(self, runner, fields, covariances=()):
+        """Allocates the accumulators.
+
+        :param fields: names of the scalar fields (attributes of the
+            simulation object, e.g. 'rho' or 'vx') for which to compute
+            the mean and variance
+        :param covariances: iterable of pairs of names of fields for which
+            to compute the covariance
+        """
+        covariances = [tuple(pair) for pair in covariances]
+        for name in set(sum(covariances, ())) - set(fields):
+            raise ValueError('Covariance requested for field "{0}" which is '
+                             'not accumulated.'.format(name))
+
+        self._fstats_fields = list(fields)
+        self._fstats_covariances = covariances
+        self._fstats_count = 0
+        self._fstats_host = {}
+        self._fstats_gpu = {}
+        self._fstats_kernels = []
+
+        gpu_map = runner.gpu_geo_map()
+        gpu_fields = dict((name, self._fstats_gpu_field(runner, name)) for
+                          name in fields)
+        if runner.config.node_addressing == 'indirect':
+            shape = (runner._subdomain.active_nodes,)
+        else:
+            shape = tuple(runner._physical_size)
+
+        def _alloc(name):
+            h = np.zeros(shape, dtype=np.float64)
+            self._fstats_host[name] = h
+            self._fstats_gpu[name] = runner.backend.alloc_buf(like=h)
+            return self._fstats_gpu[name]
+
+        mean = dict((f, _alloc('{0}_mean'.format(f))) for f in fields)
+
+        # Covariances use the means from the previous sample, so their
+        # kernels have to run first.
+        for f, g in covariances:
+            self._fstats_kernels.append(self._fstats_kernel(
+                runner, 'UpdateFieldCovariance',
+                [gpu_map, gpu_fields[f], gpu_fields[g], mean[f], mean[g],
+                 _alloc('{0}_{1}_cov'.format(f, g))], 'PPPPPP'))
+
+        for f in fields:
+            self._fstats_kernels.append(self._fstats_kernel(
+                runner, 'UpdateFieldMoments',
+                [gpu_map, gpu_fields[f], mean[f],
+                 _alloc('{0}_m2'.format(f))], 'PPPP'))
+
+        self._fstats_restore(runner)
+
+    def _fstats_gpu_field(self, runner, name):
+        field = getattr(self, name)
+        for scalar in runner._scalar_fields:
+            if scalar is field:
+                return runner.gpu_field(scalar)
+        for vector in runner._vector_fields:
+            for i, component in enumerate(vector):
+                if component is field:
+                    return runner.gpu_field(vector)[i]
+        raise ValueError('"{0}" is not a field of the simulation.'.format(
+            name))
+
+    def _fstats_kernel(self, runner, name, args, signature):
+        # The sample number is updated before every call.
+        args, signature = runner._add_indirect_args(args + [0],
+                                                    signature + 'i')
+        return runner.get_kernel(name, args, signature)
+
+    def _fstats_restore(self, runner):
+        state = self._fstats_restored
+        self._fstats_restored = None
+        if state is None:
+            return
+
+        spec = runner._spec
+        if (state['location'] != list(spec.location) or
+                state['size'] != list(spec.size) or
+                set(state['arrays'].keys()) != set(self._fstats_host.keys())):
+            runner.config.logger.warning(
+                'Field statistics in the checkpoint do not match the current '
+                'subdomain and will be reset.')
+            return
+
+        for name, h in self._fstats_host.items():
+            h[:] = state['arrays'][name]
+            runner.backend.to_buf(self._fstats_gpu[name])
+        self._fstats_count = state['count']
+
+    def collect_field_stats(self, runner):
+        """Updates the statistics with the current values of the fields."""
+        self._fstats_count += 1
+        for kernel in self._fstats_kernels:
+            kernel.args[-1] = self._fstats_count
+            runner.backend.run_kernel(kernel, runner._kernel_grid_full)
+
+    def reset_field_stats(self, runner):
+        """Discards all samples collected so far."""
+        self._fstats_count = 0
+        for name, h in self._fstats_host.items():
+            h[:] = 0.0
+            runner.backend.to_buf(self._fstats_gpu[name])
+
+    def _fstats_to_host(self, runner):
+        for name in self._fstats_host:
+            runner.backend.from_buf(self._fstats_gpu[name])
+
+    def field_stats(self, runner):
+        """Returns the current statistics.
+
+        :rvalue: dict with the number of samples ('count'), and double
+            precision arrays of the mean ('<f>_mean') and variance
+            ('<f>_var') of every field, and covariances ('<f>_<g>_cov') of
+            every pair of fields; non-fluid nodes are set to NaN
+        """
+        self._fstats_to_host(runner)
+        ret = {'count': self._fstats_count}
+        n = max(self._fstats_count, 1)
+
+        lattice = runner._subdomain.sparse_lattice
+        nonfluid = np.logical_not(runner._subdomain.fluid_map())
+        for name, h in self._fstats_host.items():
+            if lattice is not None:
+                h = lattice.scatter(h)
+            h = h[runner._spec._nonghost_slice]
+            if name.endswith('_mean'):
+                h = h.copy()
+            else:
+                # Sums of squared deviations and of products of deviations.
+                h = h / n
+                if name.endswith('_m2'):
+                    name = name[:-3] + '_var'
+            h[nonfluid] = np.nan
+            ret[name] = h
+        return ret
+
+    def get_checkpoint_state(self, runner):
+        self._fstats_to_host(runner)
+        return {
+            'count': self._fstats_count,
+            'location': list(runner._spec.location),
+            'size': list(runner._spec.size),
+            'arrays': dict((name, h.copy()) for name, h in
+                           self._fstats_host.items()),
+        }
+
+    def set_checkpoint_state(self, runner, state):
+        # The accumulators are only allocated in prepare_field_stats().
+        self._fstats_restored = state
+
+
+class ReynoldsStatsFuture(object):
+    """Results of a batch of Reynolds statistics which are being transferred
+    from the compute device to the host."""
+
+    def __init__(self, event, host_bufs, normalizer, iters):
+        self._event = event
+        self._host_bufs = host_bufs
+        self._normalizer = normalizer
+        self._iters = iters
+        self._result = None
+
+    def done(self):
+        """Returns True if the transfer is complete."""
+        return self._result is not None or self._event.query()
+
+    def result(self):
+        """Waits for the transfer to complete.
+
+        :rvalue: dict mapping names of the statistics to arrays of shape
+            (stat_buf_size, NX), and 'iters' to the list of iterations at
+            which the measurements were taken
+        """
+        if self._result is None:
+            self._event.synchronize()
+            # Divide the stats by this value to get an average over all nodes.
+            div = self._normalizer
+            self._result = dict((name, h / div) for name, h in
+                                self._host_bufs.items())
+            self._result['iters'] = self._iters
+            # The host buffers are reused for future batches.
+            self._host_bufs = None
+        return self._result
+
+
 class ReynoldsStatsMixIn(FlowStatsMixIn):
     """Computes statistics used to characterize turbulent flows:
     - first 4 moments of any quantity (velocity, density)
     - correlations between any 2 qauntities
+
+    The statistics are computed in a separate stream and stored in one of
+    two sets of buffers in GPU memory.  When a set is full, it is transferred
+    to the host asynchronously while the other set is being filled.
     """
     aux_code = ['reynolds_statistics.mako']
 
     #: Number of copies of the stats buffers to keep in GPU memory
-    #: between host syncs.
+    #: between host syncs.  Two sets of buffers of this size are allocated.
     stat_buf_size = 1024
 
     #: List of iterations at which measurements were taken.
     snapshot_iters = []
 
+    _reyn_stat_names = (['%s_m%d' % (f, m) for m in range(1, 5) for f in
+                         ('ux', 'uy', 'uz', 'rho')] +
+                        ['ux_uy', 'ux_uz', 'uy_uz', 'ux_rho', 'uy_rho',
+                         'uz_rho'])
+
     def prepare_reynolds_stats(self, runner, moments=True,
                                correlations=True,
-                               axis='x'):
+                               axis='x', callback=None):
+        """Allocates buffers and prepares the kernels.
+
+        :param callback: if not None, called with the dict of statistics
+            (see ReynoldsStatsFuture.result()) for every batch of
+            stat_buf_size samples, once it is available on the host
+        """
         if axis == 'x':
             NX = self.config.lat_nx
             normalizer = runner._spec.ny * runner._spec.nz
@@ -85,219 +302,214 @@ class ReynoldsStatsMixIn(FlowStatsMixIn):
         self._reyn_moments = moments
         self._reyn_corr = correlations
         self._reyn_normalizer = normalizer
+        self._reyn_callback = callback
         self._reyn_bytes = 0
-
-        def _alloc_stat_buf(name, helper_size, need_finalize):
-            h = np.zeros([self.stat_buf_size, NX], dtype=np.float64)
-            self._reyn_bytes += h.nbytes
-            setattr(self, 'stat_%s' % name, h)
-            setattr(self, 'gpu_stat_%s' % name, runner.backend.alloc_buf(like=h))
-
-            if need_finalize:
-                h = np.zeros([NX, helper_size], dtype=np.float64)
-                self._reyn_bytes += h.nbytes
-                setattr(self, 'stat_tmp_%s' % name, h)
-                setattr(self, 'gpu_stat_tmp_%s' % name, runner.backend.alloc_buf(like=h))
+        self._reyn_stream = runner.backend.make_stream()
+        self._reyn_copy_stream = runner.backend.make_stream()
+        # Index of the buffer set currently being filled.
+        self._reyn_set = 0
+        # Futures for the last transfer from every buffer set.
+        self._reyn_pending = [None, None]
+        self._reyn_undelivered = []
 
         lat_nx = runner._lat_size[-1]
-
-        # Buffers for moments of the hydrodynamic variables.
         cm_bs = 128   # block_size, keep in sync with template
-        self.stat_cm_grid_size = (NX + 2 + cm_bs - 1) / cm_bs
+        self.stat_cm_grid_size = (NX + 2 + cm_bs - 1) // cm_bs
         cm_finalize = lat_nx >= cm_bs and axis != 'x'
         self.cm_finalize = cm_finalize
-        for m in range(1, 5):
-            for f in 'ux', 'uy', 'uz', 'rho':
-                _alloc_stat_buf('%s_m%d' % (f, m), self.stat_cm_grid_size, cm_finalize)
-
-        # Buffer for correlations of hydrodynamic variables.
         corr_bs = 128    # block_size, keep in sync with template
-        self.stat_corr_grid_size = (NX + 2 + corr_bs - 1) / corr_bs
+        self.stat_corr_grid_size = (NX + 2 + corr_bs - 1) // corr_bs
         corr_finalize = lat_nx >= corr_bs and axis != 'x'
         self.corr_finalize = corr_finalize
-        _alloc_stat_buf('ux_uy', self.stat_corr_grid_size, corr_finalize)
-        _alloc_stat_buf('ux_uz', self.stat_corr_grid_size, corr_finalize)
-        _alloc_stat_buf('uy_uz', self.stat_corr_grid_size, corr_finalize)
-        _alloc_stat_buf('ux_rho', self.stat_corr_grid_size, corr_finalize)
-        _alloc_stat_buf('uy_rho', self.stat_corr_grid_size, corr_finalize)
-        _alloc_stat_buf('uz_rho', self.stat_corr_grid_size, corr_finalize)
+
+        # Buffers for partial results of the reductions.  These are only
+        # accessed from the stats stream and can be shared between sets.
+        gpu_tmp = {}
+        for name in self._reyn_stat_names:
+            finalize = corr_finalize if '_m' not in name else cm_finalize
+            if not finalize:
+                continue
+            grid_size = (self.stat_corr_grid_size if '_m' not in name else
+                         self.stat_cm_grid_size)
+            h = np.zeros([NX, grid_size], dtype=np.float64)
+            self._reyn_bytes += h.nbytes
+            gpu_tmp[name] = runner.backend.alloc_buf(like=h)
+
+        # Buffers for moments of the hydrodynamic variables and correlations
+        # between them.
+        self._reyn_host = []
+        self._reyn_gpu = []
+        self._reyn_launches = []
+        self._reyn_offset_kernels = []
+        for i in range(2):
+            host = {}
+            gpu = {}
+            for name in self._reyn_stat_names:
+                h = runner.backend.alloc_async_host_buf(
+                    (self.stat_buf_size, NX), dtype=np.float64)
+                self._reyn_bytes += h.nbytes
+                host[name] = h
+                gpu[name] = runner.backend.alloc_buf(like=h)
+            self._reyn_host.append(host)
+            self._reyn_gpu.append(gpu)
+            launches, offset_kernels = self._reyn_kernels(runner, axis, gpu,
+                                                          gpu_tmp)
+            self._reyn_launches.append(launches)
+            self._reyn_offset_kernels.append(offset_kernels)
 
         self.config.logger.info('Size of Reynolds stats buffer: %d' % self._reyn_bytes)
 
+    def _reyn_kernels(self, runner, axis, gpu, gpu_tmp):
+        """Prepares kernels writing to a single set of stats buffers.
+
+        :rvalue: list of (kernel, grid) pairs to run for every sample, list
+            of kernels taking the offset in the stats buffers as the last
+            argument
+        """
+        NX = self._reyn_points
+        cm_bs = 128
+        corr_bs = 128
+        launches = []
+        offset_kernels = []
+
         gpu_rho = runner.gpu_field(self.rho)
         gpu_v = runner.gpu_field(self.v)
         args = gpu_v + [gpu_rho]
 
         for field, name in zip(args, ('ux', 'uy', 'uz', 'rho')):
-            if cm_finalize:
-                setattr(self, 'stat_kern_cm_%s' % name,
-                        runner.get_kernel(
-                            'ReduceComputeMoments%s64' % axis.upper(), [
-                                field,
-                                getattr(self, 'gpu_stat_tmp_%s_m1' % name),
-                                getattr(self, 'gpu_stat_tmp_%s_m2' % name),
-                                getattr(self, 'gpu_stat_tmp_%s_m3' % name),
-                                getattr(self, 'gpu_stat_tmp_%s_m4' % name)],
-                    'PPPPP', block_size=(cm_bs,), more_shared=True))
+            moments = ['%s_m%d' % (name, m) for m in range(1, 5)]
+            if self.cm_finalize:
+                kernel = runner.get_kernel(
+                    'ReduceComputeMoments%s64' % axis.upper(),
+                    [field] + [gpu_tmp[x] for x in moments],
+                    'PPPPP', block_size=(cm_bs,), more_shared=True)
                 nbs = int(pow(2, math.ceil(math.log(self.stat_cm_grid_size, 2))))
-                setattr(self, 'stat_kern_cm_%s_fin' % name,
-                        runner.get_kernel(
-                    'FinalizeReduceComputeMoments%s64' % axis.upper(), [
-                        getattr(self, 'gpu_stat_tmp_%s_m1' % name),
-                        getattr(self, 'gpu_stat_tmp_%s_m2' % name),
-                        getattr(self, 'gpu_stat_tmp_%s_m3' % name),
-                        getattr(self, 'gpu_stat_tmp_%s_m4' % name),
-                        getattr(self, 'gpu_stat_%s_m1' % name),
-                        getattr(self, 'gpu_stat_%s_m2' % name),
-                        getattr(self, 'gpu_stat_%s_m3' % name),
-                        getattr(self, 'gpu_stat_%s_m4' % name), 0],
-                    'PPPPPPPPi', block_size=(nbs,), more_shared=True))
+                fin_kernel = runner.get_kernel(
+                    'FinalizeReduceComputeMoments%s64' % axis.upper(),
+                    [gpu_tmp[x] for x in moments] +
+                    [gpu[x] for x in moments] + [0],
+                    'PPPPPPPPi', block_size=(nbs,), more_shared=True)
+                launches.append((kernel, [self.stat_cm_grid_size]))
+                launches.append((fin_kernel, [1, NX]))
+                offset_kernels.append(fin_kernel)
             else:
-                setattr(self, 'stat_kern_cm_%s' % name,
-                        runner.get_kernel(
-                            'ReduceComputeMoments%s64' % axis.upper(), [
-                                field,
-                                getattr(self, 'gpu_stat_%s_m1' % name),
-                                getattr(self, 'gpu_stat_%s_m2' % name),
-                                getattr(self, 'gpu_stat_%s_m3' % name),
-                                getattr(self, 'gpu_stat_%s_m4' % name), 0],
-                    'PPPPPi', block_size=(cm_bs,), more_shared=True))
-
-        if corr_finalize:
-            self.stat_kern_corr = runner.get_kernel(
-                'ReduceComputeCorrelations%s64' % axis.upper(), gpu_v + [
-                    gpu_rho, self.gpu_stat_tmp_ux_uy, self.gpu_stat_tmp_ux_uz,
-                    self.gpu_stat_tmp_uy_uz, self.gpu_stat_tmp_ux_rho,
-                    self.gpu_stat_tmp_uy_rho, self.gpu_stat_tmp_uz_rho],
+                kernel = runner.get_kernel(
+                    'ReduceComputeMoments%s64' % axis.upper(),
+                    [field] + [gpu[x] for x in moments] + [0],
+                    'PPPPPi', block_size=(cm_bs,), more_shared=True)
+                launches.append((kernel, [self.stat_cm_grid_size]))
+                offset_kernels.append(kernel)
+
+        corr = ['ux_uy', 'ux_uz', 'uy_uz', 'ux_rho', 'uy_rho', 'uz_rho']
+        if self.corr_finalize:
+            kernel = runner.get_kernel(
+                'ReduceComputeCorrelations%s64' % axis.upper(),
+                gpu_v + [gpu_rho] + [gpu_tmp[x] for x in corr],
                 'PPPPPPPPPP', block_size=(corr_bs,), more_shared=True)
-
             nbs = int(pow(2, math.ceil(math.log(self.stat_corr_grid_size, 2))))
-            self.stat_kern_corr_fin = runner.get_kernel(
+            fin_kernel = runner.get_kernel(
                 'FinalizeReduceComputeCorrelations%s64' % axis.upper(),
-                [self.gpu_stat_tmp_ux_uy, self.gpu_stat_tmp_ux_uz,
-                 self.gpu_stat_tmp_uy_uz, self.gpu_stat_tmp_ux_rho,
-                 self.gpu_stat_tmp_uy_rho, self.gpu_stat_tmp_uz_rho,
-                 self.gpu_stat_ux_uy, self.gpu_stat_ux_uz,
-                 self.gpu_stat_uy_uz, self.gpu_stat_ux_rho,
-                 self.gpu_stat_uy_rho, self.gpu_stat_uz_rho, 0],
+                [gpu_tmp[x] for x in corr] + [gpu[x] for x in corr] + [0],
                 'PPPPPPPPPPPPi', block_size=(nbs,), more_shared=True)
+            launches.append((kernel, [self.stat_corr_grid_size, NX]))
+            launches.append((fin_kernel, [1, NX]))
+            offset_kernels.append(fin_kernel)
         else:
-            self.stat_kern_corr = runner.get_kernel(
-                'ReduceComputeCorrelations%s64' % axis.upper(), gpu_v + [
-                    gpu_rho, self.gpu_stat_ux_uy, self.gpu_stat_ux_uz,
-                    self.gpu_stat_uy_uz, self.gpu_stat_ux_rho,
-                    self.gpu_stat_uy_rho, self.gpu_stat_uz_rho, 0],
+            kernel = runner.get_kernel(
+                'ReduceComputeCorrelations%s64' % axis.upper(),
+                gpu_v + [gpu_rho] + [gpu[x] for x in corr] + [0],
                 'PPPPPPPPPPi', block_size=(corr_bs,), more_shared=True)
+            launches.append((kernel, [self.stat_corr_grid_size]))
+            offset_kernels.append(kernel)
+
+        return launches, offset_kernels
 
     stat_cnt = 0
     def collect_reynolds_stats(self, runner):
-        """Collects Reynolds statistics."""
-        # TODO(mjanusz): Run these kernels in a stream other than main.
+        """Collects Reynolds statistics.
+
+        Has to be called in iterations in which the macroscopic fields
+        were computed.  The kernels are run in a separate stream, and this
+        function does not wait for them to complete.
+
+        :rvalue: ReynoldsStatsFuture for the stats collected so far if the
+            current set of buffers is full, None otherwise
+        """
+        backend = runner.backend
+        runner._profile.record_cpu_start(TimeProfile.STATS)
+        self._reyn_deliver()
+
         self.stat_cnt += 1
         self.snapshot_iters.append(self.iteration)
 
-        NX = self._reyn_points
-        grid = [self.stat_cm_grid_size]
-        if self.cm_finalize:
-            runner.backend.run_kernel(self.stat_kern_cm_ux, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_ux_fin, [1, NX])
-            runner.backend.run_kernel(self.stat_kern_cm_uy, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_uy_fin, [1, NX])
-            runner.backend.run_kernel(self.stat_kern_cm_uz, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_uz_fin, [1, NX])
-            runner.backend.run_kernel(self.stat_kern_cm_rho, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_rho_fin, [1, NX])
-        else:
-            runner.backend.run_kernel(self.stat_kern_cm_ux, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_uy, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_uz, grid)
-            runner.backend.run_kernel(self.stat_kern_cm_rho, grid)
-
-        if self.corr_finalize:
-            runner.backend.run_kernel(self.stat_kern_corr, [self.stat_corr_grid_size, NX])
-            runner.backend.run_kernel(self.stat_kern_corr_fin, [1, NX])
-        else:
-            runner.backend.run_kernel(self.stat_kern_corr, [self.stat_corr_grid_size])
+        # Wait for the macroscopic fields to be computed.
+        self._reyn_stream.wait_for_event(backend.make_event(runner._calc_stream))
+        for kernel, grid in self._reyn_launches[self._reyn_set]:
+            backend.run_kernel(kernel, grid, self._reyn_stream)
+        # Do not overwrite the fields before the stats are computed.
+        runner._calc_stream.wait_for_event(backend.make_event(self._reyn_stream))
 
         # Stat buffer full?
         if self.stat_cnt == self.stat_buf_size:
-            self.stat_cnt = 0
-            # Reset stat buffer offset.
-            if self.cm_finalize:
-                self.stat_kern_cm_ux_fin.args[-1] = 0
-                self.stat_kern_cm_uy_fin.args[-1] = 0
-                self.stat_kern_cm_uz_fin.args[-1] = 0
-                self.stat_kern_cm_rho_fin.args[-1] = 0
-            else:
-                self.stat_kern_cm_ux.args[-1] = 0
-                self.stat_kern_cm_uy.args[-1] = 0
-                self.stat_kern_cm_uz.args[-1] = 0
-                self.stat_kern_cm_rho.args[-1] = 0
-
-            if self.corr_finalize:
-                self.stat_kern_corr_fin.args[-1] = 0
-            else:
-                self.stat_kern_corr.args[-1] = 0
-
-            # Load stats from GPU memory.
-            for stat in ('ux', 'uy', 'uz', 'rho'):
-                runner.backend.from_buf(getattr(self, 'gpu_stat_%s_m1' % stat))
-                runner.backend.from_buf(getattr(self, 'gpu_stat_%s_m2' % stat))
-                runner.backend.from_buf(getattr(self, 'gpu_stat_%s_m3' % stat))
-                runner.backend.from_buf(getattr(self, 'gpu_stat_%s_m4' % stat))
-
-            runner.backend.from_buf(self.gpu_stat_ux_uy)
-            runner.backend.from_buf(self.gpu_stat_ux_uz)
-            runner.backend.from_buf(self.gpu_stat_uy_uz)
-            runner.backend.from_buf(self.gpu_stat_ux_rho)
-            runner.backend.from_buf(self.gpu_stat_uy_rho)
-            runner.backend.from_buf(self.gpu_stat_uz_rho)
-
-            # Divide the stats by this value to get an average over all nodes.
-            div = self._reyn_normalizer
-
-            iters = self.snapshot_iters
-            self.snapshot_iters = []
-
-            return {
-                'ux_m1': self.stat_ux_m1 / div,
-                'ux_m2': self.stat_ux_m2 / div,
-                'ux_m3': self.stat_ux_m3 / div,
-                'ux_m4': self.stat_ux_m4 / div,
-                'uy_m1': self.stat_uy_m1 / div,
-                'uy_m2': self.stat_uy_m2 / div,
-                'uy_m3': self.stat_uy_m3 / div,
-                'uy_m4': self.stat_uy_m4 / div,
-                'uz_m1': self.stat_uz_m1 / div,
-                'uz_m2': self.stat_uz_m2 / div,
-                'uz_m3': self.stat_uz_m3 / div,
-                'uz_m4': self.stat_uz_m4 / div,
-                'rho_m1': self.stat_rho_m1 / div,
-                'rho_m2': self.stat_rho_m2 / div,
-                'rho_m3': self.stat_rho_m3 / div,
-                'rho_m4': self.stat_rho_m4 / div,
-                'ux_uy': self.stat_ux_uy / div,
-                'ux_uz': self.stat_ux_uz / div,
-                'uy_uz': self.stat_uy_uz / div,
-                'ux_rho': self.stat_ux_rho / div,
-                'uy_rho': self.stat_uy_rho / div,
-                'uz_rho': self.stat_uz_rho / div,
-                'iters': iters}
+            future = self._reyn_flush(runner)
         else:
             # Update buffer offset.
-            if self.cm_finalize:
-                self.stat_kern_cm_ux_fin.args[-1] += NX
-                self.stat_kern_cm_uy_fin.args[-1] += NX
-                self.stat_kern_cm_uz_fin.args[-1] += NX
-                self.stat_kern_cm_rho_fin.args[-1] += NX
-            else:
-                self.stat_kern_cm_ux.args[-1] += NX
-                self.stat_kern_cm_uy.args[-1] += NX
-                self.stat_kern_cm_uz.args[-1] += NX
-                self.stat_kern_cm_rho.args[-1] += NX
-
-            if self.corr_finalize:
-                self.stat_kern_corr_fin.args[-1] += NX
-            else:
-                self.stat_kern_corr.args[-1] += NX
-
+            for kernel in self._reyn_offset_kernels[self._reyn_set]:
+                kernel.args[-1] += self._reyn_points
+            future = None
+
+        runner._profile.record_cpu_end(TimeProfile.STATS)
+        return future
+
+    def _reyn_flush(self, runner):
+        """Starts the transfer of the current set of buffers to the host
+        and switches to the other set."""
+        backend = runner.backend
+        cur = self._reyn_set
+
+        # The host buffers are about to be overwritten.  The previous
+        # transfer from them is normally long complete.
+        if self._reyn_pending[cur] is not None:
+            self._reyn_pending[cur].result()
+
+        self._reyn_copy_stream.wait_for_event(
+            backend.make_event(self._reyn_stream))
+        host = self._reyn_host[cur]
+        for name in self._reyn_stat_names:
+            backend.from_buf_async(self._reyn_gpu[cur][name],
+                                   self._reyn_copy_stream, target=host[name])
+
+        iters = self.snapshot_iters
+        self.snapshot_iters = []
+        future = ReynoldsStatsFuture(backend.make_event(self._reyn_copy_stream),
+                                     host, self._reyn_normalizer, iters)
+        self._reyn_pending[cur] = future
+        if self._reyn_callback is not None:
+            self._reyn_undelivered.append(future)
+
+        # Reset stat buffer offset.
+        for kernel in self._reyn_offset_kernels[cur]:
+            kernel.args[-1] = 0
+        self.stat_cnt = 0
+        self._reyn_set = 1 - cur
+
+        # Do not overwrite the other set while it is being transferred.
+        if self._reyn_pending[self._reyn_set] is not None:
+            self._reyn_stream.wait_for_event(
+                self._reyn_pending[self._reyn_set]._event)
+        return future
+
+    def _reyn_deliver(self, wait=False):
+        """Passes completed batches of stats to the callback."""
+        while self._reyn_undelivered and (
+                wait or self._reyn_undelivered[0].done()):
+            self._reyn_callback(self._reyn_undelivered.pop(0).result())
+
+    def finish_reynolds_stats(self, runner):
+        """Waits for all pending transfers of stats to the host and passes
+        their results to the callback.
+
+        Stats from an incomplete set of buffers are discarded.  Call this
+        from after_main_loop() when using a callback.
+        """
+        self._reyn_deliver(wait=True)
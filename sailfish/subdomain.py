@@ -16,6 +16,7 @@ from scipy.ndimage import filters
 from sailfish import util
 from sailfish import sym
 import sailfish.node_type as nt
+from sailfish.sparse import SparseLattice
 from sailfish.subdomain_connection import LBConnection
 from functools import reduce
 
@@ -58,6 +59,7 @@ class SubdomainSpec(object):
             self.envelope_size = None
         self._runner = None
         self._id = id_
+        self._num_active_nodes = None
         self._clear_connections()
         self._clear_connectors()
 
@@ -94,6 +96,19 @@ class SubdomainSpec(object):
     def num_actual_nodes(self):
         return reduce(operator.mul, self.actual_size)
 
+    @property
+    def num_active_nodes(self):
+        """Estimated number of active (non-solid) nodes, used to balance
+        the load.  All nodes are assumed to be active unless the estimate
+        is provided by the geometry class."""
+        if self._num_active_nodes is None:
+            return self.num_nodes
+        return self._num_active_nodes
+
+    @num_active_nodes.setter
+    def num_active_nodes(self, x):
+        self._num_active_nodes = x
+
     @property
     def periodic_x(self):
         """X-axis periodicity within this subdomain."""
@@ -381,10 +396,13 @@ class Subdomain(object):
         self._seen_types = set([0])
         self._needs_orientation = False
 
-        # A dense boolean array indicating which nodes are active in the
-        # simulation (marked as True). This is only used in the indirect
-        # addressing node. This array covers all nodes, including ghosts.
-        self.active_node_mask = None
+        # Active nodes of the simulation (SparseLattice covering all nodes,
+        # including ghosts). This is only used in the indirect addressing
+        # mode.
+        self.sparse_lattice = None
+        # Compact copies of the type maps, covering the active nodes only.
+        self._sparse_type_map = None
+        self._sparse_vis_map = None
 
         if self.spec.runner.config.node_addressing == 'indirect':
             self.config.logger.debug('Loading active node map..')
@@ -394,14 +412,38 @@ class Subdomain(object):
 
     def allocate(self):
         runner = self.spec.runner
-        self._type_map_ghost, self._sparse_type_map = runner.make_scalar_field(np.uint32, register=False, nonghost_view=False)
+        self._type_map_ghost, _ = runner.make_scalar_field(np.uint32, register=False, need_indirect=False, nonghost_view=False)
         self._type_map = self._type_map_ghost[self.spec._nonghost_slice]
         self._type_map_base = runner.field_base(self._type_map_ghost)
-        self._param_map, self._sparse_param_map = runner.make_scalar_field(dtype=np.int_, register=False)
+        self._param_map, _ = runner.make_scalar_field(dtype=np.int_, register=False, need_indirect=False)
         self._param_map_base = runner.field_base(self._param_map)
-        self._orientation, self._sparse_orientation_map = runner.make_scalar_field(np.uint32, register=False)
+        self._orientation, _ = runner.make_scalar_field(np.uint32, register=False, need_indirect=False)
         self._orientation_base = runner.field_base(self._orientation)
 
+    def release_dense_maps(self):
+        """Replaces the dense geometry arrays with compact arrays covering
+        the active nodes only.
+
+        Used with sparse host storage once the geometry is on the compute
+        device.  Afterwards, the geometry cannot be modified, and
+        visualization_map() and fluid_map() create a new dense array on every
+        call.
+        """
+        runner = self.spec.runner
+        self.encoded_map(sparse=True)
+        vis_map = np.zeros(self.full_lat_shape, dtype=self._type_vis_map.dtype)
+        vis_map[self.spec._nonghost_slice] = self._type_vis_map
+        self._sparse_vis_map = self.sparse_lattice.gather(vis_map)
+        del vis_map
+
+        for field in (self._type_map_ghost, self._param_map, self._orientation):
+            runner.release_field(field)
+        self._type_map_ghost = self._type_map = self._type_map_base = None
+        self._param_map = self._param_map_base = None
+        self._orientation = self._orientation_base = None
+        self._type_vis_map = None
+        self._encoder.release_param_map()
+
     @property
     def config(self):
         return self.spec.runner.config
@@ -422,6 +464,32 @@ class Subdomain(object):
         raise NotImplementedError('initial_conditions() not defined in a child '
                 'class')
 
+    @property
+    def active_node_mask(self):
+        """Dense Boolean array indicating which nodes are active in the
+        simulation (marked as True), or None if indirect addressing is not
+        used.  The array covers all nodes, including ghosts, and is created
+        from sparse_lattice on every access."""
+        if self.sparse_lattice is None:
+            return None
+        return self.sparse_lattice.mask()
+
+    @active_node_mask.setter
+    def active_node_mask(self, mask):
+        if mask is None:
+            self.sparse_lattice = None
+        else:
+            self.sparse_lattice = SparseLattice.from_mask(
+                mask, self.config.node_ordering, self.config.block_size)
+
+    def active_node_coords(self):
+        """Returns a sequence (in natural order) of 1D arrays with the global
+        coordinates of the active nodes (including ghosts), in the order used
+        in sparse arrays."""
+        es = self.spec.envelope_size
+        return [x + origin - es for x, origin in
+                zip(reversed(self.sparse_lattice.coords()), self.spec.location)]
+
     def load_active_node_map(self, *args):
         """Populates active_node_mask with a dense Boolean array.
 
@@ -463,7 +531,7 @@ class Subdomain(object):
         """
         self.config.logger.debug('... setting active node map from wall map')
         fluid_map = np.logical_not(wall_map)
-        neighbor = self._lattice_kernel(zero=0)
+        neighbors = self._lattice_kernel(zero=0)
 
         # Mark nodes connected to at least one active node as active.
         # We need these nodes for walls and ghost nodes.
@@ -474,14 +542,14 @@ class Subdomain(object):
 
     @property
     def active_nodes(self):
-        if self.active_node_mask is not None:
-            return int(np.sum(self.active_node_mask))
+        if self.sparse_lattice is not None:
+            return self.sparse_lattice.size
         else:
             return reduce(operator.mul, self.lat_shape)
 
     @util.lazy_property
     def num_fluid_nodes(self):
-        if self.active_node_mask is not None:
+        if self.sparse_lattice is not None:
             return self.active_nodes
         else:
             return np.sum(self.fluid_map())
@@ -585,6 +653,48 @@ class Subdomain(object):
             getattr(node_type, 'orientation', 0),
             node_type.id, key)
 
+    def neighbor_types(self, type_map, select):
+        """Looks up the types of the neighbors of selected nodes in all
+        directions of the lattice.
+
+        All neighbors are found in a single chunked, multi-threaded pass over
+        type_map.  Neighbors across the boundaries of type_map are found using
+        periodic wrapping (as with np.roll).  Apart from a copy of one chunk
+        per thread, memory usage is proportional to the number of selected
+        nodes.
+
+        :param type_map: array of node type IDs
+        :param select: boolean array of the same shape as type_map, selecting
+            the nodes to process
+        :rvalue: (nodes, types) tuple; nodes is a tuple of index arrays of the
+            selected nodes in row-major order (as returned by np.nonzero),
+            types[i] are the types of the neighbors of these nodes in the
+            direction of grid.basis[i] (types[0] are the types of the nodes
+            themselves)
+        """
+        shifts = self._array_shifts(self.grid.basis)
+        halo = self._stencil_halo(shifts)
+        dtype = np.min_scalar_type(max(nt._NODE_TYPES))
+
+        def _query(block, start, stop):
+            nodes = np.nonzero(select[start:stop])
+            flat_block = block.reshape(-1)
+            flat_nodes = np.ravel_multi_index([x + halo for x in nodes],
+                                              block.shape)
+            types = np.empty((len(shifts), flat_nodes.size), dtype=dtype)
+            idx = np.empty_like(flat_nodes)
+            for i, shift in enumerate(shifts):
+                np.add(flat_nodes, util.flat_offset(block, shift), out=idx)
+                types[i] = flat_block.take(idx)
+            return (nodes[0] + start,) + nodes[1:], types
+
+        results = util.chunked_stencil(_query, type_map, halo,
+                                       self.config.geometry_threads)
+        nodes = tuple(np.concatenate(x) for x in
+                      zip(*[nodes for nodes, _ in results]))
+        types = np.concatenate([types for _, types in results], axis=1)
+        return nodes, types
+
     def tag_directions(self):
         """Creates direction tags for nodes that support it.
 
@@ -613,25 +723,39 @@ class Subdomain(object):
         dry_types = self._type_map.dtype.type(dry_types)
         wet_types = self._type_map.dtype.type(wet_types)
         orient_types = self._type_map.dtype.type(orient_types)
-        # Only do direction tagging for nodes that do not have
-        # orientation/direction already.
-        orient_map = (
-            util.in_anyd_fast(self._type_map_base[ngs], orient_types) &
-            (self._orientation_base[ngs] == 0))
-
-        l = self.grid.dim - 1
+        type_map = self._type_map_base[tuple(ngs)]
+        orientation = self._orientation_base[tuple(ngs)]
         # Skip the stationary vector.
-        for i, vec in enumerate(self.grid.basis[1:]):
-            shifted_map = self._type_map_base[ngs]
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
-
-            # If the given distribution points to a fluid node, tag it as
-            # active.
-            idx = orient_map & util.in_anyd_fast(shifted_map, wet_types)
-            self._orientation_base[ngs][idx] |= (1 << i)
+        shifts = self._array_shifts(self.grid.basis[1:])
+        halo = self._stencil_halo(shifts)
+
+        def _tag(block, start, stop):
+            # Only do direction tagging for nodes that do not have
+            # orientation/direction already.
+            chunk_orientation = orientation[start:stop]
+            orient_map = (
+                util.in_anyd_fast(util.shifted_view(block, [0] * block.ndim,
+                                                    halo), orient_types) &
+                (chunk_orientation == 0))
+            nodes = np.nonzero(orient_map)
+            if nodes[0].size == 0:
+                return
+
+            # Only look up the neighbors of the tagged nodes.
+            flat_block = block.reshape(-1)
+            flat_nodes = np.ravel_multi_index([x + halo for x in nodes],
+                                              block.shape)
+            tags = np.zeros(flat_nodes.shape, dtype=orientation.dtype)
+            for i, shift in enumerate(shifts):
+                # If the given distribution points to a fluid node, tag it as
+                # active.
+                wet = util.in_anyd_fast(
+                    flat_block[flat_nodes + util.flat_offset(block, shift)],
+                    wet_types)
+                tags |= wet.astype(tags.dtype) << tags.dtype.type(i)
+            chunk_orientation[nodes] |= tags
+
+        util.chunked_stencil(_tag, type_map, halo, self.config.geometry_threads)
 
         self.config.logger.debug('... link tagging done.')
         return True
@@ -650,27 +774,79 @@ class Subdomain(object):
         # Convert to a numpy array.
         dry_types = self._type_map.dtype.type(dry_types)
         orient_types = self._type_map.dtype.type(orient_types)
-        orient_map = util.in_anyd_fast(self._type_map_base, orient_types)
-        l = self.grid.dim - 1
-        for vec in self.grid.basis:
-            # Orientaion only handles the primary directions. More complex
-            # setups need link tagging.
-            if vec.dot(vec) != 1:
-                continue
-            shifted_map = self._type_map_base
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
+        # Orientaion only handles the primary directions. More complex
+        # setups need link tagging.
+        vecs = [vec for vec in self.grid.basis if vec.dot(vec) == 1]
+        dirs = [self.grid.vec_to_dir(list(vec)) for vec in vecs]
+        shifts = self._array_shifts(vecs)
+        halo = self._stencil_halo(shifts)
+        orientation = self._orientation_base
+
+        def _orient(block, start, stop):
+            chunk_orientation = orientation[start:stop]
+            nodes = np.nonzero(util.in_anyd_fast(
+                util.shifted_view(block, [0] * block.ndim, halo),
+                orient_types))
+            if nodes[0].size == 0:
+                return
+
+            flat_block = block.reshape(-1)
+            flat_nodes = np.ravel_multi_index([x + halo for x in nodes],
+                                              block.shape)
+            node_orientation = chunk_orientation[nodes]
+            for shift, dir_ in zip(shifts, dirs):
+                # Only set orientation where it's not already defined (=0).
+                idx = ((flat_block[flat_nodes +
+                                   util.flat_offset(block, shift)] == 0) &
+                       (node_orientation == 0))
+                node_orientation[idx] = dir_
+            chunk_orientation[nodes] = node_orientation
+
+        util.chunked_stencil(_orient, self._type_map_base, halo,
+                             self.config.geometry_threads)
+
+    def _array_shifts(self, vectors):
+        """Converts lattice vectors into lists of offsets in the order of
+        the axes of the geometry arrays."""
+        return [[int(x) for x in reversed(list(vec))] for vec in vectors]
 
-            # Only set orientation where it's not already defined (=0).
-            idx = orient_map & (shifted_map == 0) & (self._orientation_base == 0)
-            self._orientation_base[idx] = self.grid.vec_to_dir(list(vec))
+    @staticmethod
+    def _stencil_halo(shifts):
+        return max([abs(x) for shift in shifts for x in shift] + [1])
 
     def reset(self, encode=True):
         self.config.logger.debug('Setting subdomain geometry...')
         self._type_map_encoded = False
+        self._sparse_type_map = None
+
+        from sailfish import geo_encoder
+
+        # The cache only holds fully encoded geometry.
+        cache = None
+        if encode and self.config.geometry_cache_dir:
+            cache = geo_encoder.GeometryCache(self.config.geometry_cache_dir,
+                                              self.config.logger)
+            cache_key = cache.key(self)
+            if cache_key is None:
+                self.config.logger.warning(
+                    'Sources of the subdomain class not available. The '
+                    'geometry will not be cached.')
+                cache = None
+
+        state = cache.get(cache_key) if cache is not None else None
+        if state is not None:
+            self._set_geometry_state(state)
+            self.config.logger.info('Loaded geometry from cache.')
+        else:
+            self._process_geometry(encode)
+            if cache is not None:
+                cache.put(cache_key, self._get_geometry_state())
 
+        self.config.logger.info('Fluid node fraction: %.1f%%' %
+                                (self.num_fluid_nodes * 100.0 /
+                                 self.spec.num_nodes))
+
+    def _process_geometry(self, encode):
         # Use a coordinate map covering ghost nodes as well. This is
         # necessary so that orientation detection works correctly
         # in case the ghost nodes would correspond to wet nodes from
@@ -722,9 +898,42 @@ class Subdomain(object):
             self.encoded_map()
         self.config.logger.debug('... encoder done.')
 
-        self.config.logger.info('Fluid node fraction: %.1f%%' %
-                                (self.num_fluid_nodes * 100.0 /
-                                 self.spec.num_nodes))
+    def _get_geometry_state(self):
+        """Returns the processed and encoded geometry of the subdomain for
+        caching."""
+        assert self._type_map_encoded
+        return {
+            'type_map': self._type_map_base,
+            'orientation': self._orientation_base,
+            'type_vis_map': self._type_vis_map,
+            'node_types': list(self._params.values()),
+            'seen_types': self._seen_types,
+            'needs_orientation': self._needs_orientation,
+            'time_dependence': self.config.time_dependence,
+            'space_dependence': self.config.space_dependence,
+            'encoder': self._encoder.get_state(),
+        }
+
+    def _set_geometry_state(self, state):
+        """Restores the geometry returned by _get_geometry_state()."""
+        from sailfish import geo_encoder
+        self._type_map_base[:] = state['type_map']
+        self._orientation_base[:] = state['orientation']
+        self._type_vis_map[:] = state['type_vis_map']
+        # Hashes of strings are not stable across processes.
+        self._params = dict(
+            (hash((node_type.id, self._hashable_params(node_type.params))),
+             node_type) for node_type in state['node_types'])
+        self._seen_types = state['seen_types']
+        self._needs_orientation = state['needs_orientation']
+        if state['time_dependence']:
+            self.config.time_dependence = True
+        if state['space_dependence']:
+            self.config.space_dependence = True
+
+        self._encoder = geo_encoder.GeoEncoderConst(self)
+        self._encoder.set_state(state['encoder'])
+        self._type_map_encoded = True
 
     def get_fo_distributions(self, fo):
         """Computes an array indicating which distributions correspond to
@@ -744,23 +953,17 @@ class Subdomain(object):
         self.config.logger.debug('%s: num solid nodes: %d' %
                                  (fo, np.sum(cond)))
 
+        nodes, types = self.neighbor_types(self._type_vis_map, cond)
+        nodes = tuple([x + self.spec.envelope_size for x in nodes])
         ret = {}
-        l = self.grid.dim - 1
         # Skip the stationary vector.
-        for i, vec in enumerate(self.grid.basis[1:]):
-            shifted_map = self._type_vis_map.copy()
-
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
-
+        for i in range(1, types.shape[0]):
             # The current distribution is pointing to a fluid node.
-            t = np.where(cond & (shifted_map == nt._NTFluid.id))
+            idx = np.flatnonzero(types[i] == nt._NTFluid.id)
             # Only add entries for distributions that actually contribute
             # momentum.
-            if t[0].size > 0:
-                ret[i + 1] = tuple([x + self.spec.envelope_size for x in t])
+            if idx.size > 0:
+                ret[i] = tuple([x.take(idx) for x in nodes])
 
         return ret
 
@@ -770,7 +973,11 @@ class Subdomain(object):
         return self._encoder.scratch_space_size if self._encoder is not None else 0
 
     def init_fields(self, sim):
-        mgrid = self._get_mgrid()
+        if (self.config.node_addressing == 'indirect' and
+                self.config.sparse_host_storage):
+            mgrid = self.active_node_coords()
+        else:
+            mgrid = self._get_mgrid()
         self.initial_conditions(sim, *mgrid)
 
     def update_context(self, ctx):
@@ -787,16 +994,20 @@ class Subdomain(object):
             if hasattr(node_type, 'update_context'):
                 node_type.update_context(ctx)
 
-    def encoded_map(self, indirect_address=None):
+    def encoded_map(self, sparse=False):
+        """Returns the encoded type map.
+
+        :param sparse: if True, returns a compact array covering the active
+            nodes only (for indirect node addressing)
+        """
         if not self._type_map_encoded:
             self._encoder.encode(self._orientation_base)
             self._type_map_encoded = True
 
-        if indirect_address is not None:
-            assert self.active_node_mask is not None
-            anm = self.active_node_mask
-            h = indirect_address[anm]
-            self._sparse_type_map[h] = self._type_map_ghost[anm]
+        if sparse:
+            if self._sparse_type_map is None:
+                self._sparse_type_map = self.sparse_lattice.gather(
+                    self._type_map_base)
             return self._sparse_type_map
 
         return self._type_map_base
@@ -804,6 +1015,11 @@ class Subdomain(object):
     def visualization_map(self):
         """Returns an unencoded type map for visualization/
         postprocessing purposes."""
+        if self._type_vis_map is None:
+            # Inactive nodes do not take part in the simulation.
+            return self.sparse_lattice.scatter(
+                self._sparse_vis_map,
+                fill=nt._NTUnused.id)[self.spec._nonghost_slice]
         return self._type_vis_map
 
     def fluid_map(self, wet=True):
@@ -813,7 +1029,7 @@ class Subdomain(object):
         if wet:
             uniq_types = set(np.unique(fm))
             wet_types = list(set(nt.get_wet_node_type_ids()) & uniq_types)
-            wet_types = self._type_map.dtype.type(wet_types)
+            wet_types = fm.dtype.type(wet_types)
             return util.in_anyd_fast(fm, wet_types)
         else:
             return fm == 0
@@ -18,8 +18,10 @@ import signal
 import time
 import numpy as np
 import zmq
-from sailfish import codegen, io
+from sailfish import codegen, io, sparse, util
 from sailfish.lb_base import LBMixIn, LBSim
+from sailfish.output_policy import ChangeDrivenOutputPolicy, OutputPolicy
+from sailfish.output_reduction import OutputReductionStage, parse_output_reduction
 from sailfish.profile import profile, TimeProfile
 from sailfish.subdomain_connection import ConnectionBuffer, MacroConnectionBuffer
 import sailfish.node_type as nt
@@ -61,7 +63,11 @@ class SubdomainRunner(object):
 
     An arrow above symbolizes a dependency between the two streams.
     """
-    INVALID_NODE = 0xffffffff
+    INVALID_NODE = sparse.INVALID_NODE
+
+    #: Time (in ms) after which waiting for data from other subdomains is
+    #: interrupted to check whether the simulation should be terminated.
+    _recv_poll_timeout = 100
 
     def __init__(self, simulation, spec, output, backend, quit_event,
             summary_addr=None, master_addr=None, summary_channel=None):
@@ -78,6 +84,7 @@ class SubdomainRunner(object):
         """
 
         self._summary_sender = None
+        self._master_sock = None
         self._ppid = os.getppid() if os.name != 'nt' else 0
 
         self._ctx = zmq.Context()
@@ -111,18 +118,23 @@ class SubdomainRunner(object):
         # Set of fields that are also wrapped in a GPUArray.
         self._array_fields = set()
 
+        # Maps names of output fields to the host fields.
+        self._output_fields = {}
+        self._output_reduction = None
+
         self._gpu_field_map = {}
         self._gpu_grids_primary = []
         self._gpu_grids_secondary = []  # only used for the AB access pattern
         self._gpu_indirect_address = None  # only used for indirect node addressing
 
-        # Numpy array where every entry contains a node address.
-        # The node address is the node's offset within the dense node array
-        # used for data storage in the indirect addressing scheme.
-        self._host_indirect_address = None
-
         self._quit_event = quit_event
 
+        # Checkpoint writer, page-locked host buffers for snapshots of the
+        # distributions and the snapshot waiting for its transfer to complete.
+        self._checkpoint_writer = None
+        self._checkpoint_bufs = {}
+        self._checkpoint_pending = None
+
         self._pbc_kernels = []
 
         # Dictionary of variables to be exported to the code templates
@@ -247,6 +259,12 @@ class SubdomainRunner(object):
 
         ctx['initialization'] = self._initialization
 
+    @property
+    def _sparse_host(self):
+        """True if host fields are only stored for the active nodes."""
+        return (self.config.node_addressing == 'indirect' and
+                self.config.sparse_host_storage)
+
     def add_visualization_field(self, field_cb, name):
         self._output.register_field(field_cb, name, visualization=True)
 
@@ -261,8 +279,14 @@ class SubdomainRunner(object):
         Ghost nodes can still be accessed via the 'base' attribute of the
         returned ndarray.
 
+        With sparse host storage (--sparse_host_storage), fields mirrored on
+        the compute device are only allocated for the active nodes (including
+        ghosts), and the returned view covers all of them.
+
         :param register: if True, the field will be registered for output and
             for automated creation of equivalent field on the compute device.
+        :param need_indirect: if False, the field is a dense host array also
+            with indirect addressing
         :rvalue: tuple of: non-ghost view into the backing array,
             sparse field (only when indirect addressing is enabled; None
             otherwise)
@@ -270,17 +294,23 @@ class SubdomainRunner(object):
         if dtype is None:
             dtype = self.float
 
+        sparse_host = need_indirect and self._sparse_host
+        if sparse_host:
+            shape = self._subdomain.active_nodes
+        else:
+            shape = self._physical_size
+
         if async:
-            field = self.backend.alloc_async_host_buf(self._physical_size, dtype=dtype)
+            field = self.backend.alloc_async_host_buf(shape, dtype=dtype)
         else:
-            field = np.zeros(self._physical_size, dtype=dtype)
+            field = np.zeros(shape, dtype=dtype)
 
         # Initialize floating point fields to inf to help surfacing problems
         # with uninitialized nodes.
         if dtype == self.float:
             field[:] = np.inf
 
-        if nonghost_view:
+        if nonghost_view and not sparse_host:
             fview = field[self._spec._nonghost_slice]
         else:
             fview = field.view()
@@ -298,6 +328,7 @@ class SubdomainRunner(object):
 
         if name is not None and register:
             self._output.register_field(fview, name)
+            self._output_fields[name] = fview
 
         if register:
             self._scalar_fields.append(fview)
@@ -306,9 +337,14 @@ class SubdomainRunner(object):
         # both distributions and macroscopic fields are stored in 'sparse'
         # arrays that only store data for active nodes. The dense fields
         # allocated above are only used for compatibility with the host
-        # initialization code.
+        # initialization code.  With sparse host storage, the field allocated
+        # above is already sparse.
         sparse_field = None
-        if self.config.node_addressing == 'indirect' and need_indirect:
+        if sparse_host:
+            sparse_field = field
+            if register:
+                self._sparse_scalar_fields.append(sparse_field)
+        elif self.config.node_addressing == 'indirect' and need_indirect:
             if async:
                 sparse_field = self.backend.alloc_async_host_buf(
                     self._subdomain.active_nodes, dtype=dtype)
@@ -322,6 +358,11 @@ class SubdomainRunner(object):
     def field_base(self, field):
         return self._field_base[id(field.base)]
 
+    def release_field(self, field):
+        """Drops the reference to the backing array of a field created with
+        make_scalar_field(register=False)."""
+        del self._field_base[id(field.base)]
+
     def make_vector_field(self, name=None, output=False, async=False,
                           gpu_array=False):
         """Allocates several scalar arrays representing a vector field."""
@@ -336,6 +377,7 @@ class SubdomainRunner(object):
 
         if name is not None:
             self._output.register_field(components, name)
+            self._output_fields[name] = components
 
         self._vector_fields.append(components)
         self._sparse_vector_fields.append(sparse_components)
@@ -352,7 +394,13 @@ class SubdomainRunner(object):
         self._log_required_memory()
         self._subdomain.allocate()
         self._subdomain.reset()
+        if self._sparse_host:
+            self._output = io.SparseOutputWrapper(
+                self._output, self._subdomain.sparse_lattice,
+                self._spec._nonghost_slice)
         self._output.set_fluid_map(self._subdomain.fluid_map())
+        self._output.set_geometry(self._spec.location,
+                                  list(reversed(self._global_size)))
         if self.config.debug_dump_node_type_map:
             self._output.dump_node_type(self._subdomain.visualization_map())
 
@@ -578,7 +626,7 @@ class SubdomainRunner(object):
                 # TODO: Ideally, we would filter out unused nodes here. This
                 # requires careful handling between what the source domain and the
                 # destination domain see/expect.
-                ret = self._host_indirect_address.flat[idxs]
+                ret = self._subdomain.sparse_lattice.address(idxs)
                 mask = ret != self.INVALID_NODE
                 if ret.size == 1:
                     if ret != self.INVALID_NODE:
@@ -767,7 +815,6 @@ class SubdomainRunner(object):
                 for i, grid in enumerate(self._sim.grids):
                     # TODO(michalj): Optimize this by providing proper padding.
                     coll_buf = alloc(cpair.src.transfer_shape, dtype=self.float)
-                    recv_buf = alloc(cpair.dst.transfer_shape, dtype=self.float)
                     dist_full_buf = alloc(cpair.dst.full_shape, dtype=self.float)
 
                     if self.config.access_pattern == 'AA':
@@ -784,7 +831,7 @@ class SubdomainRunner(object):
                     cbuf = ConnectionBuffer(face, cpair,
                             GPUBuffer(coll_buf, self.backend),
                             coll_idx,
-                            recv_buf,
+                            None,  # recv_buf, allocated below.
                             GPUBuffer(dist_partial_buf, self.backend),
                             GPUBuffer(dist_partial_idx, self.backend),
                             dist_partial_sel,
@@ -810,10 +857,45 @@ class SubdomainRunner(object):
                                           x.grid_id))
             self._recv_block_to_connbuf[subdomain_id] = recv_bufs
 
+        # Data exchanged with other subdomains is transferred directly between
+        # the compute device and contiguous host buffers (one per connected
+        # subdomain), so that no intermediate copies are necessary.
+        #
+        # Two send buffers are used in alternate iterations.  Data sent
+        # from a buffer is not copied by the connector, so the buffer
+        # cannot be modified until the data is received on the other side.
+        # The remote subdomain needs this data before it can send its data
+        # for the next iteration, which in turn has to be received here
+        # before the buffer is used again.
+        self._send_bufs = {}
+        self._recv_bufs = {}
+        for subdomain_id, cbufs in self._block_to_connbuf.items():
+            self._send_bufs[subdomain_id] = [
+                alloc(sum(getattr(x, self._coll_buf_name(i)).host.size
+                          for x in cbufs), dtype=self.float)
+                for i in range(2)]
+
+            recv_bufs = self._recv_block_to_connbuf[subdomain_id]
+            shapes = [x.cpair.dst.transfer_shape for x in recv_bufs]
+            recv = alloc(sum(reduce(operator.mul, shape) for shape in shapes),
+                         dtype=self.float)
+            self._recv_bufs[subdomain_id] = recv
+            i = 0
+            for cbuf, shape in zip(recv_bufs, shapes):
+                l = reduce(operator.mul, shape)
+                cbuf.recv_buf = recv[i:i+l].reshape(shape)
+                i += l
+
+    def _coll_buf_name(self, iteration):
+        """Returns the name of the ConnectionBuffer attribute holding the data
+        to be sent to other subdomains in a given iteration."""
+        if self.config.access_pattern == 'AA' and iteration & 1:
+            return 'local_coll_buf'
+        else:
+            return 'coll_buf'
+
     def _update_compute_code(self):
-        code = self._bcg.get_code(self, self.backend.name)
-        self.config.logger.debug("... compute code prepared.")
-        self.module = self.backend.build(code)
+        self.module = self._bcg.build_module(self, self.backend)
 
     def _init_compute(self):
         self.config.logger.debug("Initializing compute unit...")
@@ -827,24 +909,25 @@ class SubdomainRunner(object):
         self._calc_stream = self.backend.make_stream()
 
     def _build_indirect_address_map(self):
-        """Builds a node addressing map."""
-        addr, _ = self.make_scalar_field(dtype=np.uint32, register=False, need_indirect=False,
-                                         nonghost_view=False)
-        # Mark all nodes as invalid.
-        addr[:] = self.INVALID_NODE
-        self._host_indirect_address = addr
-        addr[self._subdomain.active_node_mask] = np.arange(self._subdomain.active_nodes, dtype=np.uint32)
-        self._gpu_indirect_address = self.backend.alloc_buf(like=self._field_base[id(addr.base)])
+        """Builds a node addressing map on the compute device.  The dense
+        map is not kept on the host, where node addresses are looked up in
+        the sparse lattice."""
+        addr = self._subdomain.sparse_lattice.address_map()
+        self._gpu_indirect_address = self.backend.alloc_buf(size=addr.nbytes)
+        self.backend.to_buf(self._gpu_indirect_address, addr)
 
     def _init_gpu_data_indirect(self):
         self._build_indirect_address_map()
-        addr = self._host_indirect_address
-        mask = self._subdomain.active_node_mask
+        lattice = self._subdomain.sparse_lattice
+        # With sparse host storage, the host fields are the sparse arrays.
+        dense_host = not self._sparse_host
 
         for field, sparse_field in zip(self._scalar_fields,
                                        self._sparse_scalar_fields):
             # Copy field to the sparse array.
-            sparse_field[addr[mask]] = self._field_base[id(field.base)][mask]
+            if dense_host:
+                lattice.gather(self._field_base[id(field.base)],
+                               out=sparse_field)
             self._gpu_field_map[id(field)] = self.backend.alloc_buf(
                 like=sparse_field,
                 wrap_in_array=(id(field.base) in self._array_fields))
@@ -854,28 +937,33 @@ class SubdomainRunner(object):
             gpu_vector = []
             for component, sparse_component in zip(field, sparse_field):
                 # Copy field to the sparse array.
-                sparse_component[addr[mask]] = self._field_base[id(component.base)][mask]
+                if dense_host:
+                    lattice.gather(self._field_base[id(component.base)],
+                                   out=sparse_component)
                 gpu_vector.append(self.backend.alloc_buf(
                     like=sparse_component,
                     wrap_in_array=(id(component.base) in self._array_fields)))
             self._gpu_field_map[id(field)] = gpu_vector
 
         self._gpu_geo_map = self.backend.alloc_buf(
-                like=self._subdomain.encoded_map(addr))
+                like=self._subdomain.encoded_map(sparse=True))
 
     def _unravel_fields(self):
         """Copies data from sparse arrays back into the dense arrays used for
-        operations on the host."""
-        addr = self._host_indirect_address
-        mask = self._subdomain.active_node_mask
+        operations on the host.  Not necessary with sparse host storage."""
+        if self._sparse_host:
+            return
+
+        lattice = self._subdomain.sparse_lattice
         for field, sparse_field in zip(self._scalar_fields,
                                        self._sparse_scalar_fields):
-             self._field_base[id(field.base)][mask] = sparse_field[addr[mask]]
+            lattice.scatter(sparse_field, out=self._field_base[id(field.base)])
 
         for field, sparse_field in zip(self._vector_fields,
                                        self._sparse_vector_fields):
             for component, sparse_component in zip(field, sparse_field):
-                self._field_base[id(component.base)][mask] = sparse_component[addr[mask]]
+                lattice.scatter(sparse_component,
+                                out=self._field_base[id(component.base)])
 
     def _init_gpu_data_direct(self):
         for field in self._scalar_fields:
@@ -1066,84 +1154,146 @@ class SubdomainRunner(object):
         if not self._spec._connectors:
             return
 
-        if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
-            buf = 'local_coll_buf'
-        else:
-            buf = 'coll_buf'
+        parity = self._sim.iteration & 1
+        buf = self._coll_buf_name(self._sim.iteration)
 
         for b_id, connector in self._spec._connectors.items():
-            conn_bufs = self._block_to_connbuf[b_id]
-            for x in conn_bufs:
-                self.backend.from_buf_async(getattr(x, buf).gpu, self._data_stream)
+            send_buf = self._send_bufs[b_id][parity]
+            i = 0
+            for x in self._block_to_connbuf[b_id]:
+                gpu_buf = getattr(x, buf)
+                l = gpu_buf.host.size
+                self.backend.from_buf_async(gpu_buf.gpu, self._data_stream,
+                                            target=send_buf[i:i+l])
+                i += l
 
         self.backend.sync_stream(self._data_stream)
 
         for b_id, connector in self._spec._connectors.items():
-            conn_bufs = self._block_to_connbuf[b_id]
-
-            if len(conn_bufs) > 1:
-                connector.send(np.hstack(
-                    [np.ravel(getattr(x, buf).host) for x in conn_bufs]))
-            else:
-                # TODO(michalj): Use non-blocking sends here?
-                connector.send(np.ravel(getattr(conn_bufs[0], buf).host).copy())
+            # TODO(michalj): Use non-blocking sends here?
+            # Returns false only if quit event is active.
+            if not connector.send(self._send_bufs[b_id][parity],
+                                  self._quit_event):
+                return
 
     @profile(TimeProfile.RECV_DISTS)
     def _recv_dists(self):
-        def distribute(cbuf):
-            # _recv_dists is called after the iteration counter has been updated.
-            if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
-                cbuf.distribute_unpropagated(self.backend, self._data_stream)
-            else:
-                cbuf.distribute(self.backend, self._data_stream)
-
+        # _recv_dists is called after the iteration counter has been updated.
         if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
-            get_buf = operator.attrgetter('local_recv_buf.host')
+            self._recv_all(self._recv_unpropagated_dists_from)
         else:
-            get_buf = operator.attrgetter('recv_buf')
+            self._recv_all(self._recv_dists_from)
 
-        for b_id, connector in self._spec._connectors.items():
-            conn_bufs = self._recv_block_to_connbuf[b_id]
-            if len(conn_bufs) > 1:
-                dest = np.hstack([np.ravel(get_buf(x)) for x in conn_bufs])
-                self._profile.record_cpu_start(TimeProfile.NET_RECV)
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
-                    return
+    def _recv_all(self, recv_from):
+        """Receives distributions from all connected subdomains.
 
-                self._profile.record_cpu_end(TimeProfile.NET_RECV)
-                i = 0
-                for cbuf in conn_bufs:
-                    recv_buf = get_buf(cbuf)
-                    l = recv_buf.size
-                    recv_buf[:] = dest[i:i+l].reshape(recv_buf.shape)
-                    i += l
-                    distribute(cbuf)
-            else:
-                cbuf = conn_bufs[0]
-                recv_buf = get_buf(cbuf)
-                dest = np.ravel(recv_buf)
+        :param recv_from: callable receiving data from a single subdomain,
+            taking its ID and returning False if the quit event is active
+        """
+        handles = [(connector.poll_handle(), b_id) for b_id, connector in
+                   self._spec._connectors.items()]
+        if not handles:
+            return
 
-                # Returns false only if quit event is active.
+        # Wait for data from all connected subdomains at the same time and
+        # process it in the order in which it arrives, so that data from
+        # one subdomain can be distributed while waiting for the others.
+        if all(handle is not None for handle, _ in handles):
+            poller = zmq.Poller()
+            pending = {}
+            for handle, b_id in handles:
+                poller.register(handle, zmq.POLLIN)
+                pending[handle] = b_id
+
+            while pending:
                 self._profile.record_cpu_start(TimeProfile.NET_RECV)
-                if not connector.recv(dest, self._quit_event):
+                events = poller.poll(self._recv_poll_timeout)
+                self._profile.record_cpu_end(TimeProfile.NET_RECV)
+                if self._quit_event.is_set():
                     return
 
+                for handle, _ in events:
+                    b_id = pending.pop(handle)
+                    poller.unregister(handle)
+                    if not recv_from(b_id):
+                        return
+        else:
+            for _, b_id in handles:
+                self._profile.record_cpu_start(TimeProfile.NET_RECV)
+                ret = recv_from(b_id)
                 self._profile.record_cpu_end(TimeProfile.NET_RECV)
-                # If ravel returned a copy, we need to write the data
-                # back to the proper buffer.
-                # TODO(michalj): Check if there is any way of avoiding this
-                # copy.
-                if dest.flags.owndata:
-                    recv_buf[:] = dest.reshape(recv_buf.shape)
-                distribute(cbuf)
+                if not ret:
+                    return
 
-    def _fields_to_host(self, sync=False):
-        """Copies data for all fields from the GPU to the host."""
+    def _recv_dists_from(self, b_id):
+        """Receives distributions from a single subdomain and schedules them
+        for distribution.
+
+        :param b_id: ID of the remote subdomain
+        :rvalue: False if the quit event is active, True otherwise
+        """
+        # The recv buffers of all connections with the remote subdomain
+        # are views into a single contiguous buffer, so the received data
+        # can be distributed without any intermediate copies.
+        connector = self._spec._connectors[b_id]
+        if not connector.recv(self._recv_bufs[b_id], self._quit_event):
+            return False
+
+        for cbuf in self._recv_block_to_connbuf[b_id]:
+            cbuf.distribute(self.backend, self._data_stream)
+        return True
+
+    def _recv_unpropagated_dists_from(self, b_id):
+        """Receives data for the fully local step of the AA access pattern
+        from a single subdomain.
+
+        :param b_id: ID of the remote subdomain
+        :rvalue: False if the quit event is active, True otherwise
+        """
+        get_buf = operator.attrgetter('local_recv_buf.host')
+        connector = self._spec._connectors[b_id]
+        conn_bufs = self._recv_block_to_connbuf[b_id]
+        if len(conn_bufs) > 1:
+            dest = np.hstack([np.ravel(get_buf(x)) for x in conn_bufs])
+            if not connector.recv(dest, self._quit_event):
+                return False
+
+            i = 0
+            for cbuf in conn_bufs:
+                recv_buf = get_buf(cbuf)
+                l = recv_buf.size
+                recv_buf[:] = dest[i:i+l].reshape(recv_buf.shape)
+                i += l
+                cbuf.distribute_unpropagated(self.backend, self._data_stream)
+        else:
+            cbuf = conn_bufs[0]
+            recv_buf = get_buf(cbuf)
+            dest = np.ravel(recv_buf)
+            if not connector.recv(dest, self._quit_event):
+                return False
+
+            # If ravel returned a copy, we need to write the data
+            # back to the proper buffer.
+            # TODO(michalj): Check if there is any way of avoiding this
+            # copy.
+            if dest.flags.owndata:
+                recv_buf[:] = dest.reshape(recv_buf.shape)
+            cbuf.distribute_unpropagated(self.backend, self._data_stream)
+        return True
+
+    def _fields_to_host(self, sync=False, exclude=()):
+        """Copies data for all fields from the GPU to the host.
+
+        :param exclude: IDs of fields which should not be copied
+        """
         for field in self._scalar_fields:
+            if id(field) in exclude:
+                continue
             self.backend.from_buf_async(self.gpu_field(field), self._calc_stream)
 
         for field in self._vector_fields:
+            if id(field) in exclude:
+                continue
             for component in self.gpu_field(field):
                 self.backend.from_buf_async(component, self._calc_stream)
 
@@ -1395,10 +1545,42 @@ class SubdomainRunner(object):
         gy = rest // arr_nx
         return dist_num, gy, gx
 
+    def global_sum(self, values):
+        """Sums values over all subdomains of the simulation.
+
+        Has to be called in the same iterations in all subdomains.  The sums
+        are computed by the machine master (and the controller in cluster
+        simulations), and are identical in all subdomains.
+
+        :param values: list of numbers
+        :rvalue: list of sums of the corresponding elements of values
+        """
+        # Single process mode and unit tests.
+        if self._master_sock is None:
+            return list(values)
+
+        self._master_sock.send_pyobj(util.GlobalSumRequest(
+            self._sim.iteration, list(values)))
+        # Do not wait forever if the simulation is being terminated, e.g.
+        # after another subdomain failed.
+        while not self._master_sock.poll(self._recv_poll_timeout):
+            if self._quit_event.is_set():
+                return list(values)
+        sums = self._master_sock.recv_pyobj()
+        if sums is None:
+            raise ValueError('Global sums requested in different iterations '
+                             'in different subdomains.')
+        return sums
+
     def send_summary_info(self, timing_info, min_timings, max_timings):
         if self._summary_sender is not None:
+            # Statistics of connectors which collect them, e.g. to select
+            # the compression method.
+            link_stats = dict((b_id, c.stats()) for b_id, c in
+                              self._spec._connectors.items()
+                              if hasattr(c, 'stats'))
             self._summary_sender.send_pyobj((timing_info, min_timings,
-                    max_timings, self._subdomain.active_nodes))
+                    max_timings, self._subdomain.active_nodes, link_stats))
             self.config.logger.debug('Sending timing information to controller.')
             assert self._summary_sender.recv() == 'ack'
 
@@ -1407,43 +1589,207 @@ class SubdomainRunner(object):
         # Applies initial conditions on the GPU.
         self._sim.initial_conditions(self)
 
-    def save_checkpoint(self):
+    def save_checkpoint(self, wait=False):
+        """Starts saving a checkpoint.
+
+        The distributions are copied to page-locked host buffers on the data
+        stream and written to disk in a background thread, so that the
+        simulation can continue in the meantime.
+
+        :param wait: if True, waits for the transfer of the distributions
+            to the host to complete
+        """
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = io.CheckpointWriter(
+                self.config.checkpoint_delta_every,
+                self.config.checkpoint_delta_tolerance,
+                self.config.checkpoint_format)
+
+        writer = self._checkpoint_writer
         if self.config.single_checkpoint:
+            # Delta checkpoints need to be kept separately from the full
+            # checkpoint they refer to.
             fname = io.checkpoint_filename(self.config.checkpoint_file,
-                    1, self._spec.id, 0)
+                    1, self._spec.id, 0 if writer.next_is_full() else 1)
         else:
             fname = io.checkpoint_filename(self.config.checkpoint_file,
                     io.filename_iter_digits(self.config.max_iters),
                     self._spec.id, self._sim.iteration)
 
-        sim_state = pickle.dumps(self._sim.get_state(), -1)
-        data = { 'state': sim_state }
+        # The host buffers are reused, so wait for the previous checkpoint
+        # to be written.
+        writer.wait()
 
+        iter_idx = self._sim.iteration & 1
+        gpu_dists = []
         for i in range(len(self._sim.grids)):
-            data['dist{0}a'.format(i)] = self._debug_get_dist(True, i)
+            gpu_dists.append(('dist{0}a'.format(i),
+                              self.gpu_dist(i, iter_idx)))
             if self.config.access_pattern == 'AB':
-                data['dist{0}b'.format(i)] = self._debug_get_dist(False, i)
+                gpu_dists.append(('dist{0}b'.format(i),
+                                  self.gpu_dist(i, 1 - iter_idx)))
 
-        np.savez(fname, **data)
+        if self.config.node_addressing == 'indirect':
+            shape = (self._sim.grid.Q, self.num_active_nodes)
+        else:
+            shape = tuple([self._sim.grid.Q] + self._physical_size)
+
+        dists = {}
+        for name, gpu_buf in gpu_dists:
+            if name not in self._checkpoint_bufs:
+                self._checkpoint_bufs[name] = self.backend.alloc_async_host_buf(
+                    shape, dtype=self.float)
+            dists[name] = self._checkpoint_bufs[name]
+            self.backend.from_buf_async(gpu_buf, self._data_stream,
+                                        target=dists[name])
+
+        # Kernels on the calculation stream can overwrite the distributions
+        # once the transfer is complete.
+        self._calc_stream.wait_for_event(
+            self.backend.make_event(self._data_stream))
+
+        sim_state = self._sim.get_state()
+        # Allow mix-ins to store their own data in the checkpoint.
+        for c in self._sim.__class__.mro()[1:]:
+            if (issubclass(c, LBMixIn) and hasattr(c, 'get_checkpoint_state')
+                and not issubclass(c, LBSim)):
+                sim_state[c.__name__] = c.get_checkpoint_state(self._sim, self)
+        sim_state = pickle.dumps(sim_state, -1)
+        info = {
+            'iteration': self._sim.iteration,
+            'subdomain': self._spec.id,
+            'location': list(self._spec.location),
+            'size': list(self._spec.size),
+            'envelope_size': self._spec.envelope_size,
+            'node_addressing': self.config.node_addressing,
+            'node_ordering': self.config.node_ordering,
+        }
+        self._checkpoint_pending = (fname, sim_state, dists, info)
+        if wait:
+            self.backend.sync_stream(self._data_stream)
+            self._submit_checkpoint()
+
+    def _submit_checkpoint(self):
+        """Hands the snapshot of the distributions over to the checkpoint
+        writer. Can only be called after the data stream is synchronized."""
+        if self._checkpoint_pending is not None:
+            self._checkpoint_writer.save(*self._checkpoint_pending)
+            self._checkpoint_pending = None
 
     def restore_checkpoint(self, fname):
         self.config.logger.info('Restoring checkpoint from {0}'.format(fname))
 
-        cpoint = np.load(fname)
-        sim_state = pickle.loads(str(cpoint['state']))
+        if fname.endswith('.json'):
+            state, dists = self._load_raw_checkpoint(fname)
+        else:
+            # Checkpoints saved before the subdomain description was stored
+            # in npz files always use the row-major order of nodes.
+            info = io.load_checkpoint_info(fname)
+            addressing = info.get('node_addressing',
+                                  self.config.node_addressing)
+            ordering = info.get('node_ordering', 'row_major')
+            if (addressing != self.config.node_addressing or
+                    (addressing == 'indirect' and
+                     ordering != self.config.node_ordering)):
+                raise ValueError('Restoring a checkpoint saved with a '
+                                 'different node addressing mode or node '
+                                 'ordering is not supported.')
+            state, dists = io.load_checkpoint(fname)
+        sim_state = pickle.loads(state if isinstance(state, bytes)
+                                 else str(state))
         self._sim.set_state(sim_state)
         if not self.config.restore_time:
             self._sim.iteration = 0
+        for c in self._sim.__class__.mro()[1:]:
+            if (issubclass(c, LBMixIn) and hasattr(c, 'set_checkpoint_state')
+                and not issubclass(c, LBSim) and c.__name__ in sim_state):
+                c.set_checkpoint_state(self._sim, self, sim_state[c.__name__])
 
-        for k, v in cpoint.items():
-            if not k.startswith('dist'):
-                continue
-
+        for k, v in dists.items():
             is_primary = k.endswith('a')
             dist_num = int(k[4:-1])
 
             self._debug_set_dist(v, is_primary, dist_num)
 
+    def _load_raw_checkpoint(self, fname):
+        """Loads distributions from a checkpoint in the raw format.
+
+        If the checkpoint was saved with the same subdomain decomposition,
+        the distributions are memory-mapped from the data file and uploaded
+        directly to the device.  Otherwise, they are assembled from the
+        parts of the global lattice covered by the current subdomain.
+
+        :returns: tuple of: pickled simulation state, dict of distribution
+            arrays
+        """
+        manifests = io.load_checkpoint_manifests(fname)
+        if not manifests:
+            raise ValueError('No checkpoint manifests found for {0}'.format(
+                fname))
+
+        spec = self._spec
+        if self.config.node_addressing == 'indirect':
+            shape = [self._sim.grid.Q, self.num_active_nodes]
+        else:
+            shape = [self._sim.grid.Q] + self._physical_size
+        dtype = np.dtype(self.float).str
+
+        for m in manifests:
+            if (m['location'] == list(spec.location) and
+                    m['size'] == list(spec.size) and
+                    m['envelope_size'] == spec.envelope_size and
+                    m['node_addressing'] == self.config.node_addressing and
+                    (self.config.node_addressing == 'direct' or
+                     m.get('node_ordering', 'row_major') ==
+                     self.config.node_ordering) and
+                    all(a['shape'] == shape and a['dtype'] == dtype
+                        for a in m['arrays'].values())):
+                return m['state'], dict((name, io.checkpoint_array(m, name))
+                                        for name in m['arrays'])
+
+        if self.config.node_addressing == 'indirect':
+            raise ValueError('Restoring a checkpoint saved with a different '
+                             'subdomain decomposition or node ordering is '
+                             'not supported with indirect node addressing.')
+
+        self.config.logger.info('Re-slicing checkpoint saved with a different '
+                                'subdomain decomposition.')
+        dim = spec.dim
+        gsize = [self._subdomain.gx, self._subdomain.gy]
+        periodic = [self.config.periodic_x, self.config.periodic_y]
+        if dim == 3:
+            gsize.append(self._subdomain.gz)
+            periodic.append(self.config.periodic_z)
+        # Global coordinates of the nodes of this subdomain (including ghost
+        # nodes) along every axis, in array order.
+        coords = []
+        for axis in reversed(range(dim)):
+            c = (np.arange(spec.actual_size[axis]) + spec.location[axis] -
+                 spec.envelope_size)
+            if periodic[axis]:
+                c %= gsize[axis]
+            coords.append((axis, c))
+
+        dists = {}
+        for name in manifests[0]['arrays']:
+            dbuf = np.zeros(shape, dtype=self.float)
+            for m in manifests:
+                dst_idx = []
+                src_idx = []
+                for axis, c in coords:
+                    rel = c - m['location'][axis]
+                    sel = np.nonzero((rel >= 0) & (rel < m['size'][axis]))[0]
+                    dst_idx.append(sel)
+                    src_idx.append(rel[sel] + m['envelope_size'])
+                if any(len(x) == 0 for x in dst_idx):
+                    continue
+                src = io.checkpoint_array(m, name)
+                dbuf[(slice(None),) + np.ix_(*dst_idx)] = \
+                        src[(slice(None),) + np.ix_(*src_idx)]
+            dists[name] = dbuf
+
+        return manifests[0]['state'], dists
+
     def _prepare_compute_kernels(self):
         gck = self._sim.get_compute_kernels
 
@@ -1553,6 +1899,9 @@ class SubdomainRunner(object):
             self._subdomain.init_fields(self._sim)
         self._init_gpu_data()
         self._init_force_objects()
+        # Geometry updates from the frontend modify the dense maps.
+        if self._sparse_host and self._spec.geo_queue is None:
+            self._subdomain.release_dense_maps()
         self.config.logger.debug("Initializing GPU kernels.")
 
         self._init_buffers()
@@ -1562,6 +1911,13 @@ class SubdomainRunner(object):
             self._pbc_kernels = self._sim.get_pbc_kernels(self)
         self._aux_kernels = self._sim.get_aux_kernels(self)
 
+        if self.config.output and self.config.output_reduce:
+            self._output_reduction = OutputReductionStage(
+                self, self._output_fields,
+                parse_output_reduction(self.config.output_reduce),
+                self.config.output_average_every)
+        self._output_policy = self._make_output_policy()
+
         # No need to run the potentially costly initilization if we are
         # restarting from a checkpoint.
         if restore_filename is None:
@@ -1571,13 +1927,19 @@ class SubdomainRunner(object):
             # Run self-consistent (density) initialization if requested.
             if self._initialization:
                 self.initialize()
-
-            # Save initial state of the simulation.
-            if self.config.output and self.config.from_ == 0:
-                self.config.logger.debug("Saving initial state.")
-                self._output.save(self._sim.iteration)
         else:
             self.restore_checkpoint(restore_filename)
+        self._output_policy.start()
+
+        # Save initial state of the simulation.
+        if (restore_filename is None and self.config.output and
+                self.config.from_ == 0):
+            self.config.logger.debug("Saving initial state.")
+            if self._output_reduction is not None:
+                self._output_reduction.sample(output=True)
+                self.backend.sync_stream(self._calc_stream)
+            self._output.save(self._sim.iteration)
+            self._output_policy.output_saved()
 
         if not self.config.max_iters:
             self.config.logger.warning("Running infinite simulation.")
@@ -1597,6 +1959,39 @@ class SubdomainRunner(object):
             "Simulation completed after {0} iterations.".format(
                 self._sim.iteration))
 
+    def _make_output_policy(self):
+        if self._sim.output_policy is not None:
+            policy = self._sim.output_policy(self)
+            # Custom policies could save the output in different iterations
+            # in different subdomains.
+            self._check_output_policy = not policy.synchronized
+            return policy
+        if self.config.output_change_threshold > 0.0:
+            return ChangeDrivenOutputPolicy(self,
+                                            self.config.output_change_threshold,
+                                            self.config.output_max_interval)
+        return OutputPolicy(self)
+
+    _check_output_policy = False
+    _output_policy_warned = False
+
+    def _agree_on_output(self, output_req):
+        """Verifies that the output policy made the same decision in all
+        subdomains.
+
+        :rvalue: True if the output is to be saved in any of the subdomains
+        """
+        requested, total = self.global_sum([int(output_req), 1])
+        if 0 < requested < total:
+            if not self._output_policy_warned:
+                self.config.logger.warning(
+                    'Output policy requested output in iteration {0} in {1} '
+                    'out of {2} subdomains. Saving output in all subdomains.'
+                    .format(self._sim.iteration, requested, total))
+                self._output_policy_warned = True
+            return True
+        return output_req
+
     def need_quit(self):
         if self.config.max_iters > 0:
             it = self._sim.iteration
@@ -1669,11 +2064,17 @@ class SubdomainRunner(object):
             while True:
                 self._profile.start_step()
 
-                output_req = self._sim.need_output()
-                sync_req, fields_req = self._sim.need_sync_fields()
+                host_sync_req = self._sim.need_sync_flag
+                output_cand = self._output_policy.output_candidate()
+                sync_req, fields_req = self._sim.need_sync_fields(output=False)
+                sample_req = (self._output_reduction is not None and
+                              self._output_reduction.sample_due(
+                                  self._sim.iteration))
+                reduce_req = self._output_reduction is not None and (
+                    output_cand or sample_req)
 
                 # Distribution dumping.
-                if sync_req and self.config.debug_dump_dists:
+                if (sync_req or output_cand) and self.config.debug_dump_dists:
                     bufs = []
                     for i in range(len(self._sim.grids)):
                         bufs.append(self._debug_get_dist(self, grid_num=i))
@@ -1681,10 +2082,27 @@ class SubdomainRunner(object):
                     del bufs
 
                 # Updates the iteration number.
-                self.step(fields_req)
+                self.step(fields_req or output_cand or reduce_req)
+
+                # The output policy decides whether to save the output once
+                # the fields are computed.
+                output_req = output_cand and self._output_policy.need_output()
+                if output_cand and self._check_output_policy:
+                    output_req = self._agree_on_output(output_req)
+                sync_req = sync_req or output_req
+
+                if reduce_req and (output_req or sample_req):
+                    self._output_reduction.sample(output=output_req)
 
                 if sync_req:
-                    self._fields_to_host()
+                    # Reduced output fields are transferred by the reduction
+                    # stage. The full fields are only needed if explicitly
+                    # requested.
+                    if self._output_reduction is not None and not host_sync_req:
+                        self._fields_to_host(
+                            exclude=self._output_reduction.field_ids)
+                    else:
+                        self._fields_to_host()
 
                 # Periodically log effective performance.
                 pse = self.config.perf_stats_every
@@ -1709,8 +2127,9 @@ class SubdomainRunner(object):
                 # tasks should be above this line to minimize performance
                 # impact.
                 self.backend.sync_stream(self._data_stream, self._calc_stream)
+                self._submit_checkpoint()
 
-                if sync_req and self._host_indirect_address is not None:
+                if sync_req and self.config.node_addressing == 'indirect':
                     self._unravel_fields()
 
                 if output_req:
@@ -1722,6 +2141,7 @@ class SubdomainRunner(object):
                         self._quit_event.set()
                         break
                     self._output.save(self._sim.iteration)
+                    self._output_policy.output_saved()
                 elif sync_req:
                     # Required so that custom code in "after_step" below does
                     # not get access to potentially invalid field values. If
@@ -1747,16 +2167,18 @@ class SubdomainRunner(object):
             # we don't run into problems with zmq.
             self._data_stream.synchronize()
             self._calc_stream.synchronize()
+            self._submit_checkpoint()
             if output_req:
-                if self._host_indirect_address is not None:
+                if self.config.node_addressing == 'indirect':
                     self._unravel_fields()
                 self._output.save(self._sim.iteration)
+                self._output_policy.output_saved()
 
             self._profile.record_end()
 
             if (self._sim.iteration >= self.config.max_iters and
                     self.config.checkpoint_file and self.config.final_checkpoint):
-                self.save_checkpoint()
+                self.save_checkpoint(wait=True)
 
             self._sim.after_main_loop(self)
 
@@ -1770,6 +2192,8 @@ class SubdomainRunner(object):
             self._quit_event.set()
 
         self._output.wait()
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
 
 
 class IBMSubdomainRunner(SubdomainRunner):
@@ -1907,11 +2331,13 @@ class NNSubdomainRunner(SubdomainRunner):
         for b_id, connector in self._spec._connectors.items():
             conn_bufs = self._block_to_macrobuf[b_id]
             if len(conn_bufs) > 1:
-                connector.send(np.hstack(
-                    [np.ravel(x.coll_buf.host) for x in conn_bufs]))
+                data = np.hstack([np.ravel(x.coll_buf.host) for x in conn_bufs])
             else:
                 # TODO(michalj): Use non-blocking sends here?
-                connector.send(np.ravel(conn_bufs[0].coll_buf.host).copy())
+                data = np.ravel(conn_bufs[0].coll_buf.host).copy()
+            # Returns false only if quit event is active.
+            if not connector.send(data, self._quit_event):
+                return
 
     def _macro_idx_helper(self, gx, buf_slice):
         idx = np.mgrid[list(reversed(buf_slice))].astype(np.uint32)
@@ -0,0 +1,54 @@
+## Kernels to accumulate running statistics of macroscopic fields at every
+## node of the subdomain, using Welford's algorithm:
+##
+##  d = f - <f>_(n-1)
+##  <f>_n = <f>_(n-1) + d / n
+##  M2_n = M2_(n-1) + d^2 (n - 1) / n
+##  C_n = C_(n-1) + d_f d_g (n - 1) / n
+##
+## where n is the number of the current sample. The variance and covariance
+## are M2_n / n and C_n / n, respectively. All accumulators use double
+## precision. Covariances have to be updated before the means.
+
+<%namespace file="kernel_common.mako" import="*"/>
+
+${kernel} void UpdateFieldMoments(
+  ${nodes_array_if_required()}
+  ${global_ptr} ${const_ptr} int *__restrict__ map,
+  ${global_ptr} ${const_ptr} float *__restrict__ f,
+  ${global_ptr} double *__restrict__ mean,
+  ${global_ptr} double *__restrict__ m2,
+  int n)
+{
+  ${local_indices()}
+  ${indirect_index()}
+
+  if (!isWetNode(decodeNodeType(map[gi]))) {
+    return;
+  }
+
+  const double d = f[gi] - mean[gi];
+  m2[gi] += d * d * ((double)(n - 1) / n);
+  mean[gi] += d / n;
+}
+
+${kernel} void UpdateFieldCovariance(
+  ${nodes_array_if_required()}
+  ${global_ptr} ${const_ptr} int *__restrict__ map,
+  ${global_ptr} ${const_ptr} float *__restrict__ f,
+  ${global_ptr} ${const_ptr} float *__restrict__ g,
+  ${global_ptr} ${const_ptr} double *__restrict__ mean_f,
+  ${global_ptr} ${const_ptr} double *__restrict__ mean_g,
+  ${global_ptr} double *__restrict__ cov,
+  int n)
+{
+  ${local_indices()}
+  ${indirect_index()}
+
+  if (!isWetNode(decodeNodeType(map[gi]))) {
+    return;
+  }
+
+  cov[gi] += (f[gi] - mean_f[gi]) * (g[gi] - mean_g[gi]) *
+      ((double)(n - 1) / n);
+}
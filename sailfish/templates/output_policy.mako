@@ -0,0 +1,49 @@
+## Kernels used by the change-driven output policy to detect how much the
+## flow changed since the last saved snapshot.
+
+<%namespace file="kernel_common.mako" import="*"/>
+
+<%def name="velocity_args(prefix, const=True, last=False)">
+  %for i in range(dim):
+  ${global_ptr} ${const_ptr if const else ''} float *__restrict__ ${prefix}${i}${'' if last and i == dim - 1 else ','}
+  %endfor
+</%def>
+
+// Computes the squared magnitude of the difference between the current
+// velocity and its snapshot at every wet node.  Other nodes are set to 0.
+${kernel} void ComputeVelocityChange(
+  ${nodes_array_if_required()}
+  ${global_ptr} ${const_ptr} int *__restrict__ map,
+  ${velocity_args('v')}
+  ${velocity_args('snap')}
+  ${global_ptr} float *__restrict__ change)
+{
+  ${local_indices()}
+  ${indirect_index()}
+
+  if (!isWetNode(decodeNodeType(map[gi]))) {
+    change[gi] = 0.0f;
+    return;
+  }
+
+  float d, sum = 0.0f;
+  %for i in range(dim):
+    d = v${i}[gi] - snap${i}[gi];
+    sum += d * d;
+  %endfor
+  change[gi] = sum;
+}
+
+// Stores the current velocity as the reference snapshot.
+${kernel} void StoreVelocitySnapshot(
+  ${nodes_array_if_required()}
+  ${velocity_args('v')}
+  ${velocity_args('snap', const=False, last=True)})
+{
+  ${local_indices()}
+  ${indirect_index()}
+
+  %for i in range(dim):
+    snap${i}[gi] = v${i}[gi];
+  %endfor
+}
@@ -0,0 +1,110 @@
+## Kernels used to reduce macroscopic fields on the compute device before
+## they are transferred to the host for output:
+##  - block averaging over factor^dim nodes,
+##  - running time averages over all samples taken since the last output,
+##  - conversion to half precision.
+##
+## The reduced fields are stored in dense arrays of size cnx x cny [x cnz],
+## without any ghost nodes or padding.
+
+<%namespace file="kernel_common.mako" import="*"/>
+
+// Averages a field over blocks of factor^dim wet nodes and updates the running
+// time average stored in acc. Blocks without any wet nodes are set to NaN.
+//
+// es: size of the ghost node envelope
+// nx, ny, nz: size of the subdomain (without ghost nodes)
+// count: 1-based number of the current sample in the averaging window
+${kernel} void ReduceOutputField(
+  ${nodes_array_if_required()}
+  ${global_ptr} ${const_ptr} int *__restrict__ map,
+  ${global_ptr} ${const_ptr} float *__restrict__ field,
+  ${global_ptr} float *__restrict__ acc,
+  int factor, int es, int nx, int ny,
+%if dim == 3:
+  int nz,
+%endif
+  int count)
+{
+  const int cnx = (nx + factor - 1) / factor;
+  const int cny = (ny + factor - 1) / factor;
+  const int cx = get_global_id(0);
+%if dim == 2:
+  const int cy = get_group_id(1);
+  const int ci = cx + cnx * cy;
+%else:
+  const int cy = get_group_id(1) % cny;
+  const int cz = get_group_id(1) / cny;
+  const int ci = cx + cnx * (cy + cny * cz);
+%endif
+
+  if (cx >= cnx) {
+    return;
+  }
+
+  float sum = 0.0f;
+  int wet = 0;
+
+%if dim == 3:
+  for (int z = cz * factor; z < min((cz + 1) * factor, nz); z++) {
+%endif
+  for (int y = cy * factor; y < min((cy + 1) * factor, ny); y++) {
+    for (int x = cx * factor; x < min((cx + 1) * factor, nx); x++) {
+      %if dim == 2:
+        unsigned int gi = getGlobalIdx(x + es, y + es);
+      %else:
+        unsigned int gi = getGlobalIdx(x + es, y + es, z + es);
+      %endif
+      %if node_addressing == 'indirect':
+        gi = nodes[gi];
+        if (gi == INVALID_NODE) {
+          continue;
+        }
+      %endif
+      if (isWetNode(decodeNodeType(map[gi]))) {
+        sum += field[gi];
+        wet++;
+      }
+    }
+  }
+%if dim == 3:
+  }
+%endif
+
+  const float val = (wet > 0) ? sum / wet : NAN;
+  if (count <= 1) {
+    acc[ci] = val;
+  } else {
+    acc[ci] += (val - acc[ci]) / count;
+  }
+}
+
+// Converts a reduced field to half precision.
+${kernel} void PackOutputFieldHalf(
+  ${global_ptr} ${const_ptr} float *__restrict__ acc,
+%if backend == 'cuda':
+  ${global_ptr} unsigned short *out,
+%else:
+  ${global_ptr} half *out,
+%endif
+  int cnx)
+{
+  const int cx = get_global_id(0);
+  const int ci = cx + cnx * get_group_id(1);
+
+  if (cx >= cnx) {
+    return;
+  }
+
+%if backend == 'cuda':
+  unsigned short h;
+  %if config.precision == 'double':
+    asm("cvt.rn.f16.f64 %0, %1;" : "=h"(h) : "d"(acc[ci]));
+  %else:
+    asm("cvt.rn.f16.f32 %0, %1;" : "=h"(h) : "f"(acc[ci]));
+  %endif
+  out[ci] = h;
+%else:
+  vstore_half(acc[ci], ci, out);
+%endif
+}
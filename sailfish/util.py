@@ -8,18 +8,24 @@ __license__ = 'LGPL3'
 from collections import defaultdict, namedtuple
 import gzip
 import logging
+import multiprocessing
 import random
 import socket
 import sys
 
 import numpy as np
 from math import exp, log, ceil
+from multiprocessing.pool import ThreadPool
 
 from sailfish import config
 from sailfish import sym
 
 TimingInfo = namedtuple('TimingInfo',
-                        'comp bulk bnd coll net_wait recv send total total_sq subdomain_id')
+                        'comp bulk bnd coll net_wait recv send stats total total_sq subdomain_id')
+
+#: Request for sums of values over all subdomains, sent by the subdomain
+#: runners to the machine master (see SubdomainRunner.global_sum()).
+GlobalSumRequest = namedtuple('GlobalSumRequest', 'iteration values')
 
 
 class GridError(Exception):
@@ -167,6 +173,113 @@ def in_anyd_fast(arr1, values):
     return ret
 
 
+def chunked_stencil(func, array, halo=1, num_threads=0, chunk_nodes=1 << 20):
+    """Applies a stencil operation to an array, processing it in chunks
+    in parallel.
+
+    The array is split into chunks along its first axis.  For every chunk,
+    func(block, start, stop) is called, where block is a C-contiguous copy of
+    array[start-halo:stop+halo] extended by halo nodes along all remaining
+    axes, with periodic wrapping at the boundaries of the array (i.e. the
+    same semantics as np.roll).  Use shifted_view() or flat_offset() to
+    access the neighbors of the nodes within the chunk.
+
+    The chunks are processed by a pool of threads.  func should therefore
+    rely on numpy operations that release the GIL, and must not write to
+    locations outside of [start, stop) along the first axis.
+
+    :rvalue: list of values returned by func, in the order of the chunks
+
+    :param func: callable to apply to every chunk
+    :param array: array to process
+    :param halo: number of neighbor nodes to include on every side
+    :param num_threads: number of worker threads; if 0, the number of CPUs
+        is used
+    :param chunk_nodes: approximate number of nodes in a chunk
+    """
+    n = array.shape[0]
+    assert halo <= min(array.shape)
+    row_nodes = max(int(np.prod(array.shape[1:])), 1)
+    rows = max(1, min(n, chunk_nodes // row_nodes))
+    chunks = [(start, min(start + rows, n)) for start in range(0, n, rows)]
+
+    def _axis_slice(axis, start, stop):
+        ret = [slice(None)] * array.ndim
+        ret[axis] = slice(start, stop)
+        return tuple(ret)
+
+    def _process(chunk):
+        start, stop = chunk
+        block = np.empty([stop - start + 2 * halo] +
+                         [m + 2 * halo for m in array.shape[1:]],
+                         dtype=array.dtype)
+        interior = (slice(None),) + tuple(slice(halo, halo + m) for m in
+                                          array.shape[1:])
+        if start >= halo and stop + halo <= n:
+            block[interior] = array[start - halo:stop + halo]
+        else:
+            block[interior] = array[np.arange(start - halo, stop + halo) % n]
+
+        # Halos filled for the preceding axes are copied along with the
+        # rest of the hyperplanes, which takes care of the corners.
+        for axis in range(1, array.ndim):
+            m = array.shape[axis]
+            block[_axis_slice(axis, 0, halo)] = block[_axis_slice(axis, m, m + halo)]
+            block[_axis_slice(axis, m + halo, m + 2 * halo)] = \
+                    block[_axis_slice(axis, halo, 2 * halo)]
+        return func(block, start, stop)
+
+    if num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+    num_threads = min(num_threads, len(chunks))
+
+    if num_threads <= 1:
+        return [_process(chunk) for chunk in chunks]
+    else:
+        pool = ThreadPool(num_threads)
+        try:
+            return pool.map(_process, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def shifted_view(block, shift, halo=1):
+    """Returns a view of the neighbors of the nodes within a block.
+
+    :param block: array passed to the function called by chunked_stencil()
+    :param shift: offset of the neighbor, in the order of the array axes
+    :param halo: the value used in chunked_stencil()
+    """
+    return block[tuple(slice(halo + s, m - halo + s) for s, m in
+                       zip(shift, block.shape))]
+
+
+def flat_offset(block, shift):
+    """Returns the distance between the flat indices of a node and its
+    neighbor within a block passed by chunked_stencil().
+
+    :param shift: offset of the neighbor, in the order of the array axes
+    """
+    return int(np.dot(shift, np.array(block.strides) // block.itemsize))
+
+
+def block_sum(arr, factor, dtype=None):
+    """Sums an array over blocks of factor^ndim elements.
+
+    Blocks at the end of an axis the size of which is not a multiple of
+    factor are partial.
+
+    :param arr: array to reduce
+    :param factor: linear size of the blocks
+    :param dtype: data type of the result; defaults to that of arr
+    """
+    ret = np.asarray(arr, dtype=dtype)
+    for axis, n in enumerate(arr.shape):
+        ret = np.add.reduceat(ret, np.arange(0, n, factor), axis=axis)
+    return ret
+
+
 def is_number(param):
     return type(param) is float or type(param) is int or isinstance(param, np.number)
 
@@ -309,6 +422,19 @@ def energy_spectrum(velocity, buckets=None, density=False):
     return spectrum
 
 
+def global_sums(requests):
+    """Sums the values of GlobalSumRequests from all subdomains.
+
+    :param requests: iterable of GlobalSumRequest objects
+    :rvalue: list of sums of the corresponding elements of the values, or None
+        if the requests were sent in different iterations
+    """
+    requests = list(requests)
+    if len(set(r.iteration for r in requests)) != 1:
+        return None
+    return [sum(x) for x in zip(*[r.values for r in requests])]
+
+
 def lazy_property(f):
     attr_name = '_lazy_' + f.__name__
     @property
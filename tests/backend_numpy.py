@@ -0,0 +1,791 @@
+#!/usr/bin/env python
+"""Verifies the NumPy CPU backend."""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import io
+from sailfish.geo import EqualSubdomainsGeometry2D
+from sailfish.subdomain import Subdomain2D, Subdomain3D
+from sailfish.node_type import NTRegularizedVelocity
+from sailfish.lb_single import LBFluidSim
+from sailfish.output_policy import OutputPolicy
+from sailfish.stats import FieldStatsMixIn
+from sailfish.controller import LBSimulationController
+
+amplitude = 1e-3
+visc = 0.05
+
+
+class ShearWaveSubdomain2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        pass
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+        sim.vx[:] = amplitude * np.sin(2.0 * np.pi * hy / self.gy)
+        sim.vy[:] = 0.0
+
+
+class ShearWaveSubdomain3D(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        pass
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+        sim.vx[:] = amplitude * np.sin(2.0 * np.pi * hz / self.gz)
+        sim.vy[:] = 0.0
+        sim.vz[:] = 0.0
+
+
+class HalfShearWaveSubdomain2D(Subdomain2D):
+    """Shear wave limited to the lower half of the domain."""
+
+    def boundary_conditions(self, hx, hy):
+        pass
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+        sim.vx[:] = amplitude * np.maximum(np.sin(2.0 * np.pi * hy / self.gy),
+                                           0.0)
+        sim.vy[:] = 0.0
+
+
+class UnsupportedSubdomain2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node(hx == 0, NTRegularizedVelocity((0.01, 0.0)))
+
+
+class ShearWaveSim2D(LBFluidSim):
+    subdomain = ShearWaveSubdomain2D
+
+
+class ShearWaveSim3D(LBFluidSim):
+    subdomain = ShearWaveSubdomain3D
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults['grid'] = 'D3Q19'
+
+
+class RecordingShearWaveSim2D(ShearWaveSim2D):
+    """Keeps copies of the macroscopic fields from every iteration."""
+
+    def before_main_loop(self, runner):
+        self.history = [(self.rho.copy(), np.array([self.vx, self.vy]))]
+        self.need_sync_flag = True
+
+    def after_step(self, runner):
+        self.history.append((self.rho.copy(), np.array([self.vx, self.vy])))
+        self.need_sync_flag = True
+
+
+class OutputRecordingShearWaveSim2D(ShearWaveSim2D):
+    """Keeps copies of the fields passed to the output."""
+
+    def _record(self, runner):
+        output = runner._output
+        self.saved[self.iteration] = (
+            output._scalar_fields['rho'].copy(),
+            np.array(output._vector_fields['v']))
+
+    def before_main_loop(self, runner):
+        self.saved = {}
+        self._record(runner)
+
+    def after_step(self, runner):
+        if self.iteration % self.config.every == 0:
+            self._record(runner)
+
+
+class FieldStatsShearWaveSim2D(RecordingShearWaveSim2D, FieldStatsMixIn):
+    def before_main_loop(self, runner):
+        super(FieldStatsShearWaveSim2D, self).before_main_loop(runner)
+        self.prepare_field_stats(runner, ['rho', 'vx', 'vy'],
+                                 [('vx', 'vy'), ('rho', 'vx')])
+
+    def after_step(self, runner):
+        super(FieldStatsShearWaveSim2D, self).after_step(runner)
+        self.collect_field_stats(runner)
+
+
+class HalfShearWaveSim2D(LBFluidSim):
+    subdomain = HalfShearWaveSubdomain2D
+
+
+class RecordingHalfShearWaveSim2D(HalfShearWaveSim2D,
+                                  RecordingShearWaveSim2D):
+    pass
+
+
+class FirstSubdomainOutputPolicy(OutputPolicy):
+    """Requests output in even iterations, in the first subdomain only."""
+
+    def need_output(self):
+        return (self._runner._spec.id == 0 and
+                self._runner._sim.iteration % 2 == 0)
+
+
+class FirstSubdomainOutputSim2D(ShearWaveSim2D):
+    output_policy = FirstSubdomainOutputPolicy
+
+
+class UnsupportedSim2D(LBFluidSim):
+    subdomain = UnsupportedSubdomain2D
+
+
+class TestNumpyBackend(unittest.TestCase):
+    n = 32
+    max_iters = 200
+
+    def _run(self, sim_class, dim, model):
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'model': model,
+            'visc': visc,
+            'max_iters': self.max_iters,
+            'lat_nx': self.n,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+        if dim == 3:
+            settings.update({'lat_nz': self.n, 'periodic_z': True})
+
+        ctrl = LBSimulationController(sim_class, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        sim = ctrl.master.sim
+
+        # The shear wave decays exponentially at a rate determined by the
+        # viscosity, and mass is conserved in a fully periodic domain.
+        k = 2.0 * np.pi / self.n
+        expected = amplitude * np.exp(-visc * k**2 * self.max_iters)
+        self.assertAlmostEqual(np.max(sim.vx) / expected, 1.0, delta=0.01)
+        self.assertAlmostEqual(np.mean(sim.rho, dtype=np.float64), 1.0,
+                               places=4)
+        self.assertTrue(np.all(np.abs(sim.vy) < 1e-6))
+
+    def test_shear_wave_2d_bgk(self):
+        self._run(ShearWaveSim2D, 2, 'bgk')
+
+    def test_shear_wave_2d_mrt(self):
+        self._run(ShearWaveSim2D, 2, 'mrt')
+
+    def test_shear_wave_3d_bgk(self):
+        self._run(ShearWaveSim3D, 3, 'bgk')
+
+    def test_multiple_subdomains(self):
+        output_dir = tempfile.mkdtemp()
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 20,
+            'every': 20,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+            'output': output,
+            'subdomains': 2,
+            'conn_axis': 'y',
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            data = [np.load(io.filename(output, digits, i, 20)) for i in
+                    range(2)]
+            rho = np.concatenate([x['rho'] for x in data], axis=0)
+            vx = np.concatenate([x['v'][0] for x in data], axis=0)
+        finally:
+            shutil.rmtree(output_dir)
+
+        # Data exchanged between the subdomains has to reproduce the results
+        # of a simulation run in a single subdomain.
+        del settings['output'], settings['subdomains'], settings['conn_axis']
+        settings['debug_single_process'] = True
+        ctrl = LBSimulationController(ShearWaveSim2D, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        sim = ctrl.master.sim
+        np.testing.assert_array_equal(rho, sim.rho)
+        np.testing.assert_array_equal(vx, sim.vx)
+
+    def test_delta_checkpoint(self):
+        output_dir = tempfile.mkdtemp()
+        cpoint = os.path.join(output_dir, 'cpoint')
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 10,
+            'lat_nx': 16,
+            'lat_ny': 16,
+            'periodic_x': True,
+            'periodic_y': True,
+            'checkpoint_file': cpoint,
+            'checkpoint_every': 4,
+            'checkpoint_delta_every': 3,
+            'final_checkpoint': True,
+        }
+
+        try:
+            # Checkpoints: full at 4, deltas at 8 and 10.
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            base = '{0}.{1:0{2}d}'.format(cpoint, 10, digits)
+            data = np.load(io.subdomain_checkpoint(base, 0))
+            self.assertEqual(str(data['base']), os.path.basename(
+                io.subdomain_checkpoint('{0}.{1:0{2}d}'.format(
+                    cpoint, 4, digits), 0)))
+
+            settings.update({'max_iters': 20, 'restore_from': base,
+                             'checkpoint_every': 0, 'final_checkpoint': False})
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            restored = ctrl.master.sim
+        finally:
+            shutil.rmtree(output_dir)
+
+        del settings['restore_from'], settings['checkpoint_file']
+        ctrl = LBSimulationController(ShearWaveSim2D, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        np.testing.assert_array_equal(restored.rho, ctrl.master.sim.rho)
+        np.testing.assert_array_equal(restored.vx, ctrl.master.sim.vx)
+
+    def test_raw_checkpoint(self):
+        output_dir = tempfile.mkdtemp()
+        cpoint = os.path.join(output_dir, 'cpoint')
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 10,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+            'checkpoint_file': cpoint,
+            'checkpoint_format': 'raw',
+            'final_checkpoint': True,
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            base = '{0}.{1}'.format(cpoint, 10)
+            self.assertTrue(os.path.exists(base + '.0.cpoint.json'))
+
+            # Same decomposition.
+            settings.update({'max_iters': 20, 'restore_from': base,
+                             'final_checkpoint': False})
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            restored = ctrl.master.sim
+
+            # Different decomposition.
+            settings.update({'debug_single_process': False, 'output': output,
+                             'every': 20, 'subdomains': 2, 'conn_axis': 'y'})
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            data = [np.load(io.filename(output, digits, i, 20)) for i in
+                    range(2)]
+            rho = np.concatenate([x['rho'] for x in data], axis=0)
+        finally:
+            shutil.rmtree(output_dir)
+
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 20,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+        ctrl = LBSimulationController(ShearWaveSim2D, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        np.testing.assert_array_equal(restored.rho, ctrl.master.sim.rho)
+        np.testing.assert_array_equal(rho, ctrl.master.sim.rho)
+
+    def test_npy_stream_output(self):
+        output_dir = tempfile.mkdtemp()
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 20,
+            'every': 5,
+            'lat_nx': 16,
+            'lat_ny': 16,
+            'periodic_x': True,
+            'periodic_y': True,
+            'output': output,
+            'output_format': 'npy_stream',
+            'output_snapshots_per_file': 3,
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            sim = ctrl.master.sim
+            digits = io.filename_iter_digits(settings['max_iters'])
+            it0, fields0 = io.load_npy_stream(
+                io.filename(output, digits, 0, 0, suffix='.json'))
+            it1, fields1 = io.load_npy_stream(
+                io.filename(output, digits, 0, 15, suffix='.json'))
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertEqual(it0, [0, 5, 10])
+        self.assertEqual(it1, [15, 20])
+        self.assertEqual(fields0['rho'].shape, (3, 16, 16))
+        self.assertEqual(fields1['v'].shape, (2, 2, 16, 16))
+        np.testing.assert_array_equal(fields1['rho'][-1], sim.rho)
+        np.testing.assert_array_equal(fields1['v'][-1][0], sim.vx)
+
+    def test_chunked_output(self):
+        output_dir = tempfile.mkdtemp()
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 20,
+            'every': 20,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+            'output': output,
+            'output_format': 'chunked',
+            'output_chunk_size': 6,
+            'subdomains': 2,
+            'conn_axis': 'y',
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            dirname = io.merged_filename(output, digits, 20, suffix='.chunks')
+            rho = io.read_chunked(dirname, 'rho')
+            v = io.read_chunked(dirname, 'v')
+            # Region spanning both subdomains and partial chunks.
+            region = (slice(10, 22), slice(3, 9))
+            rho_region = io.read_chunked(dirname, 'rho', region)
+            vy_region = io.read_chunked(dirname, 'v', region)[1]
+        finally:
+            shutil.rmtree(output_dir)
+
+        np.testing.assert_array_equal(rho_region, rho[region])
+        np.testing.assert_array_equal(vy_region, v[1][region])
+
+        del settings['output'], settings['subdomains'], settings['conn_axis']
+        settings['debug_single_process'] = True
+        ctrl = LBSimulationController(ShearWaveSim2D, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        sim = ctrl.master.sim
+        np.testing.assert_array_equal(rho, sim.rho)
+        np.testing.assert_array_equal(v[0], sim.vx)
+
+    def test_subdomain_array(self):
+        output_dir = tempfile.mkdtemp()
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 20,
+            'every': 10,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+            'output': output,
+            'output_compress': False,
+            'subdomains': 2,
+            'conn_axis': 'y',
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            data = [np.load(io.filename(output, digits, i, 20)) for i in
+                    range(2)]
+            rho = np.concatenate([x['rho'] for x in data], axis=0)
+            v = np.concatenate([x['v'] for x in data], axis=1)
+
+            # Uncompressed arrays are memory-mapped.
+            self.assertTrue(isinstance(io.load_npz_member(
+                io.filename(output, digits, 0, 20), 'rho'), np.memmap))
+
+            rho_arr = io.SubdomainArray(output, 20, 'rho')
+            v_arr = io.SubdomainArray(output, 20, 'v')
+            self.assertEqual(rho_arr.shape, rho.shape)
+            self.assertEqual(v_arr.shape, v.shape)
+            np.testing.assert_array_equal(np.asarray(rho_arr), rho)
+            np.testing.assert_array_equal(rho_arr[10:22:3, 5], rho[10:22:3, 5])
+            np.testing.assert_array_equal(v_arr[1, -1], v[1, -1])
+            np.testing.assert_array_equal(v_arr[..., 15:17, :], v[..., 15:17, :])
+
+            series = list(io.iter_subdomain_arrays(output, 'rho',
+                                                   key=(slice(14, 18), 3)))
+            self.assertEqual([it for it, _ in series], [0, 10, 20])
+            np.testing.assert_array_equal(series[-1][1], rho[14:18, 3])
+
+            # Compressed arrays are read directly.
+            fname = os.path.join(output_dir, 'compressed.npz')
+            np.savez_compressed(fname, rho=rho)
+            np.testing.assert_array_equal(io.load_npz_member(fname, 'rho'),
+                                          rho)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def _read_vti(self, fname, name):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        extent = [int(x) for x in re.search(
+            b'<Piece Extent="([0-9 ]+)"', data).group(1).split()]
+        offset = int(re.search(b'Name="' + name.encode('ascii') +
+                               b'"[^>]*offset="([0-9]+)"', data).group(1))
+        start = data.index(b'<AppendedData encoding="raw">\n_') + 31 + offset
+        nbytes = int(np.frombuffer(data[start:start + 8], dtype=np.uint64)[0])
+        shape = (extent[3] - extent[2], extent[1] - extent[0])
+        return extent, np.frombuffer(data[start + 8:start + 8 + nbytes],
+                                     dtype=np.float32).reshape(shape)
+
+    def test_vtk_output(self):
+        output_dir = tempfile.mkdtemp()
+        output = os.path.join(output_dir, 'out')
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 20,
+            'every': 20,
+            'lat_nx': 16,
+            'lat_ny': self.n,
+            'periodic_x': True,
+            'periodic_y': True,
+            'output': output,
+            'output_format': 'vtk',
+            'output_compress': False,
+            'subdomains': 2,
+            'conn_axis': 'y',
+        }
+
+        try:
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            digits = io.filename_iter_digits(settings['max_iters'])
+            pieces = [self._read_vti(io.filename(output, digits, i, 20,
+                                                 suffix='.vti'), 'rho')
+                      for i in range(2)]
+            with open(io.merged_filename(output, digits, 20,
+                                         suffix='.pvti')) as f:
+                pvti = f.read()
+        finally:
+            shutil.rmtree(output_dir)
+
+        # The pieces share their boundary points.
+        self.assertEqual([p[0] for p in pieces],
+                         [[0, 16, 0, 16, 0, 0], [0, 16, 16, 32, 0, 0]])
+        self.assertIn('WholeExtent="0 16 0 32 0 0"', pvti)
+        self.assertIn('<Piece Extent="0 16 16 32 0 0" Source="{0}"/>'.format(
+            os.path.basename(io.filename(output, digits, 1, 20,
+                                         suffix='.vti'))), pvti)
+
+        del settings['output'], settings['subdomains'], settings['conn_axis']
+        settings['debug_single_process'] = True
+        ctrl = LBSimulationController(ShearWaveSim2D, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        rho = np.concatenate([p[1] for p in pieces], axis=0)
+        np.testing.assert_array_equal(rho, ctrl.master.sim.rho)
+
+    def test_output_reduction(self):
+        output_dir = tempfile.mkdtemp()
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 11,
+            'every': 5,
+            'lat_nx': 16,
+            'lat_ny': 16,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+
+        def _block_avg(a, factor):
+            return a.reshape(a.shape[0] // factor, factor, a.shape[1] // factor,
+                             factor).mean(axis=(1, 3), dtype=np.float64)
+
+        try:
+            ctrl = LBSimulationController(RecordingShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            full = ctrl.master.sim.history
+
+            settings['output'] = os.path.join(output_dir, 'out')
+            settings['output_reduce'] = 'rho:avg4+f16,v:avg2+mean'
+            ctrl = LBSimulationController(OutputRecordingShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            reduced = ctrl.master.sim.saved
+
+            settings['output_format'] = 'vtk'
+            ctrl = LBSimulationController(ShearWaveSim2D,
+                                          default_config=settings)
+            self.assertRaises(ValueError, ctrl.run, ignore_cmdline=True)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertEqual(sorted(reduced.keys()), [0, 5, 10])
+        rho, v = reduced[10]
+        self.assertEqual(rho.dtype, np.float16)
+        self.assertEqual(rho.shape, (4, 4))
+        self.assertEqual(v.shape, (2, 8, 8))
+        np.testing.assert_array_equal(
+            rho, _block_avg(full[10][0], 4).astype(np.float32).astype(np.float16))
+
+        # Velocity is averaged over all iterations since the previous output.
+        for it, window in ((0, [0]), (5, range(1, 6)), (10, range(6, 11))):
+            expected = np.mean([[_block_avg(c, 2) for c in full[i][1]]
+                                for i in window], axis=0)
+            np.testing.assert_allclose(reduced[it][1], expected, rtol=1e-6,
+                                       atol=1e-9)
+
+    def test_change_driven_output(self):
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 21,
+            'lat_nx': 16,
+            'lat_ny': 16,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+        ctrl = LBSimulationController(RecordingShearWaveSim2D,
+                                      default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        velocity = [h[1].astype(np.float64) for h in ctrl.master.sim.history]
+
+        def _rms(a, b):
+            return np.sqrt(np.sum(np.square(a - b)) / a[0].size)
+
+        def _saved_iterations(threshold, max_interval=0, from_=0):
+            output_dir = tempfile.mkdtemp()
+            settings.update({
+                'max_iters': 20,
+                'every': 1,
+                'from_': from_,
+                'output': os.path.join(output_dir, 'out'),
+                'output_change_threshold': threshold,
+                'output_max_interval': max_interval})
+            try:
+                ctrl = LBSimulationController(ShearWaveSim2D,
+                                              default_config=settings)
+                ctrl.run(ignore_cmdline=True)
+                return sorted(int(re.search(r'\.(\d+)\.npz$', fn).group(1))
+                              for fn in os.listdir(output_dir)
+                              if fn.endswith('.npz'))
+            finally:
+                shutil.rmtree(output_dir)
+
+        self.assertEqual(_saved_iterations(1e-12), list(range(21)))
+        self.assertEqual(_saved_iterations(1.0, max_interval=5),
+                         [0, 5, 10, 15, 20])
+
+        threshold = _rms(velocity[20], velocity[0]) / 4.0
+        expected = [0]
+        for i in range(1, 21):
+            if _rms(velocity[i], velocity[expected[-1]]) >= threshold:
+                expected.append(i)
+        self.assertLess(len(expected), 21)
+        self.assertGreater(len(expected), 2)
+        self.assertEqual(_saved_iterations(threshold), expected)
+
+        # The initial state is the reference snapshot even if it is not
+        # saved.
+        expected = [0]
+        for i in range(6, 21):
+            if _rms(velocity[i], velocity[expected[-1]]) >= threshold:
+                expected.append(i)
+        self.assertEqual(_saved_iterations(threshold, from_=5), expected[1:])
+
+    def _saved_subdomain_iterations(self, sim_class, settings):
+        """Runs a simulation in 2 subdomains and returns a list of
+        iterations for which output was saved in every subdomain."""
+        output_dir = tempfile.mkdtemp()
+        settings = dict(settings, output=os.path.join(output_dir, 'out'),
+                        subdomains=2, conn_axis='y', every=1)
+        try:
+            ctrl = LBSimulationController(sim_class, EqualSubdomainsGeometry2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            saved = [[], []]
+            for fn in os.listdir(output_dir):
+                m = re.search(r'\.(\d+)\.(\d+)\.npz$', fn)
+                if m is not None:
+                    saved[int(m.group(1))].append(int(m.group(2)))
+            return [sorted(x) for x in saved]
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_change_driven_output_subdomains(self):
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 21,
+            'lat_nx': 16,
+            'lat_ny': 32,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+        ctrl = LBSimulationController(
+            RecordingHalfShearWaveSim2D,
+            default_config=dict(settings, debug_single_process=True))
+        ctrl.run(ignore_cmdline=True)
+        velocity = [h[1].astype(np.float64) for h in ctrl.master.sim.history]
+
+        def _rms(a, b):
+            return np.sqrt(np.sum(np.square(a - b)) / a[0].size)
+
+        # The flow changes mostly in the subdomain covering the lower half
+        # of the domain.  The output is saved based on the change in the
+        # whole domain.
+        threshold = _rms(velocity[20], velocity[0]) / 4.0
+        expected = [0]
+        for i in range(1, 21):
+            if _rms(velocity[i], velocity[expected[-1]]) >= threshold:
+                expected.append(i)
+        self.assertLess(len(expected), 21)
+        self.assertGreater(len(expected), 2)
+
+        settings.update({'max_iters': 20,
+                         'output_change_threshold': threshold})
+        self.assertEqual(
+            self._saved_subdomain_iterations(HalfShearWaveSim2D, settings),
+            [expected, expected])
+
+    def test_custom_output_policy_subdomains(self):
+        settings = {
+            'backends': 'numpy',
+            'quiet': True,
+            'max_iters': 6,
+            'lat_nx': 16,
+            'lat_ny': 32,
+            'periodic_x': True,
+            'periodic_y': True,
+        }
+        # Output requested in a single subdomain is saved in all of them.
+        self.assertEqual(
+            self._saved_subdomain_iterations(FirstSubdomainOutputSim2D,
+                                             settings),
+            [[0, 2, 4, 6], [0, 2, 4, 6]])
+
+    def test_field_stats(self):
+        output_dir = tempfile.mkdtemp()
+        cpoint = os.path.join(output_dir, 'cpoint')
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 10,
+            'lat_nx': 16,
+            'lat_ny': 16,
+            'periodic_x': True,
+            'periodic_y': True,
+            'checkpoint_file': cpoint,
+            'checkpoint_every': 5,
+        }
+
+        try:
+            ctrl = LBSimulationController(FieldStatsShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            sim = ctrl.master.sim
+            stats = sim.field_stats(ctrl.master.runner)
+
+            # Restart from the checkpoint taken in the middle of the run.
+            digits = io.filename_iter_digits(settings['max_iters'])
+            settings.update({
+                'restore_from': '{0}.{1:0{2}d}'.format(cpoint, 5, digits),
+                'checkpoint_every': 0})
+            ctrl = LBSimulationController(FieldStatsShearWaveSim2D,
+                                          default_config=settings)
+            ctrl.run(ignore_cmdline=True)
+            restored = ctrl.master.sim.field_stats(ctrl.master.runner)
+        finally:
+            shutil.rmtree(output_dir)
+
+        # Samples are collected after every step but the last one.
+        history = sim.history[1:]
+        self.assertEqual(stats['count'], 9)
+        self.assertEqual(len(history), 9)
+        rho = np.array([h[0] for h in history], dtype=np.float64)
+        vx = np.array([h[1][0] for h in history], dtype=np.float64)
+        vy = np.array([h[1][1] for h in history], dtype=np.float64)
+
+        np.testing.assert_allclose(stats['rho_mean'], np.mean(rho, axis=0),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(stats['vx_var'], np.var(vx, axis=0),
+                                   rtol=1e-9, atol=1e-20)
+        np.testing.assert_allclose(stats['rho_var'], np.var(rho, axis=0),
+                                   rtol=1e-6, atol=1e-20)
+        np.testing.assert_allclose(
+            stats['vx_vy_cov'],
+            np.mean((vx - np.mean(vx, axis=0)) * (vy - np.mean(vy, axis=0)),
+                    axis=0), rtol=1e-6, atol=1e-20)
+        np.testing.assert_allclose(
+            stats['rho_vx_cov'],
+            np.mean((rho - np.mean(rho, axis=0)) * (vx - np.mean(vx, axis=0)),
+                    axis=0), rtol=1e-6, atol=1e-20)
+
+        self.assertEqual(restored['count'], 9)
+        for name, value in stats.items():
+            np.testing.assert_array_equal(restored[name], value)
+
+    def test_unsupported_node_type(self):
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 1,
+            'lat_nx': 16,
+            'lat_ny': 16,
+        }
+        ctrl = LBSimulationController(UnsupportedSim2D,
+                                      default_config=settings)
+        self.assertRaises(ValueError, ctrl.run, ignore_cmdline=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
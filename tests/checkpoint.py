@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import io
+
+
+class DeltaCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.writer = io.CheckpointWriter(delta_every=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _save(self, slot, value):
+        fname = os.path.join(self.dir, 'cp.{0}'.format(slot))
+        dists = {'dist0a': np.full((9, 100), value, dtype=np.float32)}
+        self.writer.save(fname, b'state', dists)
+        self.writer.wait()
+        return fname + '.npz'
+
+    def test_single_checkpoint(self):
+        full = self._save(0, 1.0)
+        delta = self._save(1, 2.0)
+        _, dists = io.load_checkpoint(delta)
+        np.testing.assert_equal(dists['dist0a'], 2.0)
+
+        # A new full checkpoint invalidates the delta computed against the
+        # previous one.
+        self._save(0, 3.0)
+        self.assertFalse(os.path.exists(delta))
+        _, dists = io.load_checkpoint(full)
+        np.testing.assert_equal(dists['dist0a'], 3.0)
+
+        self._save(1, 4.0)
+        _, dists = io.load_checkpoint(delta)
+        np.testing.assert_equal(dists['dist0a'], 4.0)
+
+    def test_mismatched_base(self):
+        self._save(0, 1.0)
+        delta = self._save(1, 2.0)
+        # Base replaced by a different writer, e.g. after a restart.
+        writer = io.CheckpointWriter(delta_every=2)
+        writer.save(os.path.join(self.dir, 'cp.0'), b'state',
+                    {'dist0a': np.zeros((9, 100), dtype=np.float32)})
+        writer.wait()
+        self.assertRaises(ValueError, io.load_checkpoint, delta)
+
+    def test_info(self):
+        info = {'node_addressing': 'indirect', 'node_ordering': 'hilbert',
+                'location': [0, 0]}
+        fname = os.path.join(self.dir, 'cp.0')
+        self.writer.save(fname, b'state',
+                         {'dist0a': np.zeros((9, 100), dtype=np.float32)},
+                         info)
+        self.writer.wait()
+        self.assertEqual(io.load_checkpoint_info(fname + '.npz'), info)
+
+        # Checkpoints saved without a description of the subdomain.
+        self.assertEqual(io.load_checkpoint_info(self._save(1, 1.0)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Verifies the on-disk cache of the generated compute unit code."""
+
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish.codegen import BlockCodeGenerator, CodeCache, code_cache_dir
+from sailfish.controller import LBSimulationController
+from sailfish.lb_single import LBFluidSim
+from sailfish.node_type import NTFullBBWall
+from sailfish.subdomain import Subdomain2D
+
+
+class TestSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node((hy == 0) | (hy == self.gy - 1), NTFullBBWall)
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+
+
+class TestSim(LBFluidSim):
+    subdomain = TestSubdomain
+
+
+class TestCodeCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        settings = {
+            'backends': 'numpy',
+            'debug_single_process': True,
+            'quiet': True,
+            'max_iters': 1,
+            'lat_nx': 32,
+            'lat_ny': 16,
+        }
+        ctrl = LBSimulationController(TestSim, default_config=settings)
+        ctrl.run(ignore_cmdline=True)
+        self.sim = ctrl.master.sim
+        self.runner = ctrl.master.runner
+        self.config = self.sim.config
+        self.config.code_cache_dir = self.cache_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_hit_and_miss(self):
+        gen = BlockCodeGenerator(self.sim)
+        self.config.use_code_cache = False
+        ref_src = gen.get_code(self.runner, 'cuda')
+        self.assertTrue(ref_src)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertIsNone(code_cache_dir(self.config))
+
+        self.config.use_code_cache = True
+        hits, misses = CodeCache.hits, CodeCache.misses
+        num_entries = lambda: len([x for x in os.listdir(self.cache_dir) if
+                                   x.endswith('.src')])
+        self.assertEqual(gen.get_code(self.runner, 'cuda'), ref_src)
+        self.assertEqual(CodeCache.misses, misses + 1)
+        self.assertEqual(num_entries(), 1)
+
+        self.assertEqual(gen.get_code(self.runner, 'cuda'), ref_src)
+        self.assertEqual(CodeCache.hits, hits + 1)
+        self.assertEqual(CodeCache.misses, misses + 1)
+
+        # Changes in the options used for code generation result in
+        # a different cache entry.
+        self.assertNotEqual(gen.get_code(self.runner, 'opencl'), ref_src)
+        self.assertEqual(CodeCache.misses, misses + 2)
+
+        self.config.precision = 'double'
+        self.assertNotEqual(gen.get_code(self.runner, 'cuda'), ref_src)
+        self.assertEqual(CodeCache.misses, misses + 3)
+        self.assertEqual(num_entries(), 3)
+
+        # Options which do not affect the code do not invalidate the cache.
+        self.config.precision = 'single'
+        self.config.max_iters = 1000
+        self.assertEqual(gen.get_code(self.runner, 'cuda'), ref_src)
+        self.assertEqual(CodeCache.hits, hits + 2)
+
+    def test_identical_subdomains(self):
+        gen = BlockCodeGenerator(self.sim)
+        self.config.use_code_cache = True
+        cache = CodeCache(self.cache_dir)
+        ctx, template_dirs, aux_sources, _, key = gen._prepare(self.runner,
+                                                               'cuda')
+        sources = [self.sim.kernel_file] + aux_sources
+
+        # Subdomains differing only in their location share the code.
+        spec = self.runner._spec
+        spec.location = (32, 0)
+        spec.ox = 32
+        ctx2 = gen._build_context(self.runner)
+        self.assertNotEqual(ctx['x_local_device_to_global_offset'],
+                            ctx2['x_local_device_to_global_offset'])
+        self.assertEqual(key, cache.key(ctx2, template_dirs, sources, 'cuda'))
+
+        # Unless the location is used in the code.
+        ctx['space_dependence'] = True
+        ctx2['space_dependence'] = True
+        self.assertNotEqual(cache.key(ctx, template_dirs, sources, 'cuda'),
+                            cache.key(ctx2, template_dirs, sources, 'cuda'))
+
+    def test_invalid_value_checks(self):
+        gen = BlockCodeGenerator(self.sim)
+        self.config.use_code_cache = True
+        cache = CodeCache(self.cache_dir)
+        ctx, template_dirs, aux_sources, _, key = gen._prepare(self.runner,
+                                                               'cuda')
+        sources = [self.sim.kernel_file] + aux_sources
+
+        # Identical subdomains share the code...
+        ctx2 = dict(ctx)
+        ctx2['block'] = copy.copy(ctx['block'])
+        ctx2['block'].id += 1
+        self.assertEqual(key, cache.key(ctx2, template_dirs, sources, 'cuda'))
+
+        # ... unless it reports the subdomain ID on invalid values.
+        ctx['gpu_check_invalid_values'] = True
+        ctx2['gpu_check_invalid_values'] = True
+        self.assertNotEqual(cache.key(ctx, template_dirs, sources, 'cuda'),
+                            cache.key(ctx2, template_dirs, sources, 'cuda'))
+
+    def test_shared_dir(self):
+        self.config.use_code_cache = False
+        self.config._code_share_dir = self.cache_dir
+        gen = BlockCodeGenerator(self.sim)
+        hits = CodeCache.hits
+        src = gen.get_code(self.runner, 'cuda')
+        self.assertEqual(gen.get_code(self.runner, 'cuda'), src)
+        self.assertEqual(CodeCache.hits, hits + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,8 @@ class TestCase2D(unittest.TestCase):
         config.time_dependence = False
         config.space_dependence = False
         config.access_pattern = 'AB'
+        config.geometry_cache_dir = ''
+        config.geometry_threads = 0
         self.sim = LBSim(config)
         self.config = config
         self.backend = DummyBackend()
@@ -53,5 +55,7 @@ class TestCase3D(unittest.TestCase):
         config.time_dependence = False
         config.space_dependence = False
         config.access_pattern = 'AB'
+        config.geometry_cache_dir = ''
+        config.geometry_threads = 0
         self.sim = LBSim(config)
         self.backend = DummyBackend()
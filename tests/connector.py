@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import ctypes
+import multiprocessing as mp
+import os
+import unittest
+import numpy as np
+import zmq
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+from sailfish.connector import SharedMemorySubdomainConnector, \
+        CompressedZMQRemoteSubdomainConnector, \
+        DeltaCompressedZMQRemoteSubdomainConnector
+
+
+def echo(connector, num, size):
+    connector.init_runner(None)
+    quit_ev = mp.Event()
+    data = np.zeros(size, dtype=np.float32)
+    for i in range(num):
+        connector.recv(data, quit_ev)
+        connector.send(data + 1.0)
+
+
+def fill(connector, num, size, quit_ev, sent):
+    connector.init_runner(None)
+    data = np.zeros(size, dtype=np.float32)
+    for i in range(num):
+        if not connector.send(data, quit_ev):
+            return
+        sent.value += 1
+
+
+class TestSharedMemoryConnector(unittest.TestCase):
+    size = 64
+
+    def setUp(self):
+        self.c1, self.c2 = SharedMemorySubdomainConnector.make_pair(
+            ctypes.c_float, (self.size, self.size), (0, 1))
+
+    def tearDown(self):
+        for f in self.c1.ipc_files + self.c2.ipc_files:
+            os.unlink(f)
+
+    def test_exchange(self):
+        num = 10
+        remote = mp.Process(target=echo, args=(self.c2, num, self.size))
+        remote.start()
+
+        self.c1.init_runner(None)
+        quit_ev = mp.Event()
+        data = np.zeros(self.size, dtype=np.float32)
+        for i in range(num):
+            send = np.arange(self.size, dtype=np.float32) * i
+            self.c1.send(send)
+            self.c1.recv(data, quit_ev)
+            np.testing.assert_array_equal(data, send + 1.0)
+        remote.join()
+
+    def test_multiple_messages_in_flight(self):
+        self.c1.init_runner(None)
+        self.c2.init_runner(None)
+        quit_ev = mp.Event()
+        data = np.zeros(self.size, dtype=np.float32)
+
+        # All slots can be filled before the receiver picks up the data.
+        for i in range(self.c1.nslots):
+            self.c1.send(np.ones(self.size, dtype=np.float32) * i)
+        for i in range(self.c1.nslots):
+            self.assertTrue(self.c2.recv(data, quit_ev))
+            self.assertTrue(np.all(data == i))
+
+        # Messages smaller than the slot size are supported.
+        self.c2.send(np.ones(self.size // 2, dtype=np.float32))
+        small = np.zeros(self.size // 2, dtype=np.float32)
+        self.assertTrue(self.c1.recv(small, quit_ev))
+        self.assertTrue(np.all(small == 1.0))
+
+    def test_send_quit(self):
+        # The receiver never consumes any data, so the sender blocks once
+        # all slots are filled, until the quit event is set.
+        self.c2.init_runner(None)
+        quit_ev = mp.Event()
+        sent = mp.Value('i', 0)
+        remote = mp.Process(target=fill, args=(self.c1, self.c1.nslots + 1,
+                                                self.size, quit_ev, sent))
+        remote.daemon = True
+        remote.start()
+        remote.join(0.5)
+        self.assertTrue(remote.is_alive())
+        self.assertEqual(sent.value, self.c1.nslots)
+
+        quit_ev.set()
+        remote.join(5.0)
+        self.assertFalse(remote.is_alive())
+        self.assertEqual(sent.value, self.c1.nslots)
+
+    def test_send_after_release(self):
+        self.c1.init_runner(None)
+        self.c2.init_runner(None)
+        quit_ev = mp.Event()
+        sent = mp.Value('i', 0)
+        num = self.c1.nslots + 2
+        remote = mp.Process(target=fill, args=(self.c1, num, self.size,
+                                                quit_ev, sent))
+        remote.daemon = True
+        remote.start()
+
+        # Consuming the data wakes up the blocked sender.
+        data = np.zeros(self.size, dtype=np.float32)
+        for i in range(num):
+            self.assertTrue(self.c2.recv(data, quit_ev))
+        remote.join(5.0)
+        self.assertFalse(remote.is_alive())
+        self.assertEqual(sent.value, num)
+
+    def test_quit_and_overflow(self):
+        self.c1.init_runner(None)
+        self.c2.init_runner(None)
+        quit_ev = mp.Event()
+        quit_ev.set()
+        data = np.zeros(self.size, dtype=np.float32)
+        self.assertFalse(self.c1.recv(data, quit_ev))
+        self.assertRaises(ValueError, self.c1.send,
+                          np.zeros(self.size + 1, dtype=np.float32))
+
+
+@unittest.skipIf(blosc is None, 'blosc is not available')
+class TestCompressedConnector(unittest.TestCase):
+    size = 4096
+
+    def setUp(self):
+        self.ctx = zmq.Context()
+        self.c1 = CompressedZMQRemoteSubdomainConnector('tcp://127.0.0.1')
+        self.c2 = CompressedZMQRemoteSubdomainConnector('tcp://127.0.0.1',
+                                                        receiver=True)
+        self.c1.probe_interval = 10
+        self.c1.init_runner(self.ctx)
+        self.c2.port = self.c1.port
+        self.c2.init_runner(self.ctx)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def _exchange(self, make_data, num):
+        quit_ev = mp.Event()
+        recv = np.zeros(self.size, dtype=np.float32)
+        for i in range(num):
+            data = make_data(i)
+            self.c1.send(data)
+            self.assertTrue(self.c2.recv(recv, quit_ev))
+            np.testing.assert_array_equal(recv, data)
+
+    def test_method_selection(self):
+        methods = self.c1._methods
+        num = len(methods) * self.c1.probe_messages
+        # All methods are tried in the first probing round.
+        self._exchange(lambda i: np.ones(self.size, dtype=np.float32) * i, num)
+        stats = self.c1.stats()
+        for name, _, _ in methods:
+            self.assertEqual(stats['messages'][name], self.c1.probe_messages)
+        self.assertIn(stats['method'], [m[0] for m in methods])
+
+        # Keep sending data with the selected method until the next round.
+        self._exchange(lambda i: np.ones(self.size, dtype=np.float32),
+                       self.c1.probe_interval)
+        stats = self.c1.stats()
+        self.assertEqual(sum(stats['messages'].values()),
+                         num + self.c1.probe_interval)
+        self.assertEqual(stats['bytes_raw'], (num + self.c1.probe_interval) *
+                         self.size * 4)
+
+    def test_ratio_change_triggers_probing(self):
+        self.c1._methods = [m for m in self.c1._methods if m[1] is not None]
+        num = len(self.c1._methods) * self.c1.probe_messages
+        self._exchange(lambda i: np.zeros(self.size, dtype=np.float32), num)
+        self.assertEqual(self.c1._since_probe, 0)
+
+        # Random data does not compress, which starts a new probing round.
+        self._exchange(lambda i: np.random.random(self.size).astype(np.float32), 2)
+        self.assertEqual(len(self.c1._to_probe), num - 1)
+
+
+@unittest.skipIf(blosc is None, 'blosc is not available')
+class TestDeltaCompressedConnector(unittest.TestCase):
+    size = 4096
+
+    def setUp(self):
+        self.ctx = zmq.Context()
+        self.c1 = DeltaCompressedZMQRemoteSubdomainConnector(
+            'tcp://127.0.0.1', keyframe_every=5)
+        self.c2 = DeltaCompressedZMQRemoteSubdomainConnector(
+            'tcp://127.0.0.1', receiver=True, keyframe_every=5)
+        self.c1.init_runner(self.ctx)
+        self.c2.port = self.c1.port
+        self.c2.init_runner(self.ctx)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_exact_reconstruction(self):
+        quit_ev = mp.Event()
+        base = np.random.random(self.size).astype(np.float32)
+        bufs = [np.zeros(self.size, dtype=np.float32),
+                np.zeros(self.size // 2, dtype=np.float32)]
+
+        # Slowly evolving data, with messages of two different sizes sent
+        # in alternate iterations as with the AA access pattern.
+        for i in range(23):
+            recv = bufs[i & 1]
+            data = (base[:recv.size] * (1.0 + 1e-6 * i)).astype(np.float32)
+            self.c1.send(data)
+            self.assertTrue(self.c2.recv(recv, quit_ev))
+            np.testing.assert_array_equal(recv, data)
+
+        # Differences compress better than the data itself.
+        stats = self.c1.stats()
+        self.assertGreater(stats['ratio'], 1.0)
+
+    def test_invalid_keyframe_interval(self):
+        self.assertRaises(ValueError, DeltaCompressedZMQRemoteSubdomainConnector,
+                          'tcp://127.0.0.1', keyframe_every=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
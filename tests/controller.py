@@ -1,6 +1,6 @@
 import unittest
 
-from sailfish.config import MachineSpec
+from sailfish.config import LBConfig, MachineSpec
 from sailfish import controller
 from sailfish.subdomain import SubdomainSpec2D
 
@@ -73,5 +73,58 @@ class TestSubdomainDistribution(unittest.TestCase):
         self.assertEqual(assignments, [[subds[0], subds[1], subds[2]], [subds[3]]])
 
 
+class TestSubdomainPlacement(unittest.TestCase):
+    nodes = [
+            MachineSpec('a', 'a', gpus=[0]),
+            MachineSpec('b', 'b', gpus=[0])
+        ]
+
+    def _connect(self, subds, gsize):
+        config = LBConfig()
+        config.lat_nx, config.lat_ny = gsize
+        config.periodic_x = False
+        config.periodic_y = False
+        config.grid = 'D2Q9'
+        controller.LBGeometryProcessor(subds, 2, gsize).transform(config)
+
+    def test_connected_subdomains_on_same_node(self):
+        # A chain of subdomains along the X axis, listed out of order.
+        subds = [
+                SubdomainSpec2D((0, 0), (32, 32), envelope_size=1, id_=0),
+                SubdomainSpec2D((64, 0), (32, 32), envelope_size=1, id_=1),
+                SubdomainSpec2D((32, 0), (32, 32), envelope_size=1, id_=2),
+                SubdomainSpec2D((96, 0), (32, 32), envelope_size=1, id_=3),
+            ]
+        self._connect(subds, (128, 32))
+
+        naive = [[subds[0], subds[1]], [subds[2], subds[3]]]
+        assignments = controller.split_subdomains_between_nodes(self.nodes, subds)
+        self.assertEqual(assignments, [[subds[0], subds[2]], [subds[1], subds[3]]])
+
+        cut, imbalance = controller.placement_stats(self.nodes, assignments)
+        naive_cut, _ = controller.placement_stats(self.nodes, naive)
+        self.assertLess(cut, naive_cut)
+        self.assertEqual(imbalance, 0.0)
+        # Only the subdomains 1 and 2 are connected across the nodes.
+        self.assertEqual(cut, sum(c.src.elements for c in
+                                  subds[2].get_connections(SubdomainSpec2D.X_HIGH, 1) +
+                                  subds[1].get_connections(SubdomainSpec2D.X_LOW, 2)))
+
+    def test_load_balancing(self):
+        subds = [
+                SubdomainSpec2D((0, 0), (10, 10), id_=0),
+                SubdomainSpec2D((0, 10), (10, 10), id_=1),
+                SubdomainSpec2D((0, 20), (10, 10), id_=2),
+                SubdomainSpec2D((0, 30), (10, 10), id_=3),
+            ]
+        subds[2].num_active_nodes = 10
+        subds[3].num_active_nodes = 10
+
+        assignments = controller.split_subdomains_between_nodes(self.nodes, subds)
+        self.assertEqual([len(x) for x in assignments], [2, 2])
+        _, imbalance = controller.placement_stats(self.nodes, assignments)
+        self.assertEqual(imbalance, 0.0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,9 @@ class DummyLogger(object):
     def info(*args):
         pass
 
+    def warning(*args):
+        pass
+
 class DummyEvent(object):
     def is_set(self):
         return False
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+from scipy.ndimage import morphology
+
+from sailfish.config import LBConfig
+from sailfish.geo import rcb_decomposition, RCBGeometry2D, RCBGeometry3D
+
+
+def vessel_2d(ny=60, nx=200):
+    hy, hx = np.mgrid[0:ny, 0:nx]
+    wall_map = np.abs(hy - (ny / 2 + ny / 4 * np.sin(hx / 25.0))) >= 6
+    return wall_map
+
+
+class TestRCBDecomposition(unittest.TestCase):
+    def _coverage(self, wall_map, subdomains):
+        cover = np.zeros(wall_map.shape, dtype=np.int32)
+        for location, size, _ in subdomains:
+            cover[tuple(slice(l, l + s) for l, s in
+                        zip(reversed(location), reversed(size)))] += 1
+        return cover
+
+    def test_balance_and_coverage(self):
+        wall_map = vessel_2d()
+        fluid = np.logical_not(wall_map)
+        needed = morphology.binary_dilation(fluid,
+                                            structure=np.ones((3, 3), dtype=np.bool))
+        for num in (2, 3, 5, 8):
+            subdomains = rcb_decomposition(wall_map, num, tolerance=0.05)
+            self.assertEqual(len(subdomains), num)
+            counts = np.array([x[2] for x in subdomains])
+            self.assertEqual(np.sum(counts), np.sum(fluid))
+            self.assertLess(np.max(counts) / np.mean(counts) - 1.0, 0.05)
+
+            # Subdomains do not overlap and cover all fluid nodes and wall
+            # nodes adjacent to them, but not the whole domain.
+            cover = self._coverage(wall_map, subdomains)
+            self.assertEqual(np.max(cover), 1)
+            self.assertTrue(np.all(cover[needed] == 1))
+            self.assertLess(np.sum(cover), wall_map.size)
+
+    def test_periodic_axis_not_trimmed(self):
+        wall_map = np.ones((20, 40), dtype=np.bool)
+        wall_map[5:15, :] = False
+        subdomains = rcb_decomposition(wall_map, 1, periodicity=[True, False])
+        self.assertEqual(subdomains, [((0, 4), (40, 12), 400)])
+        subdomains = rcb_decomposition(wall_map, 1, periodicity=[False, True])
+        self.assertEqual(subdomains, [((0, 0), (40, 20), 400)])
+
+    def test_3d_box(self):
+        wall_map = np.zeros((20, 30, 40), dtype=np.bool)
+        subdomains = rcb_decomposition(wall_map, 4)
+        self.assertEqual([x[2] for x in subdomains], [6000] * 4)
+        self.assertTrue(all(size[2] == 20 for _, size, _ in subdomains))
+
+    def test_too_many_subdomains(self):
+        wall_map = np.ones((10, 10), dtype=np.bool)
+        wall_map[5, 5] = False
+        self.assertRaises(ValueError, rcb_decomposition, wall_map, 2)
+
+    def test_no_empty_subdomains(self):
+        wall_map = np.ones((10, 10), dtype=np.bool)
+        wall_map[4, 4:6] = False
+        wall_map[5, 4] = False
+        subdomains = rcb_decomposition(wall_map, 3)
+        self.assertEqual([x[2] for x in subdomains], [1, 1, 1])
+
+        # A plus-shaped domain cannot be split into 5 boxes containing
+        # fluid nodes.
+        wall_map = np.ones((10, 10), dtype=np.bool)
+        wall_map[4, 3:6] = False
+        wall_map[3:6, 4] = False
+        self.assertRaises(ValueError, rcb_decomposition, wall_map, 5)
+
+
+class TestRCBGeometry(unittest.TestCase):
+    def _config(self, nx, ny, nz=None):
+        config = LBConfig()
+        config.lat_nx = nx
+        config.lat_ny = ny
+        config.lat_nz = nz
+        config.periodic_x = False
+        config.periodic_y = False
+        config.periodic_z = False
+        config.subdomains = 4
+        config.geometry_for_decomposition = ''
+        config.decomposition_tolerance = 0.05
+        return config
+
+    def test_wall_map_override(self):
+        wall_map = vessel_2d()
+
+        class Geo(RCBGeometry2D):
+            def wall_map(self):
+                return wall_map
+
+        specs = Geo(self._config(200, 60)).subdomains()
+        self.assertEqual(len(specs), 4)
+        self.assertEqual(sum(s.num_active_nodes for s in specs),
+                         np.sum(np.logical_not(wall_map)))
+
+        class BadGeo(RCBGeometry2D):
+            def wall_map(self):
+                return wall_map.T
+
+        self.assertRaises(ValueError, BadGeo(self._config(200, 60)).subdomains)
+
+    def test_no_wall_map(self):
+        specs = RCBGeometry3D(self._config(16, 16, 32)).subdomains()
+        self.assertEqual([s.size for s in specs], [(16, 16, 8)] * 4)
+        self.assertEqual([s.location[2] for s in specs], [0, 8, 16, 24])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,9 +18,11 @@ echo ${targets} | tr ' ' '\n' | while read filename ; do
 		python $filename --max_iters=50 --access_pattern=AB --node_addressing=direct --every=50 --seed=1234 --quiet --output=${tmpdir}/result_dir_ab
 		python $filename --max_iters=50 --access_pattern=AB --node_addressing=indirect --every=50 --seed=1234 --silent --output=${tmpdir}/result_ind_ab
 		python $filename --max_iters=50 --access_pattern=AA --node_addressing=indirect --every=50 --seed=1234 --silent --output=${tmpdir}/result_ind_aa
+		python $filename --max_iters=50 --access_pattern=AB --node_addressing=indirect --node_ordering=hilbert --every=50 --seed=1234 --silent --output=${tmpdir}/result_ind_hilbert
 
 		if utils/compare_results.py ${tmpdir}/result_dir_ab.0.50.npz ${tmpdir}/result_ind_ab.0.50.npz && \
-			utils/compare_results.py ${tmpdir}/result_dir_ab.0.50.npz ${tmpdir}/result_ind_aa.0.50.npz ; then
+			utils/compare_results.py ${tmpdir}/result_dir_ab.0.50.npz ${tmpdir}/result_ind_aa.0.50.npz && \
+			utils/compare_results.py ${tmpdir}/result_dir_ab.0.50.npz ${tmpdir}/result_ind_hilbert.0.50.npz ; then
 			echo "ok"
 		else
 			echo "failed"
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import io
+from sailfish.config import LBConfig
+
+
+class ChunkedOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_non_float_fields(self):
+        config = LBConfig()
+        config.output = os.path.join(self.dir, 'out')
+        config.max_iters = 10
+        config.output_chunk_size = 4
+        config.output_compress = False
+        config.subdomains = 2
+
+        # Only the first subdomain saves its data.
+        output = io.ChunkedOutput(config, 0)
+        output.set_geometry((0, 0), (10, 6))
+        output.set_fluid_map(np.ones((6, 5), dtype=np.bool_))
+        output.register_field(np.arange(30, dtype=np.int32).reshape(6, 5),
+                              'idx')
+        output.register_field(np.ones((6, 5), dtype=np.bool_), 'mask')
+        output.register_field(np.ones((6, 5), dtype=np.float32), 'rho')
+        output.save(10)
+
+        dirname = io.merged_filename(config.output, io.filename_iter_digits(
+            config.max_iters), 10, suffix='.chunks')
+        idx = io.read_chunked(dirname, 'idx')
+        np.testing.assert_equal(idx[:, :5], np.arange(30).reshape(6, 5))
+        np.testing.assert_equal(idx[:, 5:], 0)
+        mask = io.read_chunked(dirname, 'mask')
+        self.assertEqual(mask.dtype, np.bool_)
+        np.testing.assert_equal(mask[:, :5], True)
+        np.testing.assert_equal(mask[:, 5:], False)
+        rho = io.read_chunked(dirname, 'rho')
+        self.assertTrue(np.all(np.isnan(rho[:, 5:])))
+
+
+if __name__ == '__main__':
+    unittest.main()
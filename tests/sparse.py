@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+
+from sailfish.sparse import (SparseLattice, INVALID_NODE, NODE_ORDERINGS,
+                             hilbert_keys, morton_keys)
+
+
+class SparseLatticeTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.mask = rng.random_sample((5, 6, 7)) > 0.6
+        self.lattice = SparseLattice.from_mask(self.mask)
+
+    def test_mask_and_coords(self):
+        self.assertEqual(self.lattice.size, np.sum(self.mask))
+        np.testing.assert_equal(self.lattice.mask(), self.mask)
+        for c, ref in zip(self.lattice.coords(), np.nonzero(self.mask)):
+            np.testing.assert_equal(c, ref)
+
+    def test_address(self):
+        amap = self.lattice.address_map()
+        self.assertEqual(amap.dtype, np.uint32)
+        np.testing.assert_equal(amap[np.logical_not(self.mask)], INVALID_NODE)
+        np.testing.assert_equal(amap[self.mask],
+                                np.arange(self.lattice.size))
+
+        idx = np.array([0, 17, 63, amap.size - 1])
+        np.testing.assert_equal(self.lattice.address(idx), amap.flat[idx])
+
+    def test_gather_scatter(self):
+        dense = np.arange(self.mask.size, dtype=np.float32).reshape(
+            self.mask.shape)
+        compact = self.lattice.gather(dense)
+        np.testing.assert_equal(compact, dense[self.mask])
+
+        out = self.lattice.scatter(compact, fill=-1.0)
+        np.testing.assert_equal(out[self.mask], dense[self.mask])
+        np.testing.assert_equal(out[np.logical_not(self.mask)], -1.0)
+
+        # Only active nodes are modified in an existing array.
+        out = np.zeros_like(dense)
+        self.lattice.scatter(compact + 1.0, out=out)
+        np.testing.assert_equal(out, np.where(self.mask, dense + 1.0, 0.0))
+
+
+class NodeOrderingTest(unittest.TestCase):
+    def test_morton(self):
+        keys = morton_keys(np.unravel_index(np.arange(16), (4, 4)), 2)
+        np.testing.assert_equal(
+            keys, [0, 1, 4, 5, 2, 3, 6, 7, 8, 9, 12, 13, 10, 11, 14, 15])
+
+    def test_hilbert(self):
+        # Consecutive nodes along the Hilbert curve are lattice neighbors.
+        for shape in ((16, 16), (8, 8, 8)):
+            mask = np.ones(shape, dtype=np.bool_)
+            lattice = SparseLattice.from_mask(mask, 'hilbert')
+            coords = np.array(lattice.coords())
+            steps = np.sum(np.abs(np.diff(coords, axis=1)), axis=0)
+            np.testing.assert_equal(steps, 1)
+
+        keys = hilbert_keys(np.nonzero(np.ones((8, 8, 8))), 3)
+        np.testing.assert_equal(np.sort(keys), np.arange(512))
+
+    def test_blocked(self):
+        mask = np.ones((8, 16), dtype=np.bool_)
+        lattice = SparseLattice.from_mask(mask, 'blocked', block_size=8)
+        y, x = lattice.coords()
+        # The first tile covers 4 rows of 8 nodes.
+        np.testing.assert_equal(y[:32], np.repeat(np.arange(4), 8))
+        np.testing.assert_equal(x[:32], np.tile(np.arange(8), 4))
+        np.testing.assert_equal(x[32:40], np.arange(8, 16))
+
+        self.assertRaises(ValueError, SparseLattice.from_mask, mask, 'blocked')
+        self.assertRaises(ValueError, SparseLattice.from_mask, mask, 'random')
+
+    def test_orderings(self):
+        rng = np.random.RandomState(0)
+        mask = rng.random_sample((9, 13, 21)) > 0.5
+        dense = rng.random_sample(mask.shape)
+        idx = np.arange(mask.size)
+
+        for ordering in NODE_ORDERINGS:
+            lattice = SparseLattice.from_mask(mask, ordering, block_size=8)
+            np.testing.assert_equal(lattice.mask(), mask)
+            np.testing.assert_equal(lattice.address(idx),
+                                    lattice.address_map().ravel())
+            compact = lattice.gather(dense)
+            np.testing.assert_equal(compact, dense.flat[lattice.nodes])
+            np.testing.assert_equal(lattice.scatter(compact),
+                                    np.where(mask, dense, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+import numpy as np
+
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.stats import ReynoldsStatsMixIn
+from dummy import DummyLogger
+
+
+class RecordingEvent(object):
+    def __init__(self):
+        self.complete = False
+
+    def query(self):
+        return self.complete
+
+    def synchronize(self):
+        self.complete = True
+
+
+class RecordingStream(object):
+    def __init__(self):
+        self.waited_for = []
+
+    def synchronize(self):
+        pass
+
+    def wait_for_event(self, event):
+        self.waited_for.append(event)
+
+
+class RecordingKernel(object):
+    def __init__(self, args):
+        self.args = args
+
+
+class RecordingBackend(DummyBackend):
+    """Keeps host and device buffers separate and makes every stats kernel
+    store the current sample at the offset it is launched with."""
+
+    def __init__(self, options=None):
+        self.sample = 0.0
+
+    def make_stream(self):
+        return RecordingStream()
+
+    def make_event(self, stream, timing=False):
+        return RecordingEvent()
+
+    def alloc_buf(self, size=None, like=None, wrap_in_array=True):
+        return np.zeros_like(like)
+
+    def from_buf_async(self, cl_buf, stream, target=None):
+        target[:] = cl_buf
+
+    def run_kernel(self, kernel, grid_size, stream=None):
+        offset = kernel.args[-1]
+        for arg in kernel.args:
+            if isinstance(arg, np.ndarray) and arg.ndim == 2:
+                arg.flat[offset:offset + arg.shape[1]] = self.sample
+
+
+class DummyProfile(object):
+    def record_cpu_start(self, what):
+        pass
+
+    def record_cpu_end(self, what):
+        pass
+
+
+class DummySpec(object):
+    nx = 8
+    ny = 2
+    nz = 2
+
+
+class DummyRunner(object):
+    def __init__(self):
+        self.backend = RecordingBackend()
+        self._spec = DummySpec()
+        self._lat_size = (2, 2, 8)
+        self._calc_stream = self.backend.make_stream()
+        self._profile = DummyProfile()
+
+    def gpu_field(self, field):
+        if type(field) is list:
+            return [self.gpu_field(x) for x in field]
+        return field
+
+    def get_kernel(self, name, args, args_format, block_size=None,
+                   more_shared=False):
+        return RecordingKernel(list(args))
+
+
+class ReynoldsSim(ReynoldsStatsMixIn):
+    stat_buf_size = 3
+
+    def __init__(self, config):
+        self.config = config
+        self.iteration = 0
+        self.snapshot_iters = []
+        shape = (2, 2, 8)
+        self.rho = np.zeros(shape)
+        self.v = [np.zeros(shape) for i in range(3)]
+
+
+class ReynoldsStatsTest(unittest.TestCase):
+    def setUp(self):
+        config = LBConfig()
+        config.lat_nx = 8
+        config.lat_ny = 2
+        config.lat_nz = 2
+        config.logger = DummyLogger()
+        self.runner = DummyRunner()
+        self.sim = ReynoldsSim(config)
+        self.batches = []
+
+    def _collect(self, iterations):
+        futures = []
+        for i in iterations:
+            self.sim.iteration = i
+            self.runner.backend.sample = float(i)
+            future = self.sim.collect_reynolds_stats(self.runner)
+            if future is not None:
+                futures.append(future)
+        return futures
+
+    def _offsets(self, buf_set):
+        return [k.args[-1] for k in self.sim._reyn_offset_kernels[buf_set]]
+
+    def _samples(self, iterations):
+        return np.array([[float(i)] * DummySpec.nx for i in iterations])
+
+    def _expected(self, iterations):
+        return self._samples(iterations) / (DummySpec.ny * DummySpec.nz)
+
+    def test_buffer_sets(self):
+        sim = self.sim
+        sim.prepare_reynolds_stats(self.runner)
+        self.assertEqual(len(sim._reyn_offset_kernels[0]), 5)
+
+        self.assertEqual(self._collect([1, 2]), [])
+        self.assertEqual(sim._reyn_set, 0)
+        self.assertEqual(self._offsets(0), [16] * 5)
+
+        # The first set is full and the offsets are reset.
+        future1, = self._collect([3])
+        self.assertEqual(sim._reyn_set, 1)
+        self.assertEqual(self._offsets(0), [0] * 5)
+        self.assertEqual(self._offsets(1), [0] * 5)
+
+        # Samples are now stored in the second set only.
+        future2, = self._collect([4, 5, 6])
+        self.assertEqual(sim._reyn_set, 0)
+        self.assertEqual(self._offsets(1), [0] * 5)
+        gpu = sim._reyn_gpu
+        for name in sim._reyn_stat_names:
+            np.testing.assert_equal(gpu[0][name], self._samples([1, 2, 3]))
+            np.testing.assert_equal(gpu[1][name], self._samples([4, 5, 6]))
+
+        # Stats of every batch reach the host.
+        res1 = future1.result()
+        res2 = future2.result()
+        self.assertEqual(res1['iters'], [1, 2, 3])
+        self.assertEqual(res2['iters'], [4, 5, 6])
+        for name in sim._reyn_stat_names:
+            np.testing.assert_equal(res1[name], self._expected([1, 2, 3]))
+            np.testing.assert_equal(res2[name], self._expected([4, 5, 6]))
+
+        # Going back to the first set has to wait for the host buffers to
+        # be released and the stats stream for the transfer from the set.
+        future3, = self._collect([7, 8, 9])
+        self.assertEqual(future3.result()['iters'], [7, 8, 9])
+        self.assertTrue(future1._event in sim._reyn_stream.waited_for)
+
+    def test_callback(self):
+        sim = self.sim
+        sim.prepare_reynolds_stats(self.runner, callback=self.batches.append)
+
+        future1, future2 = self._collect(range(1, 7))
+        # Transfers are not complete yet.
+        self.assertEqual(self.batches, [])
+
+        # Batches are delivered in order, even if a later transfer
+        # completes first.
+        future2._event.complete = True
+        self._collect([7])
+        self.assertEqual(self.batches, [])
+
+        future1._event.complete = True
+        self._collect([8])
+        self.assertEqual([b['iters'] for b in self.batches],
+                         [[1, 2, 3], [4, 5, 6]])
+
+    def test_finish_drains_batches(self):
+        sim = self.sim
+        sim.prepare_reynolds_stats(self.runner, callback=self.batches.append)
+
+        self._collect(range(1, 9))
+        sim.finish_reynolds_stats(self.runner)
+        self.assertEqual(sim._reyn_undelivered, [])
+        self.assertEqual([b['iters'] for b in self.batches],
+                         [[1, 2, 3], [4, 5, 6]])
+        for batch, iters in zip(self.batches, ([1, 2, 3], [4, 5, 6])):
+            np.testing.assert_equal(batch['ux_uy'], self._expected(iters))
+
+
+if __name__ == '__main__':
+    unittest.main()
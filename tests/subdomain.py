@@ -1,9 +1,11 @@
 from __future__ import division
 import numpy as np
 import operator
+import shutil
+import tempfile
 import unittest
 from sailfish.controller import LBGeometryProcessor
-from sailfish.node_type import NTEquilibriumDensity, NTEquilibriumVelocity, multifield, NTFullBBWall, _NTUnused, _NTPropagationOnly, NTHalfBBWall, DynamicValue, LinearlyInterpolatedTimeSeries
+from sailfish.node_type import NTEquilibriumDensity, NTEquilibriumVelocity, multifield, NTFullBBWall, _NTUnused, _NTPropagationOnly, NTHalfBBWall, DynamicValue, LinearlyInterpolatedTimeSeries, NTGradFreeflow
 from sailfish.subdomain import Subdomain2D, Subdomain3D, SubdomainSpec2D, SubdomainSpec3D, SubdomainPair
 from sailfish.subdomain_runner import SubdomainRunner
 from sailfish.sym import D2Q9, D3Q19, S
@@ -62,6 +64,42 @@ class TestNodeTypeSetting2D(TestCase2D):
         self.assertTrue(sub.config.time_dependence)
         self.assertTrue(sub.config.space_dependence)
 
+    def test_param_and_scratch_encoding(self):
+        """Verifies that nodes with the same parameter values share entries in
+        the parameter table and that scratch space IDs are assigned in
+        row-major order."""
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+
+        class _Subdomain2D(Subdomain2D):
+            def boundary_conditions(self, hx, hy):
+                where = (hx == 0)
+                self.set_node(where, NTEquilibriumVelocity(
+                    multifield((0.01 * (hy % 3), 0.0), where)))
+                self.set_node((hx == self.gx - 1) | ((hy == 0) & (hx > 0)),
+                              NTGradFreeflow)
+
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        sub.reset(encode=False)
+        encoder = sub._encoder
+
+        # 3 distinct velocity vectors.
+        self.assertEqual(len(encoder._geo_params), 6)
+        for y in range(0, self.lattice_size[1]):
+            np.testing.assert_array_almost_equal(
+                np.float64([0.01 * (y % 3), 0.0]),
+                np.float64(encoder.get_param((1, y + 1), 2)))
+
+        grad = np.argwhere(sub._type_map_base == NTGradFreeflow.id)
+        np.testing.assert_equal(
+            encoder._scratch_map[grad[:, 0], grad[:, 1]],
+            np.arange(grad.shape[0]))
+        self.assertEqual(encoder.scratch_space_size,
+                         grad.shape[0] * NTGradFreeflow.scratch_space_size(2))
+
     def test_solid_interior_nodes(self):
         """Verifies that interior solid nodes in a 2D cube are correctly
         rewritten as unused/propagation only."""
@@ -190,6 +228,76 @@ class TestNodeTypeSetting3D(TestCase3D):
         np.testing.assert_equal(expected, sub._type_map[0,:,:])
 
 
+# Geometry cache.
+# ===============
+
+class TestGeometryCache2D(TestCase2D):
+    class _SubdomainTest2D(TestNodeTypeSetting2D._SubdomainTest2D):
+        calls = 0
+
+        def boundary_conditions(self, hx, hy):
+            type(self).calls += 1
+            super(TestGeometryCache2D._SubdomainTest2D,
+                  self).boundary_conditions(hx, hy)
+            self.set_node((hx == self.gx - 1) & (hy > 5) & (hy < self.gy - 1),
+                          NTGradFreeflow)
+
+    def setUp(self):
+        TestCase2D.setUp(self)
+        self.config.geometry_cache_dir = tempfile.mkdtemp()
+        self._SubdomainTest2D.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.config.geometry_cache_dir)
+
+    def _make_subdomain(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = self._SubdomainTest2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        sub.reset()
+        return sub
+
+    def test_reload(self):
+        sub0 = self._make_subdomain()
+        sub1 = self._make_subdomain()
+        self.assertEqual(self._SubdomainTest2D.calls, 1)
+
+        np.testing.assert_equal(sub0.encoded_map(), sub1.encoded_map())
+        np.testing.assert_equal(sub0.visualization_map(),
+                                sub1.visualization_map())
+        np.testing.assert_equal(sub0._orientation_base, sub1._orientation_base)
+        self.assertTrue(sub1.scratch_space_size > 0)
+        self.assertEqual(sub0.scratch_space_size, sub1.scratch_space_size)
+        self.assertEqual(sub0._encoder.get_param((1, 1), 2),
+                         sub1._encoder.get_param((1, 1), 2))
+
+        ctx0, ctx1 = {}, {}
+        sub0.update_context(ctx0)
+        sub1.update_context(ctx1)
+        for key in ('node_params', 'nt_misc_shift', 'nt_param_shift',
+                    'nt_scratch_shift', 'timeseries_data', 'scratch_space_base',
+                    'type_id_remap', 'non_symbolic_idxs'):
+            self.assertEqual(ctx0[key], ctx1[key])
+        self.assertEqual(sorted(ctx0['symbol_idx_map'].keys()),
+                         sorted(ctx1['symbol_idx_map'].keys()))
+        for value in ctx1['symbol_idx_map'].values():
+            for ts in value.get_timeseries():
+                self.assertTrue(ts._offset is not None)
+
+        # A change of the settings invalidates the cached geometry.
+        self.config.use_link_tags = True
+        self._make_subdomain()
+        self.assertEqual(self._SubdomainTest2D.calls, 2)
+
+        # Geometries can be generated using random numbers.
+        self.config.seed += 1
+        self._make_subdomain()
+        self.assertEqual(self._SubdomainTest2D.calls, 3)
+
+
 # Orientation detection.
 # ======================
 
@@ -358,6 +466,29 @@ class TestOrientationDetection3D(TestCase3D):
         np.testing.assert_equal(sub._orientation[nz - 1, ny - 1, nx - 1], 0)
 
 
+class TestNeighborTypes3D(TestCase3D):
+    def test_neighbor_types(self):
+        spec = SubdomainSpec3D((0, 0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = TestOrientationDetection3D._ChannelSubdomain3D(
+            list(reversed(self.lattice_size)), spec, D3Q19)
+
+        rng = np.random.RandomState(0)
+        type_map = rng.randint(0, 8, size=(8, 10, 12)).astype(np.uint8)
+        select = rng.random_sample(type_map.shape) < 0.3
+        nodes, types = sub.neighbor_types(type_map, select)
+
+        np.testing.assert_equal(nodes, np.nonzero(select))
+        self.assertEqual(types.shape, (D3Q19.Q, np.sum(select)))
+        for i, vec in enumerate(D3Q19.basis):
+            shifted = type_map
+            for axis, shift in zip((2, 1, 0), vec):
+                shifted = np.roll(shifted, -int(shift), axis=axis)
+            np.testing.assert_equal(types[i], shifted[select])
+
+
 # Link tagging.
 # =============
 
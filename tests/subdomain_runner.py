@@ -1,18 +1,23 @@
 import ctypes
 import operator
 import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import zmq
 
+from sailfish import lb_base, sparse
 from sailfish.config import LBConfig
 from sailfish.connector import ZMQSubdomainConnector
 from sailfish.lb_base import LBSim
 from sailfish.lb_binary import LBBinaryFluidShanChen
 from sailfish.backend_dummy import DummyBackend
 from sailfish.subdomain_runner import SubdomainRunner, NNSubdomainRunner
-from sailfish.subdomain import SubdomainSpec2D, SubdomainSpec3D, SubdomainPair
-from sailfish.io import LBOutput
+from sailfish.subdomain import (Subdomain2D, SubdomainSpec2D, SubdomainSpec3D,
+                                SubdomainPair)
+from sailfish.io import CheckpointWriter, LBOutput
+from sailfish.node_type import NTEquilibriumVelocity, NTFullBBWall
 from sailfish.sym import D2Q9
 
 from dummy import *
@@ -176,7 +181,168 @@ class NNSubdomainRunnerTest(unittest.TestCase):
         np.testing.assert_equal(f_recv.recv_buf, fdist)
         np.testing.assert_equal(g_recv.recv_buf, gdist)
 
+        # Odd iterations of the AA access pattern use separate buffers for
+        # the fully local step.
+        sim1.iteration = sim2.iteration = 1
+        fdist = f_cbuf.local_coll_buf.host
+        gdist = g_cbuf.local_coll_buf.host
+        fdist.flat = np.mgrid[1000:1000 + fdist.size]
+        gdist.flat = np.mgrid[2000:2000 + gdist.size]
+
+        br1._send_dists()
+        br2._recv_dists()
+
+        np.testing.assert_equal(f_recv.local_recv_buf.host, fdist)
+        np.testing.assert_equal(g_recv.local_recv_buf.host, gdist)
+
         os.unlink(c1.ipc_file)
 
+class CircleSubdomain(Subdomain2D):
+    def _wall(self, hx, hy):
+        return (hx - 10)**2 + (hy - 8)**2 > 36
+
+    def load_active_node_map(self, hx, hy):
+        self.set_active_node_map_from_wall_map(self._wall(hx, hy))
+
+    def boundary_conditions(self, hx, hy):
+        self.set_node(self._wall(hx, hy), NTFullBBWall)
+        self.set_node((hx == 10) & (hy == 3),
+                      NTEquilibriumVelocity((0.01, 0.0)))
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0 + 0.01 * hx
+        sim.vx[:] = 0.1 * hy
+        sim.vy[:] = hx * hy
+
+
+class CircleSim(LBSim):
+    subdomain = CircleSubdomain
+
+    @classmethod
+    def fields(cls):
+        return [lb_base.ScalarField('rho'), lb_base.VectorField('v')]
+
+
+class RecordingOutput(LBOutput):
+    def save(self, i):
+        self.mask_nonfluid_nodes()
+        self.saved = dict((k, np.copy(v)) for k, v in
+                          self._scalar_fields.items())
+        self.saved.update((k, [np.copy(c) for c in v]) for k, v in
+                          self._vector_fields.items())
+
+
+class SparseHostStorageTest(unittest.TestCase):
+    """Verifies that keeping host data on compact arrays only
+    (--sparse_host_storage) does not change the simulation setup
+    or its output."""
+
+    def _run(self, sparse, ordering='row_major'):
+        config = LBConfig()
+        config.init_iters = 0
+        config.seed = 0
+        config.precision = 'single'
+        config.block_size = 8
+        config.mem_alignment = 8
+        config.node_addressing = 'indirect'
+        config.sparse_host_storage = sparse
+        config.node_ordering = ordering
+        config.lat_nx, config.lat_ny = 24, 16
+        config.logger = DummyLogger()
+        config.grid = 'D2Q9'
+        config.mode = 'batch'
+        config.periodic_x = config.periodic_y = False
+        config.use_link_tags = False
+        config.time_dependence = False
+        config.space_dependence = False
+        config.access_pattern = 'AB'
+        config.geometry_cache_dir = ''
+        config.geometry_threads = 0
+        config.output = 'test'
+        config.debug_dump_node_type_map = False
+
+        sim = CircleSim(config)
+        spec = SubdomainSpec2D((0, 0), (24, 16), envelope_size=1, id_=0)
+        output = RecordingOutput(config, 0)
+        runner = SubdomainRunner(sim, spec, output=output,
+                                 backend=DummyBackend(), quit_event=None)
+        runner._init_geometry()
+        sim.init_fields(runner)
+        runner._subdomain.init_fields(sim)
+        runner._init_gpu_data()
+        if sparse:
+            runner._subdomain.release_dense_maps()
+        runner._unravel_fields()
+        runner._output.save(0)
+        return runner, output
+
+    def test_dense_and_sparse_host_storage(self):
+        dense, dense_out = self._run(False)
+        sparse, sparse_out = self._run(True)
+
+        active = sparse._subdomain.active_nodes
+        self.assertEqual(sparse._sim.rho.shape, (active,))
+        self.assertIsNone(sparse._subdomain._type_map)
+
+        np.testing.assert_equal(dense._gpu_geo_map, sparse._gpu_geo_map)
+        np.testing.assert_equal(dense._subdomain.fluid_map(),
+                                sparse._subdomain.fluid_map())
+
+        self.assertEqual(sorted(dense_out.saved), sorted(sparse_out.saved))
+        for name, value in dense_out.saved.items():
+            np.testing.assert_equal(value, sparse_out.saved[name])
+
+        idx = (np.arange(24), np.full(24, 8, dtype=np.int))
+        np.testing.assert_equal(dense._get_global_idx(idx, 3),
+                                sparse._get_global_idx(idx, 3))
+
+    def test_node_orderings(self):
+        ref, ref_out = self._run(False)
+        ref_lattice = ref._subdomain.sparse_lattice
+        idx = (np.arange(24), np.full(24, 8, dtype=np.int))
+        ref_idx = ref._get_global_idx(idx, 3)
+
+        for ordering in sparse.NODE_ORDERINGS:
+            for sparse_host in (False, True):
+                runner, output = self._run(sparse_host, ordering)
+                lattice = runner._subdomain.sparse_lattice
+                self.assertEqual(sorted(lattice.nodes), list(ref_lattice.nodes))
+                if ordering != 'row_major':
+                    self.assertNotEqual(list(lattice.nodes),
+                                        list(ref_lattice.nodes))
+
+                np.testing.assert_equal(
+                    lattice.scatter(runner._gpu_geo_map),
+                    ref_lattice.scatter(ref._gpu_geo_map))
+                for name, value in ref_out.saved.items():
+                    np.testing.assert_equal(value, output.saved[name])
+
+                # Addresses of the same nodes in the compact arrays.
+                addr = runner._get_global_idx(idx, 3)
+                valid = ref_idx != SubdomainRunner.INVALID_NODE
+                np.testing.assert_equal(addr[~valid], ref_idx[~valid])
+                offset = 3 * lattice.size
+                np.testing.assert_equal(
+                    lattice.nodes[addr[valid] - offset],
+                    ref_lattice.nodes[ref_idx[valid] - offset])
+
+    def test_checkpoint_node_ordering(self):
+        runner, _ = self._run(False)
+        shape = (9, runner._subdomain.active_nodes)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'cp')
+            writer = CheckpointWriter()
+            writer.save(fname, b'state',
+                        {'dist0a': np.zeros(shape, dtype=np.float32)},
+                        {'node_addressing': 'indirect',
+                         'node_ordering': 'hilbert'})
+            writer.wait()
+            self.assertRaises(ValueError, runner.restore_checkpoint,
+                              fname + '.npz')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -61,6 +61,31 @@ class TestMiscUtils(unittest.TestCase):
         np.testing.assert_array_equal(
                 util.in_anyd(a, b), util.in_anyd_fast(a, b))
 
+    def test_chunked_stencil(self):
+        for shape in ((7, 5), (6, 5, 4)):
+            a = np.random.randint(0, 100, shape)
+            axes = tuple(range(len(shape)))
+            shifts = [[x - 1 for x in s] for s in np.ndindex(*([3] * len(shape)))]
+            for chunk_nodes in (1, 12, 1 << 20):
+                for threads in (1, 3):
+                    out = np.zeros((len(shifts),) + shape, dtype=a.dtype)
+                    out_flat = np.zeros_like(out)
+
+                    def _copy(block, start, stop):
+                        center = util.shifted_view(block, [0] * len(shape))
+                        nodes = np.ravel_multi_index(
+                            [x + 1 for x in np.indices(center.shape)],
+                            block.shape)
+                        for i, shift in enumerate(shifts):
+                            out[i, start:stop] = util.shifted_view(block, shift)
+                            out_flat[i, start:stop] = block.reshape(-1)[
+                                nodes + util.flat_offset(block, shift)]
+
+                    util.chunked_stencil(_copy, a, 1, threads, chunk_nodes)
+                    for i, shift in enumerate(shifts):
+                        expected = np.roll(a, [-x for x in shift], axes)
+                        np.testing.assert_array_equal(out[i], expected)
+                        np.testing.assert_array_equal(out_flat[i], expected)
 
 if __name__ == '__main__':
     unittest.main()
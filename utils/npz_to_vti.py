@@ -16,8 +16,7 @@ import os
 import sys
 import numpy as np
 
-os.environ['ETS_TOOLKIT'] = 'null'
-from tvtk.api import tvtk
+from sailfish import io
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dt', type=float, default=0.0)
@@ -34,7 +33,7 @@ for field in src_data.files:
 
 field = src_data[src_data.files[0]]
 shape = None
-origin = [0.0, 0.0, 0.0]
+origin = [-0.5, -0.5, -0.5]
 spacing = [1.0, 1.0, 1.0]
 config = {}
 
@@ -51,7 +50,9 @@ if len(sys.argv) > 2:
     for i, ((xmin, xmax), lb_extent) in enumerate(zip(config['bounding_box'], config['size'])):
         # -2 is due to padding
         scale = (xmax - xmin) / (lb_extent - 2)
-        origin[i] = xmin - 0.5 * scale
+        # Nodes are saved as cells, so the origin is at the corner of the
+        # cell of the first node.
+        origin[i] = xmin - scale
         spacing[i] = scale
 
         if 'slices' in config:
@@ -90,43 +91,16 @@ elif max_len == 3:
 else:
     raise ValueError('Unexpected field shape length %d' % max_len)
 
-first = True
-idata = tvtk.ImageData(spacing=spacing, origin=origin)
-# Only process scalar fields.
+scalar_fields = {}
+vector_fields = {}
 for field in src_data.files:
-    if len(src_data[field].shape) == max_len:
-        continue
-
-    if first:
-        idata.point_data.scalars = reorder(src_data[field]).flatten()
-        idata.point_data.scalars.name = field
-        first = False
-    else:
-        t = idata.point_data.add_array(reorder(src_data[field]).flatten())
-        idata.point_data.get_array(t).name = field
-
-# Only process vector fields.
-for field in src_data.files:
-    if len(src_data[field].shape) != max_len:
-        continue
-
     f = src_data[field]
-
-    if dim == 3:
-        tmp = idata.point_data.add_array(np.c_[reorder(f[0]).flatten() * spacing[0]/dt,
-                                               reorder(f[1]).flatten() * spacing[1]/dt,
-                                               reorder(f[2]).flatten() * spacing[2]/dt])
+    if len(f.shape) == max_len:
+        vector_fields[field] = [reorder(f[i]) * spacing[i] / dt
+                                for i in range(dim)]
     else:
-        tmp = idata.point_data.add_array(np.c_[reorder(f[0]).flatten() * spacing[0]/dt,
-                                               reorder(f[1]).flatten() * spacing[1]/dt,
-                                               np.zeros_like(f[0].flatten())])
-    idata.point_data.get_array(tmp).name = field
-
-if dim == 3:
-    idata.dimensions = list(reversed(shape))
-else:
-    idata.dimensions = list(reversed(shape)) + [1]
+        scalar_fields[field] = reorder(f)
 
 out_filename = filename.replace('.npz', '.vti')
-w = tvtk.XMLImageDataWriter(input=idata, file_name=out_filename)
-w.write()
+io.write_vti(out_filename, scalar_fields, vector_fields, origin=origin,
+             spacing=spacing, compress=True)